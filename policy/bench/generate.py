@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Generate synthetic CIB and PIB repositories, and a matching mix of PM requests, for benchmarking the PM.
+
+The CIB contains root nodes for a number of local interfaces, linked nodes describing remote endpoints reachable
+through every interface (optionally with several alternative property sets each), and extenders which augment
+matching CIB rows in the same way as cached happy eyeballs results (see doc/CIB_format.md). The PIB contains
+policies with different priorities and match shapes (any, single property, several properties, ranges and IP
+prefixes), optionally with several alternative property sets, and profiles mapping abstract request properties to
+concrete ones (see doc/NEAT_policies.md). Output is deterministic for a given seed.
+
+    ./generate.py --roots 4 --remotes 500 --policies 200 /tmp/bench
+"""
+import argparse
+import json
+import os
+import random
+
+TRANSPORTS = ['TCP', 'SCTP', 'SCTP/UDP', 'UDP', 'UDPLite']
+MATCH_SHAPES = ['any', 'single', 'multi', 'range', 'prefix']
+
+
+def prop(value, precedence=None, score=None):
+    p = {'value': value}
+    if precedence is not None:
+        p['precedence'] = precedence
+    if score is not None:
+        p['score'] = score
+    return p
+
+
+def remote_ip(j):
+    # TEST-NET range reserved for benchmarking
+    return '198.18.%d.%d' % (j >> 8 & 255, j & 255)
+
+
+def gen_cib(roots=4, remotes=100, extenders=0, alternatives=1, seed=0):
+    """Return a list of CIB node dictionaries"""
+    rng = random.Random(seed)
+    nodes = []
+    for i in range(roots):
+        nodes.append({'uid': 'bench_if%d' % i, 'root': True, 'expire': -1, 'priority': 4,
+                      'properties': {'interface': prop('bench_if%d' % i, 2),
+                                     'local_ip': prop('10.%d.0.1' % i, 2),
+                                     'capacity': prop(rng.choice([100, 1000, 10000]), 2),
+                                     'is_wired': prop(i % 2 == 0, 2),
+                                     'MTU': prop({'start': 50, 'end': rng.choice([1500, 9000])})}})
+
+    for j in range(remotes):
+        properties = {'remote_ip': prop(remote_ip(j), 2, 2),
+                      'port': prop(rng.choice([80, 443, 8080]), 2, 1),
+                      'RTT': prop(rng.randint(1, 200), 2)}
+        if alternatives > 1:
+            # each alternative generates a separate CIB row
+            options = [{'transport': prop(t, 2, alternatives - k)}
+                       for k, t in enumerate(rng.sample(TRANSPORTS, min(alternatives, len(TRANSPORTS))))]
+            properties = [properties, options]
+        for i in range(roots):
+            nodes.append({'uid': 'bench_if%d_remote_%d' % (i, j), 'link': True, 'expire': -1, 'priority': 2,
+                          'match': [{'uid': prop('bench_if%d' % i)}],
+                          'properties': properties})
+
+    for k in range(extenders):
+        i = rng.randrange(roots)
+        j = rng.randrange(max(remotes, 1))
+        nodes.append({'uid': 'bench_extender_%d' % k, 'link': False, 'expire': -1, 'priority': 10,
+                      'match': [{'interface': prop('bench_if%d' % i), 'remote_ip': prop(remote_ip(j))}],
+                      'properties': [{'transport': prop(rng.choice(TRANSPORTS), 1),
+                                      'local_port': prop(rng.randint(1024, 65535), 1),
+                                      '__cached': prop(True, 2, 5)}]})
+    return nodes
+
+
+def gen_match(shape, rng, roots, remotes):
+    if shape == 'any':
+        return {}
+    if shape == 'single':
+        return {'transport': prop(rng.choice(TRANSPORTS))}
+    if shape == 'multi':
+        return {'interface': prop('bench_if%d' % rng.randrange(roots)),
+                'remote_ip': prop(remote_ip(rng.randrange(max(remotes, 1))))}
+    if shape == 'range':
+        start = rng.choice([0, 10, 50])
+        return {'RTT': prop({'start': start, 'end': start + rng.choice([20, 100])}, 2)}
+    if shape == 'prefix':
+        return {'remote_ip': prop('198.18.%d.0/24' % rng.randrange(max(remotes >> 8, 1)))}
+    raise ValueError('unknown match shape %s' % shape)
+
+
+def gen_pib(policies=50, profiles=5, options=1, shapes=None, roots=4, remotes=100, seed=0):
+    """Return lists of policy and profile dictionaries"""
+    rng = random.Random(seed + 1)
+    shapes = shapes or MATCH_SHAPES
+
+    pib = []
+    for k in range(policies):
+        shape = shapes[k % len(shapes)]
+        properties = {'SO/SOL_SOCKET/SO_PRIORITY': prop(rng.randint(0, 6), 1),
+                      'bench_policy_%d' % (k % 10): prop(True, 1, rng.randint(0, 3))}
+        if options > 1:
+            properties = [[dict(properties, bench_option=prop(o, 1, options - o)) for o in range(options)]]
+        pib.append({'uid': 'bench_policy_%d' % k, 'policy_type': 'policy', 'priority': rng.randint(0, 9),
+                    'description': 'benchmark policy (%s match)' % shape, 'replace_matched': False,
+                    'match': gen_match(shape, rng, roots, remotes), 'properties': properties})
+
+    profile_list = [{'uid': 'bench_reliable', 'policy_type': 'profile', 'priority': 2, 'replace_matched': True,
+                     'match': {'transport': prop('reliable')},
+                     'properties': [[{'transport': prop(t, 2, 3 - n)} for n, t in
+                                     enumerate(['SCTP', 'TCP', 'SCTP/UDP'])]]},
+                    {'uid': 'bench_low_latency', 'policy_type': 'profile', 'priority': 1,
+                     'match': {'low_latency': prop(True)},
+                     'properties': {'RTT': prop({'start': 0, 'end': 50}, 1, 5)}}]
+    for k in range(max(profiles - len(profile_list), 0)):
+        profile_list.append({'uid': 'bench_profile_%d' % k, 'policy_type': 'profile', 'priority': rng.randint(3, 9),
+                             'match': {'bench_class': prop(k)},
+                             'properties': {'transport': prop(rng.choice(TRANSPORTS), 1, 1)}})
+    return pib, profile_list[:profiles]
+
+
+def gen_requests(count=20, remotes=100, seed=0):
+    """Return a list of PM requests, each of which is a list of request objects like request.json"""
+    rng = random.Random(seed + 2)
+    requests = []
+    for _ in range(count):
+        ip = remote_ip(rng.randrange(max(remotes, 1)))
+        request = [{'remote_ip': prop(ip, 2), 'transport': prop('reliable'),
+                    'low_latency': prop(rng.random() < 0.5, 1), 'MTU': prop({'start': 1500, 'end': 9000})}]
+        if rng.random() < 0.5:
+            # second request variant, as sent by NEAT for multiple transports
+            request.append({'remote_ip': prop(ip, 2), 'transport': prop('UDP'), 'low_latency': prop(True, 2),
+                            'MTU': prop({'start': 300, 'end': 1500})})
+        requests.append(request)
+    return requests
+
+
+def write_json(path, obj):
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=1)
+
+
+def write(directory, args):
+    """Write the CIB, PIB and request mix to directory/cib, directory/pib and directory/requests.ndjson"""
+    cib_dir = os.path.join(directory, 'cib')
+    pib_dir = os.path.join(directory, 'pib')
+    os.makedirs(cib_dir, exist_ok=True)
+    os.makedirs(pib_dir, exist_ok=True)
+
+    nodes = gen_cib(args.roots, args.remotes, args.extenders, args.alternatives, args.seed)
+    for node in nodes:
+        write_json(os.path.join(cib_dir, node['uid'] + '.cib'), node)
+
+    policies, profiles = gen_pib(args.policies, args.profiles, args.options, args.shapes, args.roots, args.remotes,
+                                 args.seed)
+    for p in policies:
+        write_json(os.path.join(pib_dir, p['uid'] + '.policy'), p)
+    for p in profiles:
+        write_json(os.path.join(pib_dir, p['uid'] + '.profile'), p)
+
+    requests_file = os.path.join(directory, 'requests.ndjson')
+    with open(requests_file, 'w') as f:
+        for r in gen_requests(args.requests, args.remotes, args.seed):
+            f.write(json.dumps(r) + '\n')
+
+    return {'cib_nodes': len(nodes), 'policies': len(policies), 'profiles': len(profiles),
+            'cib': cib_dir, 'pib': pib_dir, 'requests': requests_file}
+
+
+def add_arguments(parser):
+    parser.add_argument('--roots', type=int, default=4, help='number of CIB root nodes (interfaces)')
+    parser.add_argument('--remotes', type=int, default=100, help='number of remote endpoints linked to each root')
+    parser.add_argument('--extenders', type=int, default=0, help='number of CIB nodes extending CIB rows')
+    parser.add_argument('--alternatives', type=int, default=1,
+                        help='number of alternative transport properties of each remote endpoint')
+    parser.add_argument('--policies', type=int, default=50, help='number of policies')
+    parser.add_argument('--profiles', type=int, default=5, help='number of profiles')
+    parser.add_argument('--options', type=int, default=1, help='number of alternative property sets of each policy')
+    parser.add_argument('--shapes', type=str, nargs='+', default=None, choices=MATCH_SHAPES,
+                        help='match shapes of the policies (default: all)')
+    parser.add_argument('--requests', type=int, default=20, help='number of distinct requests in the request mix')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic CIB, PIB and PM request mix')
+    add_arguments(parser)
+    parser.add_argument('directory', help='output directory')
+    args = parser.parse_args()
+    print(json.dumps(write(args.directory, args), indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Concurrent load generator for a running neatpmd, mimicking the PM clients of the NEAT core.
+
+Every PM request uses a new connection to neat_pm_socket with the same sequence as nt_json_send_once: start the
+timeout timer, connect, write the indented JSON request, shut down the sending side and read the reply until the PM
+closes the connection. Requests which are not answered within the PM timeout of the core (3 s) are aborted and
+counted as timeouts. Requests are either sent at an open-loop arrival rate (Poisson or uniform), independent of the
+replies, or by a fixed number of closed-loop clients.
+
+Concurrently, HE result writers send cached happy eyeballs results to neat_cib_socket in the same format as the NEAT
+core (nt_json_send_once_no_reply), and PIB writers upload policies to neat_pib_socket.
+
+    ./loadgen.py --rate 500 --duration 30 --template ../request.json --cib-rate 50
+    ./loadgen.py --concurrency 2000 --duration 10 --template requests.ndjson:3 --template ../request.json:1
+
+The report is printed as JSON. Replies without candidates, e.g., requests shed by the PM, are counted as empty.
+"""
+import argparse
+import asyncio
+import bisect
+import collections
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+# timeout of the PM requests of the NEAT core in seconds (see neat_pm_socket.c)
+PM_TIMEOUT = 3.0
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = []
+        self.counts = collections.Counter()
+        self.errors = collections.Counter()
+        self.candidates = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def start(self):
+        self.counts['sent'] += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finish(self, result, latency=None, error=None):
+        self.in_flight -= 1
+        self.counts[result] += 1
+        if latency is not None:
+            self.latencies.append(latency)
+        if error is not None:
+            self.errors[error] += 1
+
+    def report(self, duration, budget=None):
+        latencies = sorted(self.latencies)
+        report = dict(self.counts, duration_s=duration, max_in_flight=self.max_in_flight,
+                      rate=self.counts['sent'] / duration if duration else 0.0)
+        if latencies:
+            report['latency_ms'] = {'p50': percentile(latencies, 0.5) * 1000,
+                                    'p90': percentile(latencies, 0.9) * 1000,
+                                    'p99': percentile(latencies, 0.99) * 1000,
+                                    'p999': percentile(latencies, 0.999) * 1000,
+                                    'max': latencies[-1] * 1000}
+        if budget is not None and self.counts['sent']:
+            report['within_budget'] = self.counts['ok'] / self.counts['sent']
+            # share of the PM timeout of the core used by the slowest requests
+            report['p99_budget_share'] = percentile(latencies, 0.99) / budget if latencies else None
+        if self.errors:
+            report['errors'] = dict(self.errors)
+        return report
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def load_templates(specs):
+    """Load request templates given as FILE[:WEIGHT]. NDJSON files contain one request per line."""
+    templates = []
+    weights = []
+    for spec in specs:
+        path, _, weight = spec.partition(':')
+        with open(path) as f:
+            if path.endswith('.ndjson'):
+                requests = [json.loads(line) for line in f if line.strip()]
+            else:
+                requests = [json.load(f)]
+        for r in requests:
+            # the NEAT core sends indented JSON (JSON_INDENT(2))
+            templates.append(json.dumps(r, indent=2).encode())
+            weights.append(float(weight or 1) / len(requests))
+    return templates, weights
+
+
+async def send_once(path, data, stats, budget, expect_reply=True):
+    """Send a request using a new connection, as nt_json_send_once does"""
+    stats.start()
+    start = time.perf_counter()
+    writer = None
+
+    async def exchange():
+        nonlocal writer
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(data)
+        await writer.drain()
+        writer.write_eof()
+        if expect_reply:
+            return await reader.read()
+
+    try:
+        reply = await asyncio.wait_for(exchange(), budget)
+    except asyncio.TimeoutError:
+        stats.finish('timeout')
+        return
+    except (OSError, EOFError) as e:
+        stats.finish('error', error=type(e).__name__)
+        return
+    finally:
+        if writer is not None:
+            writer.close()
+
+    latency = time.perf_counter() - start
+    if expect_reply:
+        try:
+            candidates = len(json.loads(reply.decode()))
+        except (UnicodeDecodeError, ValueError):
+            stats.finish('error', latency, error='invalid reply')
+            return
+        stats.candidates += candidates
+        if not candidates:
+            # e.g., shed by the admission control of the PM
+            stats.counts['empty'] += 1
+    stats.finish('ok', latency)
+
+
+def he_result(rng, interfaces, remotes):
+    """CIB node reporting a happy eyeballs result, as sent by send_result_connection_attempt_to_pm"""
+    success = rng.random() < 0.9
+    return [{'match': [{'interface': {'value': rng.choice(interfaces)}}], 'link': True,
+             'properties': {'transport': {'value': rng.choice(['TCP', 'SCTP'])},
+                            'remote_ip': {'value': rng.choice(remotes)},
+                            'port': {'value': rng.choice([80, 443])},
+                            '__he_candidate_success': {'value': success, 'score': 5 if success else -5},
+                            '__cached': {'value': True}}}]
+
+
+def policy(rng, n):
+    return {'uid': 'loadgen_policy_%d' % (n % 100), 'priority': rng.randint(0, 9),
+            'match': {'remote_ip': {'value': '198.18.%d.%d' % (rng.randrange(4), rng.randrange(256))}},
+            'properties': {'loadgen': {'value': n, 'precedence': 1}}}
+
+
+class Mix(object):
+    """Weighted random choice of request templates"""
+
+    def __init__(self, templates, weights, rng):
+        self.templates = templates
+        self.cumulative = list(itertools.accumulate(weights))
+        self.rng = rng
+
+    def choice(self):
+        i = bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])
+        return self.templates[min(i, len(self.templates) - 1)]
+
+
+async def open_loop(rate, duration, poisson, rng, start_request, max_in_flight=None, stats=None):
+    """
+    Start requests at the arrival times of an open-loop process, without waiting for previous requests. Arrivals
+    exceeding max_in_flight concurrent requests are dropped.
+    """
+    loop = asyncio.get_event_loop()
+    tasks = set()
+    start = t = loop.time()
+    while True:
+        t += rng.expovariate(rate) if poisson else 1 / rate
+        if t - start > duration:
+            break
+        await asyncio.sleep(max(t - loop.time(), 0))
+        if max_in_flight is not None and len(tasks) >= max_in_flight:
+            stats.counts['dropped'] += 1
+            continue
+        task = asyncio.ensure_future(start_request())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+async def closed_loop(path, mix, stats, args):
+    deadline = time.perf_counter() + args.duration
+
+    async def client():
+        while time.perf_counter() < deadline:
+            await send_once(path, mix.choice(), stats, args.budget)
+
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+
+
+def writer(path, stats, make):
+    """Write CIB nodes or policies without waiting for a reply, as nt_json_send_once_no_reply does"""
+    counter = itertools.count()
+    return lambda: send_once(path, json.dumps(make(next(counter)), indent=2).encode(), stats, PM_TIMEOUT,
+                             expect_reply=False)
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    mix = Mix(*load_templates(args.template), rng=rng)
+    sock_dir = os.path.expanduser(args.sock)
+    pm_stats, cib_stats, pib_stats = Stats(), Stats(), Stats()
+
+    pm_sock = os.path.join(sock_dir, 'neat_pm_socket')
+    jobs = []
+    if args.rate > 0:
+        jobs.append(open_loop(args.rate, args.duration, args.arrival == 'poisson', rng,
+                              lambda: send_once(pm_sock, mix.choice(), pm_stats, args.budget),
+                              args.max_connections, pm_stats))
+    else:
+        jobs.append(closed_loop(pm_sock, mix, pm_stats, args))
+    if args.cib_rate > 0:
+        interfaces = args.interfaces or ['eth0']
+        remotes = ['198.18.0.%d' % i for i in range(1, 255)]
+        jobs.append(open_loop(args.cib_rate, args.duration, True, rng,
+                              writer(os.path.join(sock_dir, 'neat_cib_socket'), cib_stats,
+                                     lambda n: he_result(rng, interfaces, remotes))))
+    if args.pib_rate > 0:
+        jobs.append(open_loop(args.pib_rate, args.duration, True, rng,
+                              writer(os.path.join(sock_dir, 'neat_pib_socket'), pib_stats,
+                                     lambda n: policy(rng, n))))
+
+    start = time.perf_counter()
+    await asyncio.gather(*jobs)
+    duration = time.perf_counter() - start
+
+    report = {'budget_s': args.budget, 'pm': pm_stats.report(duration, args.budget)}
+    if pm_stats.counts['ok']:
+        report['pm']['candidates_per_reply'] = pm_stats.candidates / pm_stats.counts['ok']
+    if args.cib_rate > 0:
+        report['cib_writers'] = cib_stats.report(duration)
+    if args.pib_rate > 0:
+        report['pib_writers'] = pib_stats.report(duration)
+    return report
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent load generator for neatpmd')
+    parser.add_argument('--sock', type=str, default='~/.neat', help='directory of the neatpmd Unix sockets')
+    parser.add_argument('--template', type=str, action='append', default=None,
+                        help='request template FILE[:WEIGHT] (.json or .ndjson), may be given multiple times')
+    parser.add_argument('--rate', type=float, default=100, help='open-loop PM request rate per second (0: closed loop)')
+    parser.add_argument('--arrival', type=str, default='poisson', choices=['poisson', 'uniform'],
+                        help='distribution of the open-loop inter-arrival times')
+    parser.add_argument('--concurrency', type=int, default=100, help='number of closed-loop clients')
+    parser.add_argument('--max-connections', type=int, default=10000,
+                        help='maximum number of concurrent open-loop requests, further arrivals are dropped')
+    parser.add_argument('--duration', type=float, default=10, help='duration of the test in seconds')
+    parser.add_argument('--budget', type=float, default=PM_TIMEOUT, help='PM request timeout in seconds')
+    parser.add_argument('--cib-rate', type=float, default=0, help='rate of HE results written to the CIB socket')
+    parser.add_argument('--interfaces', type=str, nargs='+', default=None, help='interfaces used in HE results')
+    parser.add_argument('--pib-rate', type=float, default=0, help='rate of policies written to the PIB socket')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    args = parser.parse_args()
+
+    if not args.template:
+        args.template = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'request.json')]
+    limit = raise_fd_limit() - 100
+    if args.rate <= 0 and args.concurrency > limit:
+        parser.error('the open file limit is too low for %d connections' % args.concurrency)
+    if args.max_connections > limit:
+        print('limiting concurrent requests to %d (open file limit)' % limit, file=sys.stderr)
+        args.max_connections = limit
+
+    report = asyncio.get_event_loop().run_until_complete(run(args))
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
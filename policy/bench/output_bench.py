@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Measure the per-request overhead of the neatpmd output modes.
+
+Starts neatpmd in terminal and in production mode with stdout/stderr connected to a pipe (as under journald),
+loads a CIB with remote endpoints for a few interfaces and sends identical PM requests one after another. The
+candidate cache is disabled, so that every request runs the complete lookup pipeline. Results are printed as JSON.
+
+    ./output_bench.py -n 500 --remotes 200
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from pmbench import request, wait_for
+
+POLICY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def gen_nodes(interfaces, remotes):
+    nodes = []
+    for i in range(interfaces):
+        nodes.append({'uid': 'eth%d' % i, 'root': True, 'expire': -1,
+                      'properties': {'interface': {'value': 'eth%d' % i, 'precedence': 2},
+                                     'local_ip': {'value': '10.0.%d.1' % i, 'precedence': 2}}})
+    for j in range(remotes):
+        nodes.append({'uid': 'remote_%d' % j, 'link': True, 'expire': -1,
+                      'match': [{'uid': {'value': 'eth%d' % (j % interfaces)}}],
+                      'properties': {'remote_ip': {'value': '8.8.%d.%d' % (j >> 8 & 255, j & 255), 'precedence': 2},
+                                     'transport': {'value': ['TCP', 'SCTP'], 'score': 1}}})
+    return nodes
+
+
+def bench_mode(mode, args, nodes, req):
+    tmp = tempfile.mkdtemp(prefix='neat_bench_')
+    sock_dir = os.path.join(tmp, 'sock')
+    cib_dir = os.path.join(tmp, 'cib')
+    pib_dir = os.path.join(tmp, 'pib')
+    os.makedirs(sock_dir)
+    os.makedirs(cib_dir)
+    shutil.copytree(os.path.join(POLICY_DIR, 'examples', 'pib'), pib_dir)
+
+    cmd = [sys.executable, os.path.join(POLICY_DIR, 'neatpmd'), '--sock', sock_dir, '--cib', cib_dir, '--pib', pib_dir,
+           '--candidate-cache', '0', '--output', mode]
+    env = dict(os.environ, HOME=tmp)
+    proc = subprocess.Popen(cmd, cwd=POLICY_DIR, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+
+    # drain the output like a log collector
+    output = {'bytes': 0}
+
+    def drain():
+        for line in proc.stdout:
+            output['bytes'] += len(line)
+
+    reader = threading.Thread(target=drain, daemon=True)
+    reader.start()
+
+    try:
+        pm_sock = os.path.join(sock_dir, 'neat_pm_socket')
+        stream_sock = os.path.join(sock_dir, 'neat_cib_stream_socket')
+        wait_for(pm_sock)
+        wait_for(stream_sock)
+        request(stream_sock, ''.join(json.dumps(n) + '\n' for n in nodes).encode(), timeout=60)
+
+        for _ in range(args.warmup):
+            request(pm_sock, req)
+        output['bytes'] = 0
+
+        latencies = []
+        for _ in range(args.n):
+            start = time.perf_counter()
+            request(pm_sock, req)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        proc.terminate()
+        proc.wait()
+        reader.join(timeout=5)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    latencies.sort()
+    return {'requests': args.n,
+            'mean_ms': statistics.mean(latencies) * 1000,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+            'output_bytes_per_request': output['bytes'] / args.n}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the neatpmd output modes')
+    parser.add_argument('-n', type=int, default=200, help='number of measured requests')
+    parser.add_argument('--warmup', type=int, default=20, help='number of requests sent before measuring')
+    parser.add_argument('--interfaces', type=int, default=4, help='number of interfaces in the CIB')
+    parser.add_argument('--remotes', type=int, default=100, help='number of remote endpoints in the CIB')
+    args = parser.parse_args()
+
+    nodes = gen_nodes(args.interfaces, args.remotes)
+    req = json.dumps([{'remote_ip': {'value': '8.8.0.1', 'precedence': 2},
+                       'transport': {'value': 'reliable'}}]).encode()
+
+    results = {mode: bench_mode(mode, args, nodes, req) for mode in ('terminal', 'production')}
+    results['overhead_ms'] = results['terminal']['mean_ms'] - results['production']['mean_ms']
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
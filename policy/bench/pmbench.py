@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the PM request processing.
+
+Starts neatpmd in production mode against a generated (see generate.py) or a given CIB/PIB, replays a mix of PM
+requests over the Unix socket using the one-shot mode of the NEAT library, and prints a JSON report with throughput,
+latency percentiles, the memory used by neatpmd and the number of returned candidates. Reports contain the current
+git commit and the benchmark parameters, so that runs can be compared across commits:
+
+    ./pmbench.py --remotes 500 --policies 200 -n 2000 -c 4 --report base.json
+    git checkout ...
+    ./pmbench.py --remotes 500 --policies 200 -n 2000 -c 4 --compare base.json
+
+Request mixes are either JSON files containing a single request (e.g., ../request.json) or newline delimited JSON
+files with one request per line.
+
+The startup of neatpmd is reported as the time until the PM socket is bound, until the first request is answered and
+until the CIB and PIB are completely loaded (neat_pm_ready). Use --fast-start to compare the deferred loading of the
+repositories with the default startup.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import generate
+
+POLICY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def request(path, data, timeout=10):
+    """Send a request using the one-shot mode and return the reply"""
+    s = socket.socket(socket.AF_UNIX)
+    s.settimeout(timeout)
+    s.connect(path)
+    s.sendall(data)
+    s.shutdown(socket.SHUT_WR)
+    reply = b''
+    while True:
+        chunk = s.recv(65536)
+        if not chunk:
+            break
+        reply += chunk
+    s.close()
+    return reply
+
+
+def wait_for(path, timeout=30, proc=None):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError('neatpmd exited with code %d' % proc.returncode)
+        if time.time() > deadline:
+            raise TimeoutError('neatpmd did not create %s' % path)
+        time.sleep(0.01)
+
+
+def load_requests(paths):
+    requests = []
+    for path in paths:
+        with open(path) as f:
+            if path.endswith('.ndjson'):
+                requests.extend(line.strip().encode() for line in f if line.strip())
+            else:
+                requests.append(json.dumps(json.load(f)).encode())
+    return requests
+
+
+def rss_kb(pid, field='VmRSS'):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def children(pid):
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=POLICY_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_neatpmd(tmp, cib_dir, pib_dir, first_request, args):
+    sock_dir = os.path.join(tmp, 'sock')
+    os.makedirs(sock_dir, exist_ok=True)
+    cmd = [sys.executable, os.path.join(POLICY_DIR, 'neatpmd'), '--sock', sock_dir, '--cib', cib_dir, '--pib', pib_dir,
+           '--output', 'production']
+    if args.workers is not None:
+        cmd += ['--request-workers', str(args.workers)]
+    if args.candidate_cache is not None:
+        cmd += ['--candidate-cache', str(args.candidate_cache)]
+    if args.fast_start:
+        cmd += ['--fast-start']
+    cmd += args.neatpmd_args
+
+    log = open(os.path.join(tmp, 'neatpmd.log'), 'wb')
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=POLICY_DIR, env=dict(os.environ, HOME=tmp), stdin=subprocess.DEVNULL,
+                            stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    pm_sock = os.path.join(sock_dir, 'neat_pm_socket')
+    wait_for(pm_sock, timeout=args.startup_timeout, proc=proc)
+    startup = {'socket_s': time.perf_counter() - start}
+
+    # poll until the first request is answered, as a NEAT application started together with the PM would
+    deadline = time.time() + args.startup_timeout
+    while True:
+        try:
+            request(pm_sock, first_request, timeout=args.startup_timeout)
+            break
+        except OSError:
+            if time.time() > deadline:
+                raise TimeoutError('neatpmd did not answer a request')
+            time.sleep(0.001)
+    startup['first_answer_s'] = time.perf_counter() - start
+
+    wait_for(os.path.join(sock_dir, 'neat_pm_ready'), timeout=args.startup_timeout, proc=proc)
+    startup['ready_s'] = time.perf_counter() - start
+    return proc, pm_sock, startup
+
+
+def replay(pm_sock, requests, args):
+    """Send args.n requests from the mix using args.c concurrent clients"""
+    latencies = []
+    candidates = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(args.n))
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            t = time.perf_counter()
+            try:
+                reply = request(pm_sock, requests[i % len(requests)], timeout=args.timeout)
+                n = len(json.loads(reply.decode()))
+            except (OSError, ValueError) as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - t)
+                candidates.append(n)
+
+    threads = [threading.Thread(target=client) for _ in range(args.c)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, candidates, errors, time.perf_counter() - start
+
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix='neat_bench_')
+    try:
+        if args.cib or args.pib:
+            cib_dir = args.cib or os.path.join(tmp, 'empty_cib')
+            pib_dir = args.pib or os.path.join(tmp, 'empty_pib')
+            os.makedirs(cib_dir, exist_ok=True)
+            os.makedirs(pib_dir, exist_ok=True)
+            generated = None
+        else:
+            generated = generate.write(tmp, args)
+            cib_dir, pib_dir = generated['cib'], generated['pib']
+
+        request_files = args.request_files or ([generated['requests']] if generated else
+                                               [os.path.join(POLICY_DIR, 'request.json')])
+        requests = load_requests(request_files)
+
+        proc, pm_sock, startup = start_neatpmd(tmp, cib_dir, pib_dir, requests[0], args)
+        try:
+            for i in range(args.warmup):
+                request(pm_sock, requests[i % len(requests)], timeout=args.timeout)
+            latencies, candidates, errors, duration = replay(pm_sock, requests, args)
+            workers = children(proc.pid)
+            memory = {'rss_kb': rss_kb(proc.pid), 'peak_rss_kb': rss_kb(proc.pid, 'VmHWM'),
+                      'workers_rss_kb': sum(rss_kb(p) or 0 for p in workers)}
+        finally:
+            proc.terminate()
+            proc.wait()
+    finally:
+        if args.keep:
+            print('benchmark files kept in %s' % tmp, file=sys.stderr)
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    latencies.sort()
+    report = {'commit': git_commit(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'parameters': {k: v for k, v in vars(args).items() if k not in ('report', 'compare', 'keep')},
+              'repositories': generated,
+              'startup': startup,
+              'requests': len(latencies),
+              'errors': len(errors),
+              'duration_s': duration,
+              'throughput_rps': len(latencies) / duration if duration else 0.0,
+              'memory': memory}
+    if latencies:
+        report['latency_ms'] = {'mean': statistics.mean(latencies) * 1000,
+                                'p50': percentile(latencies, 0.5) * 1000,
+                                'p90': percentile(latencies, 0.9) * 1000,
+                                'p99': percentile(latencies, 0.99) * 1000,
+                                'max': latencies[-1] * 1000}
+        report['candidates'] = {'mean': statistics.mean(candidates), 'min': min(candidates),
+                                'max': max(candidates), 'empty_replies': candidates.count(0)}
+    if errors:
+        report['first_error'] = errors[0]
+    return report
+
+
+def compare(report, baseline):
+    """Relative change of the main metrics compared to a previous report"""
+    metrics = {'throughput_rps': ('throughput_rps',), 'first_answer_s': ('startup', 'first_answer_s'),
+               'ready_s': ('startup', 'ready_s'), 'p50_ms': ('latency_ms', 'p50'),
+               'p99_ms': ('latency_ms', 'p99'), 'rss_kb': ('memory', 'rss_kb'),
+               'candidates': ('candidates', 'mean')}
+    changes = {'baseline_commit': baseline.get('commit')}
+    for name, path in metrics.items():
+        new, old = report, baseline
+        for key in path:
+            new = (new or {}).get(key)
+            old = (old or {}).get(key)
+        if new is not None and old:
+            changes[name] = {'baseline': old, 'current': new, 'change': (new - old) / old}
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of neatpmd')
+    generate.add_arguments(parser)
+    parser.add_argument('--cib', type=str, default=None, help='use an existing CIB directory instead of generating one')
+    parser.add_argument('--pib', type=str, default=None, help='use an existing PIB directory instead of generating one')
+    parser.add_argument('--request-file', dest='request_files', action='append', default=[],
+                        help='request mix (.json or .ndjson), may be given multiple times')
+    parser.add_argument('-n', type=int, default=1000, help='number of measured requests')
+    parser.add_argument('-c', type=int, default=1, help='number of concurrent clients')
+    parser.add_argument('--warmup', type=int, default=50, help='number of requests sent before measuring')
+    parser.add_argument('--timeout', type=float, default=10, help='request timeout in seconds')
+    parser.add_argument('--workers', type=int, default=None, help='number of neatpmd request workers')
+    parser.add_argument('--candidate-cache', type=int, default=None, help='size of the neatpmd candidate cache')
+    parser.add_argument('--startup-timeout', type=float, default=120, help='maximum neatpmd startup time in seconds')
+    parser.add_argument('--fast-start', action='store_true',
+                        help='start neatpmd with --fast-start (load the CIB and PIB after binding the PM socket)')
+    parser.add_argument('--neatpmd-args', type=str, nargs=argparse.REMAINDER, default=[],
+                        help='additional neatpmd arguments (must be last)')
+    parser.add_argument('--report', type=str, default=None, help='write the report to a file')
+    parser.add_argument('--compare', type=str, default=None, help='compare with a previous report')
+    parser.add_argument('--keep', action='store_true', help='keep the generated files and the neatpmd log')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.compare:
+        with open(args.compare) as f:
+            report['comparison'] = compare(report, json.load(f))
+
+    text = json.dumps(report, indent=4)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Compare the CIB storage backends.
+
+Measures the ingest rate of CIB nodes and the cold start time, i.e., the time required to load all stored nodes into
+a new CIB instance. Results are printed as JSON.
+
+    ./store_bench.py -n 2000 --batch 100
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pmdefaults as PM
+from cib import CIB, CIBNode
+from pmstore import open_store
+
+
+def gen_nodes(n, updates=0.5):
+    """Generate n remote endpoint CIB nodes; a fraction of the nodes is later updated with new measurements"""
+    nodes = [{'uid': 'eth0', 'root': True, 'expire': -1,
+              'properties': {'interface': {'value': 'eth0', 'precedence': 2}}}]
+    for i in range(n):
+        nodes.append({'uid': 'remote_%d' % (i % int(n * (1 - updates) or 1)), 'link': True, 'expire': -1,
+                      'match': [{'uid': {'value': 'eth0'}}],
+                      'properties': {'remote_ip': {'value': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                                                   'precedence': 2},
+                                     'rtt': {'value': i % 100, 'score': 1}}})
+    return nodes
+
+
+def bench_backend(backend, nodes, batch):
+    cib_dir = tempfile.mkdtemp(prefix='neat_bench_')
+    try:
+        store = open_store(backend, cib_dir, CIB.CIB_EXTENSIONS, '.cib')
+
+        start = time.perf_counter()
+        for i, n in enumerate(nodes):
+            cs = CIBNode(n)
+            store.put(cs.uid, cs.dict())
+            if (i + 1) % batch == 0:
+                store.flush()
+        store.flush()
+        ingest = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store = open_store(backend, cib_dir, CIB.CIB_EXTENSIONS, '.cib')
+        updated, _ = store.changes()
+        replay = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cib = CIB(cib_dir)
+        cold_start = time.perf_counter() - start
+
+        size = sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(cib_dir) for f in fs)
+
+        return {'backend': backend,
+                'entries': len(updated),
+                'nodes': len(cib.nodes),
+                'ingest_s': round(ingest, 4),
+                'ingest_rate': round(len(nodes) / ingest, 1),
+                'replay_s': round(replay, 4),
+                'cold_start_s': round(cold_start, 4),
+                'disk_bytes': size}
+    finally:
+        shutil.rmtree(cib_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CIB storage backend benchmark')
+    parser.add_argument('-n', type=int, default=1000, help='number of ingested CIB nodes')
+    parser.add_argument('--batch', type=int, default=PM.STORE_BATCH_SIZE, help='number of nodes per write batch')
+    parser.add_argument('--updates', type=float, default=0.5, help='fraction of ingested nodes updating existing ones')
+    args = parser.parse_args()
+
+    PM.update_log_level(0)
+    nodes = gen_nodes(args.n, args.updates)
+
+    results = []
+    for backend in ('dir', 'log'):
+        PM.STORE_BACKEND = backend
+        results.append(bench_backend(backend, nodes, args.batch))
+
+    print(json.dumps(results, indent=4))
@@ -1,6 +1,7 @@
 import bisect
 import copy
 import hashlib
+import heapq
 import itertools
 import json
 import operator
@@ -8,6 +9,10 @@ import time
 from collections import ChainMap
 
 import pmdefaults as PM
+from cibcache import CIBCache
+from iptrie import PrefixTrie
+from pmmetrics import metrics
+from pmstore import StoreError, open_store
 from pmdefaults import *
 from policy import NEATProperty, PropertyArray, PropertyMultiArray, ImmutablePropertyError, term_separator
 
@@ -33,6 +38,304 @@ def load_json(filename):
     return j
 
 
+def max_score(properties):
+    """Upper bound of the score a property contributes when it is merged with another property"""
+    return sum(p.score for p in properties.values() if p.score > 0)
+
+
+class RowIndex(object):
+    """
+    Secondary index over the materialized CIB rows.
+
+    Maps (key, value) tuples of immutable single-valued row properties to the positions of the rows containing them.
+    Immutable IP prefix values (e.g., 10.0.0.0/8) are stored in a per-key PrefixTrie. Rows which contain a key whose
+    value cannot be compared by equality (non-immutable precedence, ranges, sets or ANY) are tracked per key and are
+    returned for every value of that key.
+
+    For each row the index also stores an upper bound of the evaluated score a candidate generated from the row can
+    reach, i.e., the sum of all positive property scores.
+    """
+
+    def __init__(self, rows):
+        self.size = len(rows)
+        self.exact = {}
+        self.prefixes = {}
+        self.wildcard = {}
+        self.bounds = [max_score(row) for row in rows]
+        # number of rows containing each key
+        self.key_counts = {}
+
+        for i, row in enumerate(rows):
+            for key, p in row.items():
+                self.key_counts[key] = self.key_counts.get(key, 0) + 1
+                if p.precedence == NEATProperty.IMMUTABLE and p._value.is_prefix:
+                    self.prefixes.setdefault(key, PrefixTrie()).insert(p.value, i)
+                elif p.precedence == NEATProperty.IMMUTABLE and p._value.is_single:
+                    self.exact.setdefault((key, p.value), set()).add(i)
+                else:
+                    self.wildcard.setdefault(key, set()).add(i)
+
+    def postings(self, key, value):
+        """Return the positions of all rows which may contain a property compatible with key|value"""
+        posting = self.exact.get((key, value), set()) | self.wildcard.get(key, set())
+        if key in self.prefixes:
+            posting.update(self.prefixes[key].covering(value))
+        return posting
+
+    def candidates(self, properties):
+        """
+        Return the sorted positions of the rows which may satisfy all immutable single-valued properties. The
+        surviving rows still need to be merged with the request to resolve any remaining conflicts.
+        """
+        result = None
+        for p in properties:
+            # prefix values in the request may also match more specific row values, so they cannot be indexed
+            if p.precedence != NEATProperty.IMMUTABLE or not p._value.is_single or p._value.is_prefix:
+                continue
+            posting = self.postings(p.key, p.value)
+            result = posting if result is None else result & posting
+            if not result:
+                return []
+
+        if result is None:
+            return range(self.size)
+        return sorted(result)
+
+
+def compile_matcher(p):
+    """
+    Return a predicate which checks whether an immutable row property can be merged with the immutable request
+    property p, i.e., whether both values overlap.
+    """
+
+    def overlaps(r):
+        try:
+            return bool(p == r)
+        except TypeError:
+            # values of incomparable types, e.g., a numeric range and a set of strings
+            return False
+
+    v = p._value
+    if v.is_single and not v.is_numeric and not v.is_prefix:
+        value = v.value
+
+        def match(r):
+            rv = r._value
+            if rv.is_single and not rv.is_prefix:
+                return bool(value) and rv.value == value
+            return overlaps(r)
+        return match
+    return overlaps
+
+
+class CompiledQuery(object):
+    """
+    Lookup predicates compiled once for the immutable properties of a request.
+
+    A row is compatible with the request if it contains every immutable request key and if none of the corresponding
+    immutable row properties conflicts with the request value. Optional or base row properties never conflict. The
+    predicates are ordered so that the keys found in the fewest rows are checked first.
+
+    The query only depends on the immutable request properties, so that it can be shared by all requests which have
+    the same immutable properties (e.g., the variants of a request expanded by different profiles).
+    """
+
+    def __init__(self, properties, key_counts=None):
+        key_counts = key_counts or {}
+        # keep a copy as request properties are shared with, and may be updated through, the generated candidates
+        self.required = [copy.deepcopy(p) for p in properties.values() if p.precedence == NEATProperty.IMMUTABLE]
+        self.keys = frozenset(p.key for p in self.required)
+        # properties which can be looked up in the RowIndex
+        self.indexable = [p for p in self.required if p._value.is_single and not p._value.is_prefix]
+
+        self.required.sort(key=lambda p: key_counts.get(p.key, 0))
+        self.predicates = tuple((p.key, compile_matcher(p)) for p in self.required)
+
+    @staticmethod
+    def fingerprint(properties):
+        """Return a hashable key identifying the immutable properties of a request"""
+        fp = []
+        for p in properties.values():
+            if p.precedence != NEATProperty.IMMUTABLE:
+                continue
+            value = p.value
+            if isinstance(value, (set, frozenset)):
+                value = tuple(sorted(repr(i) for i in value))
+            fp.append((p.key, repr(value)))
+        return tuple(sorted(fp))
+
+    def matches(self, row):
+        """Return True if the row contains all immutable request properties without conflicts"""
+        for key, match in self.predicates:
+            r = row.get(key)
+            if r is None:
+                return False
+            if r.precedence == NEATProperty.IMMUTABLE and not match(r):
+                return False
+        return True
+
+    def __repr__(self):
+        return 'CompiledQuery<%s>' % ', '.join(sorted(self.keys))
+
+
+class ExtenderIndex(object):
+    """
+    Precompiled match predicates of the extender CIB nodes, i.e., CIB nodes which are not linked into the graph.
+
+    Every match clause is compiled to a tuple of (key, property) pairs and anchored on one of its properties. Clauses
+    anchored on a single value are indexed by (key, value), all other clauses only by key. Extenders with an empty
+    match clause apply to every row, extenders without any match clause (e.g., root nodes) never apply. The
+    expansions of each extender are computed once when the index is built.
+    """
+
+    def __init__(self, extenders):
+        # (uid, compiled match clauses, expanded properties) of each extender
+        self.extenders = []
+        self.exact = {}
+        self.fallback = {}
+        self.keys = {}
+        self.always = set()
+
+        for i, (uid, node) in enumerate(extenders.items()):
+            clauses = [tuple(m.items()) for m in node.match]
+            self.extenders.append((uid, clauses, list(node.expand())))
+            if not all(clauses):
+                # an empty clause matches every row
+                self.always.add(i)
+                continue
+            for clause in clauses:
+                anchor = next(((k, p) for k, p in clause if p._value.is_single and not p._value.is_prefix), None)
+                if anchor is not None:
+                    key = anchor[0]
+                    self.exact.setdefault((key, anchor[1].value), set()).add(i)
+                else:
+                    key = clause[0][0]
+                    self.fallback.setdefault(key, set()).add(i)
+                self.keys.setdefault(key, set()).add(i)
+
+    @staticmethod
+    def match_clause(clause, entry):
+        for key, p in clause:
+            if key not in entry or not entry[key] == p:
+                return False
+        return True
+
+    def matching(self, entry):
+        """Yield the uid and the expanded properties of all extenders whose match applies to the given row"""
+        ids = set(self.always)
+        for key, p in entry.items():
+            if key not in self.keys:
+                continue
+            if p._value.is_single and not p._value.is_prefix:
+                ids.update(self.exact.get((key, p.value), ()))
+                ids.update(self.fallback.get(key, ()))
+            else:
+                ids.update(self.keys[key])
+
+        for i in sorted(ids):
+            uid, clauses, expanded = self.extenders[i]
+            if any(self.match_clause(c, entry) for c in clauses):
+                yield uid, expanded
+
+    def __len__(self):
+        return len(self.extenders)
+
+
+def is_exact(p):
+    """Return True if the property value can only be matched by an equal value"""
+    return p._value.is_single and not p._value.is_prefix
+
+
+class NodeIndex(object):
+    """
+    Index of the properties (including the uid) and the match clauses of all CIB nodes. Used to find the nodes which
+    may be linked to a node without comparing all pairs of CIB nodes. Candidates returned by the index still have to
+    be verified using the match clauses.
+    """
+
+    def __init__(self, nodes=()):
+        # properties: (key, value) -> uids, key -> uids with other values, key -> all uids
+        self.exact = {}
+        self.wildcard = {}
+        self.keys = {}
+        # match clauses anchored on (key, value) or key, and uids with empty match clauses
+        self.anchors = {}
+        self.anchor_keys = {}
+        self.anchor_any = {}
+        self.empty = set()
+
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _postings(node):
+        for s in node.match_sets():
+            for p in s:
+                yield p
+
+    @staticmethod
+    def _anchor(clause):
+        return next((p for p in clause.values() if is_exact(p)), next(iter(clause.values()), None))
+
+    def add(self, node):
+        for p in self._postings(node):
+            if is_exact(p):
+                self.exact.setdefault((p.key, p.value), set()).add(node.uid)
+            else:
+                self.wildcard.setdefault(p.key, set()).add(node.uid)
+            self.keys.setdefault(p.key, set()).add(node.uid)
+
+        for clause in node.match:
+            anchor = self._anchor(clause)
+            if anchor is None:
+                self.empty.add(node.uid)
+                continue
+            if is_exact(anchor):
+                self.anchors.setdefault((anchor.key, anchor.value), set()).add(node.uid)
+            else:
+                self.anchor_keys.setdefault(anchor.key, set()).add(node.uid)
+            self.anchor_any.setdefault(anchor.key, set()).add(node.uid)
+
+    def remove(self, node):
+        for p in self._postings(node):
+            if is_exact(p):
+                self.exact.get((p.key, p.value), set()).discard(node.uid)
+            else:
+                self.wildcard.get(p.key, set()).discard(node.uid)
+            self.keys.get(p.key, set()).discard(node.uid)
+
+        for clause in node.match:
+            anchor = self._anchor(clause)
+            if anchor is None:
+                self.empty.discard(node.uid)
+                continue
+            if is_exact(anchor):
+                self.anchors.get((anchor.key, anchor.value), set()).discard(node.uid)
+            else:
+                self.anchor_keys.get(anchor.key, set()).discard(node.uid)
+            self.anchor_any.get(anchor.key, set()).discard(node.uid)
+
+    def matched_by(self, clause):
+        """Return the uids of the nodes which may contain all properties of a match clause, or None for all nodes"""
+        anchor = self._anchor(clause)
+        if anchor is None:
+            return None
+        if is_exact(anchor):
+            return self.exact.get((anchor.key, anchor.value), set()) | self.wildcard.get(anchor.key, set())
+        return self.keys.get(anchor.key, set())
+
+    def matching(self, node):
+        """Return the uids of the nodes whose match clauses may match the properties of the given node"""
+        uids = set(self.empty)
+        for p in self._postings(node):
+            if is_exact(p):
+                uids.update(self.anchors.get((p.key, p.value), ()))
+                uids.update(self.anchor_keys.get(p.key, ()))
+            else:
+                uids.update(self.anchor_any.get(p.key, ()))
+        return uids
+
+
 class CIBNode(object):
     cib = None
 
@@ -66,6 +369,9 @@ class CIBNode(object):
                 self.properties.add([PropertyArray.from_dict(ps) for ps in p])
             else:
                 self.properties.add(PropertyArray.from_dict(p))
+        # cached expansions of the properties
+        self._expanded = None
+        self._match_sets = None
 
         self.match = []
         # FIXME better error handling if match undefined
@@ -159,8 +465,17 @@ class CIBNode(object):
         return False
 
     def expand(self):
-        for p in self.properties.expand():
-            yield p
+        """Return all property arrays of the node. The expanded arrays are cached and must not be modified."""
+        if self._expanded is None:
+            self._expanded = self.properties.expand()
+        return self._expanded
+
+    def match_sets(self):
+        """Return the property sets of all expanded arrays, including the node uid, used to match other nodes"""
+        if self._match_sets is None:
+            uid = NEATProperty(('uid', self.uid))
+            self._match_sets = [set(p.values()) | {uid} for p in self.expand()]
+        return self._match_sets
 
     def update_links_from_match(self):
         """
@@ -168,31 +483,22 @@ class CIBNode(object):
          list containing the UIDs of the matched rows. The list is stored in self.linked.
         """
 
+        nodes = self.cib.nodes
         for match_properties in self.match:
-            for node in self.cib.nodes.values():
-                if node.uid == self.uid: continue  # ??
-                for p in node.expand():
-                    # Check if the properties in the match list are a full subset of some CIB properties.
-                    # Also include the CIB uid as a property while matching
-                    if match_properties <= set(p.values()) | {NEATProperty(('uid', node.uid))}:
-                        self.linked.add(node.uid)
-
-    def resolve_graph(self, path=None):
-        """new try """
-        if path is None:
-            path = []
-
-        path.append(self.uid)
-
-        remaining = set(self.cib.graph.get(self.uid, [])) - set(path)
-        if len(remaining) == 0:
-            return [path]
-
-        new_paths = []
-        for u in remaining:
-            paths = self.cib.nodes[u].resolve_graph(path.copy())
-            new_paths.extend(paths)
-        return new_paths
+            candidates = self.cib.node_index.matched_by(match_properties)
+            if candidates is None:
+                candidates = nodes.keys()
+            for uid in candidates:
+                node = nodes.get(uid)
+                if node is None or node.uid == self.uid: continue  # ??
+                # Check if the properties in the match list are a full subset of some CIB properties.
+                # Also include the CIB uid as a property while matching
+                if any(match_properties <= p for p in node.match_sets()):
+                    self.linked.add(node.uid)
+
+    def resolve_graph(self):
+        """Return all paths through the CIB graph starting at the current node, e.g., [['eth0', 'remote_1'], ...]"""
+        return [list(path) for path in self.cib.resolve_paths(self.uid)]
 
     def resolve_links(self, path=None):
         """find paths from current CIB to all linked CIBS """
@@ -240,26 +546,25 @@ class CIBNode(object):
         if not apply_extended:
             return rows
 
-        if not self.cib.extenders:
+        extender_index = self.cib.extender_index
+        if not extender_index:
             # no extender CIB nodes loaded
             return rows
 
-        # TODO optimize
         extended_rows = rows.copy()
         for entry in rows:
             # TODO take priorities into account
-            # iterate extender cib_nodes
-            for uid, xs in self.cib.extenders.items():
-                for pa in xs.expand():
-                    if xs.match_entry(entry):
-                        entry_copy = copy.deepcopy(entry)
-                        chain = ChainMap(pa, entry_copy)
-                        new_pa = PropertyArray(*(p for p in chain.values()))
-                        try:
-                            del new_pa['uid']
-                        except KeyError:
-                            pass
-                        extended_rows.append(new_pa)
+            for uid, expanded in extender_index.matching(entry):
+                for pa in expanded:
+                    # layer the extender properties on top of the row
+                    chain = ChainMap(pa, entry)
+                    new_pa = PropertyArray(*(p for p in chain.values()))
+                    try:
+                        del new_pa['uid']
+                    except KeyError:
+                        pass
+                    new_pa.meta['cib_uids'] = '%s<<%s' % (entry.meta.get('cib_uids', ''), uid)
+                    extended_rows.append(new_pa)
 
         return extended_rows
 
@@ -279,19 +584,55 @@ class CIB(object):
     cib_dir = PM.CIB_DIR
     CIB_EXTENSIONS = ('.cib', '.local', '.connection', '.remote', '.slim')
 
-    def __init__(self, cib_dir=None):
+    def __init__(self, cib_dir=None, store=None, load=True):
         # dictionary containing all loaded CIB nodes, keyed by their uid
         self.nodes = {}
-        # track CIB files
-        self.files = dict()
+        # persistent storage backend for CIB nodes
+        self.store = store
 
         CIBNode.cib = self
 
         self.graph = {}
 
+        # materialized CIB rows and their secondary index. Both are rebuilt on demand after the CIB has changed.
+        self.generation = 0
+        self._rows = None
+        self._index = None
+        self._extender_index = None
+        # compiled lookup queries keyed by the fingerprint of their immutable properties
+        self._queries = {}
+        # index of node properties and match clauses, rebuilt on demand after nodes were registered or dropped
+        self._node_index = None
+        # cached path suffixes and reachable nodes of the CIB graph
+        self._path_memo = {}
+        self._reachable = {}
+        # rows of each root node and the UIDs of all CIB nodes they were generated from
+        self._root_rows = {}
+        self._root_deps = {}
+
+        # min-heap of (expire, uid) tuples used to evict CIB nodes once they have expired
+        self._expiry = []
+        self._expiry_timer = None
+        self._expiry_deadline = None
+        self.loop = None
+
+        self.stats = {'expired': 0, 'pruned': 0}
+
+        # in-memory tier for cached happy eyeballs results
+        self.cache = CIBCache(self)
+
+        # callables invoked as observer(event, uid, cib_node) whenever a CIB node changes
+        self.observers = []
+
         if cib_dir:
             self.cib_dir = cib_dir
-            self.reload_files()
+            if self.store is None:
+                try:
+                    self.store = open_store(PM.STORE_BACKEND, cib_dir, CIB.CIB_EXTENSIONS, '.cib')
+                except StoreError as e:
+                    sys.exit('Unable to open CIB store: %s' % e)
+            if load:
+                self.reload_files()
 
     def __getitem__(self, uid):
         return self.nodes[uid]
@@ -313,62 +654,218 @@ class CIB(object):
     def extenders(self):
         return {k: v for k, v in self.nodes.items() if not v.link}
 
+    @property
+    def node_index(self):
+        if self._node_index is None:
+            self._node_index = NodeIndex(self.nodes.values())
+        return self._node_index
+
+    @property
+    def extender_index(self):
+        """Precompiled match predicates of all extender nodes, rebuilt once per CIB generation"""
+        if self._extender_index is None:
+            self._extender_index = ExtenderIndex(self.extenders)
+        return self._extender_index
+
     @property
     def rows(self):
         """
-        Returns a generator containing all expanded root CIB nodes
+        Returns a list containing all expanded root CIB nodes. Rows are materialized once per CIB generation and
+        must not be modified by the caller.
         """
+        if self._rows is None:
+            rows = []
+            for uid, r in self.roots.items():
+                if uid not in self._root_rows:
+                    # expand all cib nodes
+                    root_rows = r.expand_rows()
+                    deps = {uid}
+                    for entry in root_rows:
+                        entry.cib_node = uid
+                        deps.update(entry.meta.get('cib_uids', '').split('<<'))
+                    self._root_rows[uid] = root_rows
+                    self._root_deps[uid] = deps
+                rows.extend(self._root_rows[uid])
+            self._rows = rows
+        return self._rows
 
-        for uid, r in self.roots.items():
-            # expand all cib nodes
-            for entry in r.expand_rows():
-                entry.cib_node = uid
-                yield entry
+    @property
+    def index(self):
+        """Secondary index of the immutable properties of all CIB rows"""
+        if self._index is None:
+            self._index = RowIndex(self.rows)
+        return self._index
 
-    def reload_files(self, cib_dir=None):
+    def compile_query(self, input_properties):
+        """
+        Return the CompiledQuery for the immutable properties of a request. Queries are cached for the current CIB
+        generation, as the order of their predicates depends on the rows.
+        """
+        fp = CompiledQuery.fingerprint(input_properties)
+        query = self._queries.get(fp)
+        if query is None:
+            if len(self._queries) >= PM.CIB_QUERY_CACHE_SIZE:
+                self._queries.clear()
+            query = CompiledQuery(input_properties, self.index.key_counts)
+            self._queries[fp] = query
+        return query
+
+    def invalidate(self, uids=None):
         """
-        Reload CIB files when a change is detected on disk
+        Discard materialized rows and the row index after the CIB nodes or links changed. If a set of CIB node uids
+        is given, only the rows generated from these nodes are discarded.
         """
-        if not cib_dir:
-            cib_dir = self.cib_dir
+        self.generation += 1
+        self._rows = None
+        self._index = None
+        self._extender_index = None
+        self._queries = {}
+        self._path_memo = {}
+        self._reachable = {}
+
+        if uids is None:
+            self._root_rows.clear()
+            self._root_deps.clear()
+            return
 
-        full_names = set()
+        for root in [r for r, deps in self._root_deps.items() if deps & uids]:
+            del self._root_rows[root]
+            del self._root_deps[root]
+
+    def reachable(self, uid):
+        """Return the set of CIB node uids reachable from the given node in the CIB graph"""
+        if uid not in self._reachable:
+            seen = set()
+            stack = [uid]
+            while stack:
+                for v in self.graph.get(stack.pop(), ()):
+                    if v not in seen:
+                        seen.add(v)
+                        stack.append(v)
+            self._reachable[uid] = seen
+        return self._reachable[uid]
+
+    def resolve_paths(self, uid):
+        """
+        Enumerate all maximal simple paths through the CIB graph starting at the given node. Returns a list of uid
+        tuples.
 
+        The suffixes generated from each node are cached for the current CIB generation. As a suffix only depends on
+        the already visited nodes which are still reachable from a node, suffixes are shared between all paths (and
+        roots) which reach a node with the same reachable visited nodes. The path length and the number of paths are
+        limited by PM.CIB_MAX_PATH_DEPTH and PM.CIB_MAX_PATHS.
+        """
+        max_depth = PM.CIB_MAX_PATH_DEPTH
+        max_paths = PM.CIB_MAX_PATHS
+        truncated = False
+
+        def signature(u, visited):
+            reachable = self.reachable(u)
+            # the depth limit only matters if it may be reached by a path starting at u
+            return u, visited & reachable, min(max_depth - len(visited), len(reachable) + 1)
+
+        def frame(u, visited):
+            nonlocal truncated
+            successors = [v for v in self.graph.get(u, ()) if v not in visited]
+            if successors and len(visited) >= max_depth:
+                truncated = True
+                successors = []
+            # [uid, visited uids, unvisited successors, next successor, suffixes]
+            return [u, visited, successors, 0, []]
+
+        stack = [frame(uid, frozenset([uid]))]
+        while True:
+            u, visited, successors, i, suffixes = top = stack[-1]
+
+            if i < len(successors) and len(suffixes) < max_paths:
+                top[3] += 1
+                v = successors[i]
+                v_visited = visited | {v}
+                cached = self._path_memo.get(signature(v, v_visited))
+                if cached is None:
+                    stack.append(frame(v, v_visited))
+                else:
+                    suffixes.extend((u,) + s for s in cached)
+                continue
+
+            if i < len(successors) or len(suffixes) > max_paths:
+                truncated = True
+                del suffixes[max_paths:]
+
+            paths = suffixes or [(u,)]
+            self._path_memo[signature(u, visited)] = paths
+            stack.pop()
+            if not stack:
+                break
+            parent = stack[-1]
+            parent[4].extend((parent[0],) + s for s in paths)
+
+        if truncated:
+            logging.warning("CIB graph paths starting at %s truncated (max depth %d, max paths %d)"
+                            % (uid, max_depth, max_paths))
+        return paths
+
+    def is_cache_node(self, cib_node):
+        return any(['__cached' in p for p in cib_node.properties.expand()])
+
+    def reload_files(self, incremental=False):
+        """
+        Reload CIB nodes when a change is detected in the CIB store
+
+        If incremental is set, changed nodes are linked into the existing CIB graph one by one instead of rebuilding
+        the graph, which is faster if only a few nodes changed.
+        """
         logging.info("checking for CIB updates...")
 
-        if not os.path.exists(cib_dir):
-            sys.exit('CIB directory %s does not exist' % cib_dir)
-
-        for dirpath, dirnames, filenames in os.walk(cib_dir):
-            for filename in filenames:
-                if not filename.endswith(CIB.CIB_EXTENSIONS) or filename.startswith(('.', '#')):
-                    continue
-                full_name = os.path.join(dirpath, filename)
-                stat = os.stat(full_name)
-                full_names.add(full_name)
-                if full_name in self.files:
-                    if self.files[full_name] != stat.st_mtime_ns:
-                        logging.info("CIB node %s has changed", full_name)
-                        self.files[full_name] = stat.st_mtime_ns
-                        self.load_cib_file(full_name)
-                else:
-                    logging.info("Loading new CIB node %s.", full_name)
-                    self.files[full_name] = stat.st_mtime_ns
-                    self.load_cib_file(full_name)
+        try:
+            updated, removed = self.store.changes()
+        except StoreError:
+            sys.exit('CIB directory %s does not exist' % self.cib_dir)
+
+        for filename, cs in updated.items():
+            logging.info("Loading CIB node %s.", filename)
+            if incremental:
+                cib_node = self.parse_cib_node(cs, filename)
+                if cib_node is not None:
+                    self.add_node(cib_node)
+            else:
+                self.load_cib_node(cs, filename)
 
-        removed_files = self.files.keys() - full_names
-        for filename in removed_files:
+        for filename in removed:
             logging.info("CIB node %s has been removed", filename)
-            del self.files[filename]
             deleted_cs = [cs for cs in self.nodes.values() if cs.filename == filename]
             # remove corresponding CIBNode object
+            if incremental:
+                self.evict([cs.uid for cs in deleted_cs])
+                continue
             for cs in deleted_cs:
-                self.nodes.pop(uid, None)
+                self.drop(cs.uid)
 
-        self.update_graph()
+        if not incremental:
+            self.update_graph()
 
-    def load_cib_file(self, filename):
-        cs = load_json(filename)
+    def iter_load(self):
+        """
+        Load the CIB nodes of the store one at a time, yielding after each node. Used to fill the CIB from the event
+        loop while requests are already processed.
+        """
+        try:
+            updated, removed = self.store.changes()
+        except StoreError:
+            sys.exit('CIB directory %s does not exist' % self.cib_dir)
+
+        for filename, cs in updated.items():
+            cib_node = self.parse_cib_node(cs, filename)
+            if cib_node is not None:
+                self.add_node(cib_node)
+            yield
+
+    def load_cib_node(self, cs, filename):
+        cib_node = self.parse_cib_node(cs, filename)
+        if cib_node is not None:
+            self.register(cib_node)
+
+    def parse_cib_node(self, cs, filename):
         if not cs:
             logging.warning("CIB node file %s was invalid" % filename)
             return
@@ -382,7 +879,7 @@ class CIB(object):
             return
 
         cib_node.filename = filename
-        self.register(cib_node)
+        return cib_node
 
     def update_graph(self):
         # FIXME this tree should be rebuilt dynamically
@@ -402,12 +899,14 @@ class CIB(object):
                 if i.uid not in self.graph[r]:
                     self.graph[r].append(i.uid)
 
+        self.invalidate()
+
     def import_json(self, slim, uid=None):
         """
         Import JSON formatted CIB entries into current cib.
         """
+        start = time.perf_counter()
 
-        # TODO optimize
         try:
             json_slim = json.loads(slim)
         except json.decoder.JSONDecodeError:
@@ -416,78 +915,266 @@ class CIB(object):
 
         # check if we received multiple objects in a list
         if isinstance(json_slim, list):
-            for c in json_slim:
-                self.import_json(json.dumps(c))
-            return
+            stored = [self.import_node(c) for c in json_slim]
+        else:
+            stored = [self.import_node(json_slim, uid)]
+
+        if any(stored):
+            self.store.flush()
+            self.reload_files()
+        metrics.observe('neat_import_seconds', time.perf_counter() - start, repository='cib')
+
+    def import_node(self, node_dict, uid=None, apply=False):
+        """
+        Import a single CIB node dictionary. Returns True if the node was written to the CIB store, in which case the
+        CIB is updated on the next call of reload_files. If apply is set, the node is also linked into the CIB graph
+        right away.
+        """
 
         # convert to CIB node object to do sanity check
         try:
-            cs = CIBNode(json_slim)
+            cs = CIBNode(node_dict)
         except CIBEntryError as e:
             print(e)
             return
 
-        # no not import cache nodes if disabled
-        if not PM.CIB_CACHE and any(['__cached' in p for p in cs.properties.expand()]):
-            logging.debug('Ignoring cache CIB node')
-            return
-
         if uid is not None:
             cs.uid = uid
 
-        filename = cs.uid
-        slim = cs.json()
+        if self.is_cache_node(cs):
+            # no not import cache nodes if disabled
+            if not PM.CIB_CACHE:
+                logging.debug('Ignoring cache CIB node')
+            else:
+                self.cache.add(cs)
+            return
+
+        if self.store is None:
+            # CIB is not backed by a store
+            self.add_node(cs)
+            return
 
+        filename = cs.uid
         if not filename:
             logging.warning("CIB entry has no UID")
             # generate CIB filename
-            filename = hashlib.md5(slim.encode('utf-8')).hexdigest()
-
-        filename = '%s.cib' % filename.lower()
+            filename = hashlib.md5(cs.json().encode('utf-8')).hexdigest()
 
-        with open(os.path.join(self.cib_dir, '%s' % filename), 'w') as f:
-            f.write(slim)
-            logging.debug("CIB entry saved as \"%s\"." % filename)
+        filename = self.store.put(filename, cs.dict())
+        logging.debug("CIB entry saved as \"%s\"." % filename)
+        if apply:
+            cs.filename = filename
+            self.add_node(cs)
+        return True
 
-        self.reload_files()
+    def notify(self, event, uid, cib_node=None):
+        """Inform all observers about a changed CIB node. Events are added, changed, removed and expired."""
+        for observer in self.observers:
+            observer(event, uid, cib_node)
 
     def register(self, cib_node):
-        if cib_node in self.nodes:
+        event = 'added'
+        if cib_node.uid in self.nodes:
             logging.debug("overwriting existing CIB with uid %s" % cib_node.uid)
+            event = 'changed'
         self.nodes[cib_node.uid] = cib_node
+        self._node_index = None
+        self.invalidate()
 
-    def unregister(self, cib_uid):
+        if cib_node.expire != -1:
+            heapq.heappush(self._expiry, (cib_node.expire, cib_node.uid))
+            self._schedule_expiry()
+        self.notify(event, cib_node.uid, cib_node)
+
+    def drop(self, cib_uid):
+        """Remove a CIB node without updating the CIB graph"""
         del self.nodes[cib_uid]
+        self._node_index = None
+        self.notify('removed', cib_uid)
+
+    def unregister(self, cib_uid):
+        self.drop(cib_uid)
         self.update_graph()
 
     def remove(self, cib_uid):
         self.unregister(cib_uid)
 
+    def add_node(self, cib_node):
+        """
+        Register a single CIB node and link it into the CIB graph without rebuilding the graph. Only the rows of the
+        root nodes from which the new node is reachable are invalidated.
+        """
+        uid = cib_node.uid
+        event = 'added'
+        if uid in self.nodes:
+            self._evict([uid])
+            event = 'changed'
+
+        self.nodes[uid] = cib_node
+        self.node_index.add(cib_node)
+        cib_node.linked = set()
+        cib_node.update_links_from_match()
+        if cib_node.link:
+            for r in cib_node.linked:
+                self.graph.setdefault(r, []).append(uid)
+
+        # existing CIB nodes linking to the new node
+        expanded = cib_node.match_sets()
+        candidates = self.node_index.matching(cib_node)
+        for node in self.nodes.values():
+            if node.uid == uid or node.uid not in candidates:
+                continue
+            if any(m <= p for m in node.match for p in expanded):
+                node.linked.add(uid)
+                if node.link:
+                    self.graph.setdefault(uid, []).append(node.uid)
+
+        if cib_node.expire != -1:
+            heapq.heappush(self._expiry, (cib_node.expire, uid))
+            self._schedule_expiry()
+
+        if not cib_node.link and cib_node.match:
+            # extender nodes may apply to any CIB row
+            self.invalidate()
+        else:
+            self.invalidate(cib_node.linked | {uid})
+        self.notify(event, uid, cib_node)
+
+    def evict(self, uids, expired=False):
+        """
+        Remove a set of CIB nodes without rebuilding the CIB graph. Only the links pointing to the removed nodes and
+        the rows generated from them are invalidated.
+        """
+        for uid in self._evict(uids, expired):
+            self.notify('expired' if expired else 'removed', uid)
+
+    def _evict(self, uids, expired=False):
+        uids = set(uids)
+        removed = []
+        for uid in uids:
+            node = self.nodes.pop(uid, None)
+            if node is None:
+                continue
+            removed.append(uid)
+            if self._node_index is not None:
+                self._node_index.remove(node)
+            # nodes linking to the removed node
+            for linked_uid in self.graph.pop(uid, []):
+                if linked_uid in self.nodes:
+                    self.nodes[linked_uid].linked.discard(uid)
+            # links of the removed node
+            for r in node.linked:
+                if uid in self.graph.get(r, []):
+                    self.graph[r].remove(uid)
+
+        self.cache.discard(uids, expired)
+        self.invalidate(uids)
+        return removed
+
+    def expire_nodes(self, now=None):
+        """Evict all CIB nodes whose expiration time has passed. Returns the list of expired uids."""
+        if now is None:
+            now = time.time()
+
+        expired = []
+        while self._expiry and self._expiry[0][0] <= now:
+            deadline, uid = heapq.heappop(self._expiry)
+            node = self.nodes.get(uid)
+            # skip stale heap entries of removed or updated nodes
+            if node is None or node.expire != deadline:
+                continue
+            expired.append(uid)
+
+        if expired:
+            logging.info("%d CIB node(s) expired: %s" % (len(expired), ', '.join(expired)))
+            self.evict(expired, expired=True)
+            self.stats['expired'] += len(expired)
+        return expired
+
+    def start_expiry_timer(self, loop):
+        """Evict CIB nodes from the asyncio loop as soon as they expire"""
+        self.loop = loop
+        self._schedule_expiry()
+
+    def _schedule_expiry(self):
+        # rebuild the heap if it mostly contains stale entries
+        if len(self._expiry) > 2 * len(self.nodes) + 64:
+            self._expiry = [(n.expire, n.uid) for n in self.nodes.values() if n.expire != -1]
+            heapq.heapify(self._expiry)
+
+        if self.loop is None or not self._expiry:
+            return
+
+        deadline = self._expiry[0][0]
+        if self._expiry_timer is not None:
+            if self._expiry_deadline <= deadline:
+                return
+            self._expiry_timer.cancel()
+
+        self._expiry_deadline = deadline
+        self._expiry_timer = self.loop.call_later(max(deadline - time.time(), 0), self._expiry_timeout)
+
+    def _expiry_timeout(self):
+        self._expiry_timer = None
+        self.expire_nodes()
+        self._schedule_expiry()
+
     def lookup(self, input_properties, candidate_num=5):
         """CIB lookup logic implementation
 
         Return CIB rows that include *all* required properties from the request PropertyArray
         """
+        candidates = [c for _, _, c in self.top_candidates(input_properties, candidate_num)]
+
+        if self.cache:
+            for c in candidates:
+                self.cache.touch(c.meta.get('cib_uids', '').split('<<'))
+        return candidates
+
+    def top_candidates(self, input_properties, candidate_num=5):
+        """
+        Return the best candidate_num (score, -position, candidate) tuples in descending order, where position is
+        the position of the row in the CIB plus one, or zero for the request itself.
+        """
         assert isinstance(input_properties, PropertyArray)
-        candidates = [input_properties]
-        for e in self.rows:
-            try:
-                # FIXME better check whether all input properties are included in row - improve matching
-                # ignore optional properties in input request
-                required_pa = PropertyArray(
-                    *(p for p in input_properties.values() if p.precedence == NEATProperty.IMMUTABLE))
-                if len(required_pa & e) != len(required_pa):
-                    continue
-            except ImmutablePropertyError:
+
+        # ignore optional properties in input request
+        query = self.compile_query(input_properties)
+
+        rows = self.rows
+        index = self.index
+        input_bound = max_score(input_properties)
+
+        # bounded min-heap of the best candidates. Ties are broken by the lookup order (the request first, then the
+        # rows in CIB order), which yields the same ranking as a stable sort of all candidates.
+        heap = [(input_properties.score, 0, input_properties)]
+
+        # visit rows in order of their best achievable score so that the lookup can stop as soon as no remaining row
+        # can enter the top-k
+        positions = sorted(index.candidates(query.indexable), key=index.bounds.__getitem__, reverse=True)
+        for n, i in enumerate(positions):
+            if len(heap) >= candidate_num and heap[0][0][0] > index.bounds[i] + input_bound:
+                self.stats['pruned'] += len(positions) - n
+                break
+
+            e = rows[i]
+            # only merge rows whose immutable properties are not in conflict with the request
+            if not query.matches(e):
                 continue
             try:
                 candidate = e + input_properties
                 candidate.cib_node = e.cib_node
-                candidates.append(candidate)
+                candidate.meta['cib_uids'] = e.meta.get('cib_uids', '')
             except ImmutablePropertyError:
-                pass
+                continue
+
+            item = (candidate.score, -(i + 1), candidate)
+            if len(heap) < candidate_num:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
 
-        return sorted(candidates, key=operator.attrgetter('score'), reverse=True)[:candidate_num]
+        return sorted(heap, key=operator.itemgetter(0, 1), reverse=True)[:candidate_num]
 
     def dump(self, show_all=False):
         print(term_separator("CIB START"))
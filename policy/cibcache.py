@@ -0,0 +1,155 @@
+import logging
+import time
+from collections import OrderedDict
+
+import pmdefaults as PM
+
+
+class CacheEntry(object):
+    __slots__ = ('uid', 'size', 'destination', 'variant')
+
+    def __init__(self, uid, size, destination, variant):
+        self.uid = uid
+        self.size = size
+        self.destination = destination
+        self.variant = variant
+
+
+def destination_key(cib_node):
+    """
+    Return the destination (remote_ip, port) and the variant (interface, transport) of a cached happy eyeballs CIB
+    node, e.g., (('8.8.8.8', 80), ('eth0', 'TCP')).
+    """
+    destination = transport = None
+
+    for pa in cib_node.expand():
+        if 'remote_ip' in pa and 'port' in pa:
+            destination = (pa['remote_ip'].value, pa['port'].value)
+            transport = pa['transport'].value if 'transport' in pa else None
+        break
+
+    if destination is None:
+        return None, None
+
+    interface = None
+    for m in cib_node.match:
+        if 'interface' in m:
+            interface = m['interface'].value
+            break
+
+    variant = (interface, transport)
+    return destination, variant
+
+
+class CIBCache(object):
+    """
+    Bounded in-memory tier for CIB nodes containing happy eyeballs results (__cached property) pushed by the NEAT
+    logic.
+
+    Cached nodes are registered in the CIB but not written to the CIB directory. Entries are evicted in LRU order
+    once the number of entries or their estimated size exceeds the configured limits, and are removed from the CIB
+    after their TTL has passed. Results for the same destination, interface and transport replace each other, and
+    the number of variants kept for each destination is bounded.
+    """
+
+    def __init__(self, cib, max_entries=None, max_bytes=None, ttl=None, max_per_destination=None):
+        self.cib = cib
+        self.max_entries = max_entries or PM.CIB_CACHE_MAX_ENTRIES
+        self.max_bytes = max_bytes or PM.CIB_CACHE_MAX_BYTES
+        self.ttl = ttl or PM.CIB_CACHE_TTL
+        self.max_per_destination = max_per_destination or PM.CIB_CACHE_MAX_PER_DESTINATION
+
+        # entries in LRU order (least recently used first)
+        self.entries = OrderedDict()
+        # destination -> {variant: uid}
+        self.destinations = {}
+        self.size = 0
+
+        self.counters = {'inserted': 0, 'replaced': 0, 'hits': 0, 'evicted_lru': 0, 'evicted_ttl': 0,
+                         'evicted_destination': 0}
+
+    def __contains__(self, uid):
+        return uid in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, cib_node):
+        """Insert a cached CIB node into the CIB and evict other entries if needed"""
+        now = time.time()
+        cib_node.expire = min(cib_node.expire, now + self.ttl) if cib_node.expire != -1 else now + self.ttl
+
+        destination, variant = destination_key(cib_node)
+        evict = set()
+
+        if cib_node.uid in self.entries:
+            self._forget(cib_node.uid)
+
+        if destination is not None:
+            variants = self.destinations.setdefault(destination, OrderedDict())
+            if variant in variants:
+                # aggregate repeated results for the same destination
+                evict.add(variants.pop(variant))
+                self.counters['replaced'] += 1
+            while len(variants) >= self.max_per_destination:
+                _, uid = variants.popitem(last=False)
+                evict.add(uid)
+                self.counters['evicted_destination'] += 1
+
+        for uid in evict:
+            self._forget(uid)
+
+        entry = CacheEntry(cib_node.uid, len(cib_node.json(indent=None)), destination, variant)
+        self.entries[entry.uid] = entry
+        self.size += entry.size
+        if destination is not None:
+            self.destinations[destination][variant] = entry.uid
+        self.counters['inserted'] += 1
+
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            uid = next(iter(self.entries))
+            if uid == entry.uid:
+                break
+            self._forget(uid)
+            evict.add(uid)
+            self.counters['evicted_lru'] += 1
+
+        evict.discard(entry.uid)
+        if evict:
+            self.cib.evict(evict)
+        self.cib.add_node(cib_node)
+        logging.debug("cached CIB node %s (%d cache entries)" % (cib_node.uid, len(self.entries)))
+
+    def touch(self, uids):
+        """Mark cache entries as recently used"""
+        for uid in uids:
+            if uid in self.entries:
+                self.entries.move_to_end(uid)
+                self.counters['hits'] += 1
+
+    def discard(self, uids, expired=False):
+        """Remove entries which were evicted from the CIB, e.g., because they have expired"""
+        for uid in uids:
+            if uid not in self.entries:
+                continue
+            if expired:
+                self.counters['evicted_ttl'] += 1
+            self._forget(uid)
+
+    def _forget(self, uid):
+        entry = self.entries.pop(uid, None)
+        if entry is None:
+            return
+        self.size -= entry.size
+        variants = self.destinations.get(entry.destination)
+        if variants is not None and variants.get(entry.variant) == uid:
+            del variants[entry.variant]
+            if not variants:
+                del self.destinations[entry.destination]
+
+    def stats(self):
+        return dict(self.counters, entries=len(self.entries), bytes=self.size, destinations=len(self.destinations),
+                    max_entries=self.max_entries, max_bytes=self.max_bytes)
+
+    def __repr__(self):
+        return 'CIBCache<%d>' % len(self.entries)
@@ -0,0 +1,221 @@
+import logging
+import multiprocessing
+import operator
+import os
+import signal
+import zlib
+
+import pmdefaults as PM
+from cib import CIB
+
+
+def shard_of(cib_node, shards):
+    """Return the shard owning a root CIB node, based on its interface property or, if missing, its uid"""
+    key = cib_node.uid
+    for pa in cib_node.expand():
+        if 'interface' in pa and pa['interface']._value.is_single:
+            key = str(pa['interface'].value)
+        break
+    return zlib.crc32(str(key).encode('utf-8')) % shards
+
+
+def _worker(conn):
+    """
+    Main loop of a CIB shard process. The shard holds a replica of its root nodes and of all other CIB nodes. CIB
+    updates are applied in the order they are received, only lookups are answered.
+    """
+    # signals from the terminal are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGQUIT, signal.SIG_IGN)
+
+    cib = CIB()
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        op, args = msg[0], msg[1:]
+        try:
+            if op == 'lookup':
+                conn.send((cib.top_candidates(*args), cib.stats['pruned']))
+            elif op == 'register':
+                cib.register(*args)
+            elif op == 'add_node':
+                cib.add_node(*args)
+            elif op == 'drop':
+                if args[0] in cib.nodes:
+                    cib.drop(args[0])
+            elif op == 'update_graph':
+                cib.update_graph()
+            elif op == 'evict':
+                cib.evict(*args)
+            elif op == 'close':
+                break
+        except Exception as e:
+            logging.exception("CIB shard failed to process %s: %s" % (op, e))
+            if op == 'lookup':
+                conn.send(None)
+    conn.close()
+
+
+class ShardedCIB(CIB):
+    """
+    CIB partitioned across multiple worker processes.
+
+    The main process keeps the complete CIB (store, cache, expiry, REST interface) and forwards every update to the
+    shards. Root nodes are assigned to a single shard by their interface, all other nodes are replicated to every
+    shard as they may be linked to any root. Lookups are sent to all shards in parallel and the top-k candidates of
+    each shard are merged, which yields the same candidates as a lookup in a single CIB.
+    """
+
+    def __init__(self, cib_dir=None, store=None, shards=None, load=True):
+        self.shards = shards or PM.CIB_SHARDS
+        # shard index of each root node
+        self.owners = {}
+        self.shard_pruned = [0] * self.shards
+        self._root_rank = (None, {})
+        # shards are only used by the process which started them, forked processes use the complete local CIB
+        self.pid = os.getpid()
+
+        ctx = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        self.conns = []
+        self.workers = []
+        # shards which failed, no further messages are sent to them
+        self.dead = set()
+        for i in range(self.shards):
+            parent_conn, child_conn = ctx.Pipe()
+            worker = ctx.Process(target=_worker, args=(child_conn,), name='cib-shard-%d' % i, daemon=True)
+            worker.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+        logging.info("started %d CIB shards" % self.shards)
+
+        super().__init__(cib_dir, store, load)
+
+    @property
+    def attached(self):
+        return os.getpid() == self.pid
+
+    def _send(self, shards, *msg):
+        if not self.attached:
+            return
+        for i in shards:
+            if i in self.dead:
+                continue
+            try:
+                self.conns[i].send(msg)
+            except (BrokenPipeError, OSError) as e:
+                self._kill(i, e)
+
+    def _kill(self, i, reason):
+        """Stop using a shard which failed, lookups are served by the local CIB from now on"""
+        logging.error("CIB shard %d unavailable: %s" % (i, reason))
+        self.dead.add(i)
+        self.conns[i].close()
+
+    def _route(self, cib_node):
+        """Return the shards which hold a copy of the given CIB node"""
+        if not cib_node.root:
+            return range(self.shards)
+
+        shard = shard_of(cib_node, self.shards)
+        previous = self.owners.get(cib_node.uid)
+        if previous is not None and previous != shard:
+            # root node moved to a different shard
+            self._send([previous], 'drop', cib_node.uid)
+        self.owners[cib_node.uid] = shard
+        return [shard]
+
+    def register(self, cib_node):
+        super().register(cib_node)
+        self._send(self._route(cib_node), 'register', cib_node)
+
+    def add_node(self, cib_node):
+        super().add_node(cib_node)
+        self._send(self._route(cib_node), 'add_node', cib_node)
+
+    def drop(self, cib_uid):
+        super().drop(cib_uid)
+        shard = self.owners.pop(cib_uid, None)
+        self._send(range(self.shards) if shard is None else [shard], 'drop', cib_uid)
+
+    def update_graph(self):
+        super().update_graph()
+        self._send(range(self.shards), 'update_graph')
+
+    def evict(self, uids, expired=False):
+        uids = set(uids)
+        super().evict(uids, expired)
+        for uid in uids:
+            self.owners.pop(uid, None)
+        self._send(range(self.shards), 'evict', uids, expired)
+
+    @property
+    def root_rank(self):
+        """Position of each root node in the CIB, used to order candidates from different shards"""
+        if self._root_rank[0] != self.generation:
+            self._root_rank = (self.generation, {uid: i for i, uid in enumerate(self.roots)})
+        return self._root_rank[1]
+
+    def lookup(self, input_properties, candidate_num=5):
+        """Scatter the lookup to all shards and merge their best candidates"""
+        if not self.attached or self.dead:
+            return super().lookup(input_properties, candidate_num)
+
+        sent = []
+        for i, conn in enumerate(self.conns):
+            try:
+                conn.send(('lookup', input_properties, candidate_num))
+            except (BrokenPipeError, OSError) as e:
+                self._kill(i, e)
+                break
+            sent.append(i)
+        # collect the reply of every shard which received the lookup, so that no stale reply is left in the pipe
+        replies = []
+        for i in sent:
+            try:
+                replies.append(self.conns[i].recv())
+            except (EOFError, OSError) as e:
+                self._kill(i, e)
+
+        if self.dead or None in replies:
+            # shards reply None if their lookup failed
+            logging.warning("falling back to local CIB lookup")
+            return super().lookup(input_properties, candidate_num)
+
+        rank = self.root_rank
+        merged = []
+        for i, (items, pruned) in enumerate(replies):
+            self.shard_pruned[i] = pruned
+            for score, position, candidate in items:
+                if position == 0:
+                    # the request itself is returned by every shard
+                    if i > 0:
+                        continue
+                    merged.append((score, 1, position, candidate))
+                else:
+                    merged.append((score, -rank.get(candidate.cib_node, len(rank)), position, candidate))
+
+        merged.sort(key=operator.itemgetter(0, 1, 2), reverse=True)
+        candidates = [c for _, _, _, c in merged[:candidate_num]]
+        self.stats['pruned'] = sum(self.shard_pruned)
+
+        if self.cache:
+            for c in candidates:
+                self.cache.touch(c.meta.get('cib_uids', '').split('<<'))
+        return candidates
+
+    def close(self):
+        if not self.attached:
+            return
+        self._send(range(self.shards), 'close')
+        for worker in self.workers:
+            worker.join(timeout=1)
+        for i, conn in enumerate(self.conns):
+            if i not in self.dead:
+                conn.close()
+
+    def __repr__(self):
+        return 'ShardedCIB<%d, %d shards>' % (len(self.nodes), self.shards)
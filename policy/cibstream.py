@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import json
+import logging
+import time
+
+import pmdefaults as PM
+from pmmetrics import metrics
+
+
+class CIBStreamProtocol(asyncio.Protocol):
+    """
+    Bulk CIB ingestion using newline delimited JSON. Each line contains a CIB node (or a list of CIB nodes). Lines are
+    parsed as soon as they are received and the nodes are linked into the CIB graph in batches of PM.CIB_STREAM_BATCH
+    nodes, one batch per event loop iteration. Reading is paused while nodes are pending, and the CIB store is flushed
+    after each batch. Progress is acknowledged with one JSON line once the pending nodes are applied, e.g.,
+    {"ack": 120, "stored": 118, "errors": 2}, where ack is the number of lines processed so far. Invalid lines are
+    reported as {"error": "...", "line": 7}.
+
+    Lines longer than PM.CIB_STREAM_MAX_LINE bytes are rejected, so that the memory used by each connection is bounded.
+
+    test using
+       socat -u FILE:nodes.ndjson UNIX-CONNECT:$HOME/.neat/neat_cib_stream_socket
+    """
+
+    def __init__(self, cib):
+        self.cib = cib
+        self.transport = None
+        self.buffer = bytearray()
+        # discard data until the end of an oversized line
+        self.discard = False
+        # parsed CIB nodes which are not applied yet
+        self.pending = collections.deque()
+        self.paused = False
+        self.eof = False
+        # number of lines acknowledged
+        self.acked = 0
+
+        self.lines = 0
+        self.stored = 0
+        self.errors = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        start_time = time.perf_counter()
+        self.buffer += data
+
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if end < 0:
+                break
+            line = bytes(self.buffer[start:end])
+            start = end + 1
+            if self.discard:
+                self.discard = False
+                continue
+            self.import_line(line)
+        del self.buffer[:start]
+
+        if len(self.buffer) > PM.CIB_STREAM_MAX_LINE:
+            self.buffer.clear()
+            self.discard = True
+            self.lines += 1
+            self.error('line exceeds %d bytes' % PM.CIB_STREAM_MAX_LINE)
+
+        self.apply()
+        metrics.observe('neat_import_seconds', time.perf_counter() - start_time, repository='cib_stream')
+
+    def eof_received(self):
+        if self.buffer and not self.discard:
+            self.import_line(bytes(self.buffer))
+        self.buffer.clear()
+        self.eof = True
+        self.apply()
+        # the connection is closed once the pending nodes are applied
+        return True
+
+    def import_line(self, line):
+        """Parse the CIB nodes contained in a single line, which are added to the pending nodes"""
+        if not line.strip():
+            return
+        self.lines += 1
+
+        if len(line) > PM.CIB_STREAM_MAX_LINE:
+            self.error('line exceeds %d bytes' % PM.CIB_STREAM_MAX_LINE)
+            return
+
+        try:
+            entry = json.loads(line.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError) as e:
+            self.error('invalid JSON: %s' % e)
+            return
+
+        nodes = entry if isinstance(entry, list) else [entry]
+        for node in nodes:
+            if not isinstance(node, dict):
+                self.error('invalid CIB node')
+                continue
+            self.pending.append(node)
+
+    def apply(self):
+        """
+        Link a batch of pending nodes into the CIB graph and persist them. Further batches are applied in the next
+        event loop iterations, while reading from the connection is paused.
+        """
+        stored = 0
+        for _ in range(min(PM.CIB_STREAM_BATCH, len(self.pending))):
+            # nodes are written to the CIB store and linked into the CIB graph, cached nodes are added to the cache
+            if self.cib.import_node(self.pending.popleft(), apply=True):
+                stored += 1
+        if stored:
+            self.stored += stored
+            self.cib.store.flush()
+
+        if self.pending:
+            if not self.paused and not self.eof and self.transport is not None:
+                self.transport.pause_reading()
+                self.paused = True
+            asyncio.get_event_loop().call_soon(self.apply)
+            return
+
+        if self.lines > self.acked or self.eof:
+            self.acked = self.lines
+            self.send({'ack': self.lines, 'stored': self.stored, 'errors': self.errors})
+        if self.eof:
+            logging.info("CIB stream closed (%d lines, %d nodes stored, %d errors)" % (self.lines, self.stored,
+                                                                                      self.errors))
+            if self.transport is not None:
+                self.transport.close()
+        elif self.paused:
+            self.paused = False
+            self.transport.resume_reading()
+
+    def error(self, msg):
+        self.errors += 1
+        logging.warning("CIB stream line %d: %s" % (self.lines, msg))
+        self.send({'error': msg, 'line': self.lines})
+
+    def send(self, msg):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write((json.dumps(msg) + '\n').encode('utf-8'))
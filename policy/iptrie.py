@@ -0,0 +1,103 @@
+import functools
+import ipaddress
+
+
+@functools.lru_cache(maxsize=4096)
+def to_network(value):
+    """
+    Convert an IP address or CIDR string to an ipaddress network object, e.g., '10.1.2.3' --> 10.1.2.3/32
+
+    Returns None if the value is not a valid IP address or prefix.
+    """
+    if not isinstance(value, str):
+        return None
+    try:
+        return ipaddress.ip_network(value.strip(), strict=False)
+    except ValueError:
+        return None
+
+
+def is_prefix(value):
+    """Return True if value is a CIDR string such as '10.0.0.0/8'"""
+    return isinstance(value, str) and '/' in value and to_network(value) is not None
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'items')
+
+    def __init__(self):
+        self.children = [None, None]
+        self.items = None
+
+
+class PrefixTrie(object):
+    """
+    Binary radix trie mapping IP prefixes to sets of items, e.g., the UIDs of the entries containing the prefix.
+
+    Lookups walk at most one node per prefix bit, so all prefixes covering an address are found in O(prefix length).
+    """
+
+    def __init__(self):
+        self.roots = {4: _TrieNode(), 6: _TrieNode()}
+        self.size = 0
+
+    @staticmethod
+    def _bits(network):
+        addr = int(network.network_address)
+        width = network.max_prefixlen
+        for i in range(network.prefixlen):
+            yield (addr >> (width - 1 - i)) & 1
+
+    def insert(self, prefix, item):
+        network = to_network(prefix)
+        if network is None:
+            raise ValueError('invalid IP prefix %s' % prefix)
+
+        node = self.roots[network.version]
+        for bit in self._bits(network):
+            if node.children[bit] is None:
+                node.children[bit] = _TrieNode()
+            node = node.children[bit]
+
+        if node.items is None:
+            node.items = set()
+        if item not in node.items:
+            node.items.add(item)
+            self.size += 1
+
+    def remove(self, prefix, item):
+        network = to_network(prefix)
+        if network is None:
+            return
+
+        node = self.roots[network.version]
+        for bit in self._bits(network):
+            node = node.children[bit]
+            if node is None:
+                return
+
+        if node.items and item in node.items:
+            node.items.discard(item)
+            self.size -= 1
+
+    def covering(self, value):
+        """Yield all items whose prefix contains the given IP address or prefix"""
+        network = to_network(value)
+        if network is None:
+            return
+
+        node = self.roots[network.version]
+        if node.items:
+            yield from node.items
+        for bit in self._bits(network):
+            node = node.children[bit]
+            if node is None:
+                return
+            if node.items:
+                yield from node.items
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return 'PrefixTrie<%d>' % self.size
@@ -8,6 +8,9 @@ import sys
 import time
 
 import pmdefaults as PM
+from iptrie import PrefixTrie
+from pmmetrics import metrics
+from pmstore import StoreError, open_store
 from policy import PropertyArray, PropertyMultiArray, dict_to_properties, ImmutablePropertyError, term_separator
 
 PIB_EXTENSIONS = ('.policy', '.profile', '.pib')
@@ -146,17 +149,32 @@ class NEATPolicy(object):
 
 
 class PIB(list):
-    def __init__(self, policy_dir, file_extension=('.policy', '.profile'), policy_type='policy'):
+    def __init__(self, policy_dir, file_extension=('.policy', '.profile'), policy_type='policy', store=None,
+                 load=True):
         super().__init__()
         self.policies = self
         self.index = {}
+        # policies with IP prefix match properties, indexed by property key
+        self.prefix_index = {}
+        self.prefix_keys = {}
+        # callables invoked as observer(event, uid, policy) whenever a policy is registered or unregistered
+        self.observers = []
 
         self.file_extension = file_extension
-        # track PIB files
 
         self.policy_type = policy_type
         self.policy_dir = policy_dir
-        self.load_policies(self.policy_dir)
+
+        # persistent storage backend for PIB entries
+        self.store = store
+        if self.store is None:
+            suffix = file_extension if isinstance(file_extension, str) else file_extension[0]
+            try:
+                self.store = open_store(PM.STORE_BACKEND, policy_dir, file_extension, suffix)
+            except StoreError as e:
+                sys.exit('Unable to open PIB store: %s' % e)
+        if load:
+            self.load_policies(self.policy_dir)
 
     @property
     def files(self):
@@ -171,14 +189,13 @@ class PIB(list):
         if not os.path.exists(policy_dir):
             sys.exit('PIB directory %s does not exist' % policy_dir)
 
-        for filename in os.listdir(policy_dir):
-            if filename.endswith(self.file_extension) and not filename.startswith(('.', '#')):
-                self.load_policy(os.path.join(policy_dir, filename))
+        self.reload_files()
 
     def import_json(self, slim, uid=None):
         """
         Import a JSON formatted PIB entry into current pib.
         """
+        start = time.perf_counter()
 
         try:
             pib_entry = json.loads(slim)
@@ -188,78 +205,62 @@ class PIB(list):
 
         # check if we received multiple objects in a list
         if isinstance(pib_entry, list):
-            for p in pib_entry:
-                self.import_json(json.dumps(p))
-            return
-
-        policy = NEATPolicy(pib_entry)
-        if uid is not None:
-            policy.uid = uid
-
-        filename = policy.uid
-
-        # if not filename:
-        #    # generate hash policy filename
-        #   filename = hashlib.md5('json_slim'.encode('utf-8')).hexdigest()
-
-        filename = '%s.policy' % filename.lower()
-        policy.filename = filename
-
-        filename = os.path.join(self.policy_dir, filename)
+            policies = [NEATPolicy(p) for p in pib_entry]
+        else:
+            policies = [NEATPolicy(pib_entry, uid=uid)]
 
-        with open(filename, 'w') as f:
-            f.write(policy.json())
-            logging.debug("Policy saved as \"%s\"." % filename)
+        for policy in policies:
+            policy.filename = self.store.put(policy.uid, policy.dict())
+            logging.debug("Policy saved as \"%s\"." % policy.filename)
 
-        # FIXME register
+        self.store.flush()
         self.reload_files()
+        metrics.observe('neat_import_seconds', time.perf_counter() - start, repository='pib')
 
-    def load_policy(self, filename):
+    def load_policy(self, policy_dict, filename):
         """Load policy.
         """
-        if not filename.endswith(self.file_extension) and filename.startswith(('.', '#')):
+        logging.info("Loading policy %s...", filename)
+        if policy_dict is None:
+            logging.error("Unable not load policy %s" % filename)
             return
-        stat = os.stat(filename)
 
-        t = stat.st_mtime_ns
-        if filename not in self.files or self.files[filename].timestamp != t:
-            logging.info("Loading policy %s...", filename)
-            try:
-                p = load_policy_json(filename)
-            except NEATPIBError as e:
-                logging.error("Unable not load policy %s" % filename)
-                return
-
-            # update filename and timestamp
-            p.filename = filename
-            p.timestamp = t
-            if p:
-                self.register(p)
-        else:
-            pass
-            # logging.debug("Policy %s is up-to-date", filename)
+        p = NEATPolicy(policy_dict)
+        # update filename
+        p.filename = filename
+        self.register(p)
 
     def reload_files(self):
         """
         Reload PIB files
         """
-        current_files = set()
+        try:
+            updated, removed = self.store.changes()
+        except StoreError:
+            sys.exit('PIB directory %s does not exist' % self.policy_dir)
 
-        for dir_path, dir_names, filenames in os.walk(self.policy_dir):
-            for f in filenames:
-                if not f.endswith(self.file_extension) or f.startswith(('.', '#')):
-                    continue
-                full_name = os.path.join(dir_path, f)
-                current_files.add(full_name)
-                self.load_policy(full_name)
+        for filename, policy_dict in updated.items():
+            self.load_policy(policy_dict, filename)
 
         # check if any files were deleted
-        deleted_files = self.files.keys() - current_files
-
-        for f in deleted_files:
+        for f in removed:
             logging.info("Policy file %s has been deleted", f)
             # unregister policy
-            self.unregister(self.files[f].uid)
+            if f in self.files:
+                self.unregister(self.files[f].uid)
+
+    def iter_load(self):
+        """Load the policies of the store one at a time, yielding after each policy"""
+        if not os.path.exists(self.policy_dir):
+            sys.exit('PIB directory %s does not exist' % self.policy_dir)
+        try:
+            updated, removed = self.store.changes()
+        except StoreError:
+            sys.exit('PIB directory %s does not exist' % self.policy_dir)
+
+        for filename, policy_dict in updated.items():
+            self.load_policy(policy_dict, filename)
+            yield
 
     def register(self, policy):
         """Register new policy
@@ -273,31 +274,70 @@ class PIB(list):
 
         # check if a policy with the same UID is already installed and remove old version if so
         if policy.uid in self.index:
-            self.unregister(policy.uid)
+            self._unregister(policy.uid)
 
         # TODO tie breaker using match_len?
         idx = bisect.bisect([p.priority for p in self.policies], policy.priority)
         self.policies.insert(idx, policy)
 
         # self.policies.sort(key=operator.methodcaller('match_len'))
-        self.index[policy.uid] = idx
+        self.index[policy.uid] = policy
+
+        prefix_keys = [k for k, p in policy.match.items() if p._value.is_prefix]
+        for k in prefix_keys:
+            self.prefix_index.setdefault(k, PrefixTrie()).insert(policy.match[k].value, policy.uid)
+        if prefix_keys:
+            self.prefix_keys[policy.uid] = prefix_keys
+        self.notify('registered', policy.uid, policy)
 
     def unregister(self, policy_uid):
         """
         Remove policy from in-memory repository. This does not remove the policy from the file system.
         """
-        idx = self.index[policy_uid]
+        self._unregister(policy_uid)
+        self.notify('unregistered', policy_uid)
+
+    def _unregister(self, policy_uid):
+        policy = self.index.pop(policy_uid)
+        # list positions change whenever a policy is inserted, so look up the policy object itself
+        idx = next(i for i, p in enumerate(self.policies) if p is policy)
         del self.policies[idx]
-        del self.index[policy_uid]
+
+        for k in self.prefix_keys.pop(policy.uid, []):
+            self.prefix_index[k].remove(policy.match[k].value, policy.uid)
+
+    def notify(self, event, uid, policy=None):
+        """Inform all observers about a registered or unregistered policy"""
+        for observer in self.observers:
+            observer(event, uid, policy)
 
     def remove(self, policy_uid):
         self.unregister(policy_uid)
 
-    def lookup(self, input_properties, apply=True, tag=None):
+    def prefix_covered(self, policy, properties, cache):
+        """
+        Use the prefix index to check if the candidate properties are covered by all IP prefix match properties of
+        the policy. cache stores the covering policy UIDs of each (key, value) tuple during a single lookup.
+        """
+        for k in self.prefix_keys.get(policy.uid, []):
+            p = properties.get(k)
+            if p is None:
+                return False
+            if not p._value.is_single or p._value.is_prefix:
+                # not an address, fall back to full property matching
+                continue
+            if (k, p.value) not in cache:
+                cache[(k, p.value)] = set(self.prefix_index[k].covering(p.value))
+            if policy.uid not in cache[(k, p.value)]:
+                return False
+        return True
+
+    def lookup(self, input_properties, apply=True, tag=None, matched=None):
         """
         Look through all installed policies and apply the ones which match against the properties of the given candidate.
 
-        If apply is False, do not append the matched policy properties (dry run).
+        If apply is False, do not append the matched policy properties (dry run). If matched is a set, the UIDs of all
+        matched policies are added to it.
 
         Returns all matched policies.
         """
@@ -309,6 +349,7 @@ class PIB(list):
         logging.info("matching policies %s" % tag)
         candidates = [input_properties]
         processed_candidates = []
+        covering = {}
 
         # iterate through all policies and apply them to candidate.
         for p in self.policies:
@@ -317,8 +358,10 @@ class PIB(list):
                 policy_info += ' ' + PM.STYLES.DARK_GRAY_START + '(%s)' % p.description + PM.STYLES.FORMAT_END
             updated_candidates = []
             for cand in candidates:
-                if p.match_query(cand):
+                if self.prefix_covered(p, cand, covering) and p.match_query(cand):
                     logging.info(' ' * 4 + policy_info)
+                    if matched is not None:
+                        matched.add(p.uid)
                     if not apply:
                         continue
                     # if replace_matched attribute is true, remove the matched properties from the candidate
@@ -0,0 +1,130 @@
+import functools
+import logging
+from collections import OrderedDict
+
+import pmdefaults as PM
+
+
+class CandidateEntry(object):
+    def __init__(self, key, reply, dependencies, queries):
+        self.key = key
+        self.reply = reply
+        # (source, uid) tuples of the CIB nodes, profiles and policies used to generate the reply
+        self.dependencies = dependencies
+        # compiled CIB queries of the profile-expanded requests
+        self.queries = queries
+
+
+class CandidateCache(object):
+    """
+    Cache for the encoded replies of the PM request pipeline, keyed by the fingerprint of the expanded request.
+
+    Each entry records the CIB nodes, profiles and policies it was generated from, and is invalidated once any of
+    them changes or is removed. CIB nodes which are added (or changed) may also generate new candidates for other
+    requests, so before the next lookup all entries whose CIB queries match a row generated from these nodes are
+    invalidated as well. Newly registered profiles or policies may apply to any request, hence they clear the cache.
+    """
+
+    def __init__(self, cib, pib, profiles, max_entries=None):
+        self.cib = cib
+        self.max_entries = max_entries or PM.CANDIDATE_CACHE_SIZE
+
+        self.entries = OrderedDict()
+        # (source, uid) -> keys of the entries depending on the entity
+        self.dependents = {}
+        # CIB nodes added or changed since the last lookup
+        self.added = set()
+
+        self.stats = {'hits': 0, 'misses': 0, 'invalidated': 0, 'cleared': 0}
+
+        cib.observers.append(self.cib_changed)
+        pib.observers.append(functools.partial(self.policy_changed, 'pib'))
+        profiles.observers.append(functools.partial(self.policy_changed, 'profile'))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the cached reply for the request fingerprint, or None"""
+        if self.added:
+            self.sync()
+
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return
+
+        self.entries.move_to_end(key)
+        self.stats['hits'] += 1
+        if self.cib.cache:
+            # cached happy eyeballs results are still in use
+            self.cib.cache.touch([uid for source, uid in entry.dependencies if source == 'cib'])
+        return entry.reply
+
+    def put(self, key, reply, dependencies, queries):
+        self.remove(key)
+        if self.added:
+            # the request was processed after the changes were applied
+            self.sync()
+
+        entry = CandidateEntry(key, reply, frozenset(dependencies), queries)
+        self.entries[key] = entry
+        for d in entry.dependencies:
+            self.dependents.setdefault(d, set()).add(key)
+
+        while len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for d in entry.dependencies:
+            keys = self.dependents.get(d)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.dependents[d]
+
+    def invalidate(self, source, uid):
+        """Remove all entries depending on the given CIB node, profile or policy"""
+        keys = self.dependents.get((source, uid), ())
+        self.stats['invalidated'] += len(keys)
+        for key in list(keys):
+            self.remove(key)
+
+    def clear(self):
+        self.stats['cleared'] += 1
+        self.entries.clear()
+        self.dependents.clear()
+        self.added.clear()
+
+    def sync(self):
+        """Invalidate entries which may be affected by rows generated from recently added CIB nodes"""
+        added, self.added = self.added, set()
+        if not self.entries:
+            return
+
+        rows = [r for r in self.cib.rows if added.intersection(r.meta.get('cib_uids', '').split('<<'))]
+        if not rows:
+            return
+
+        for key, entry in list(self.entries.items()):
+            if any(q.matches(r) for q in entry.queries for r in rows):
+                self.stats['invalidated'] += 1
+                self.remove(key)
+
+    def cib_changed(self, event, uid, cib_node=None):
+        self.invalidate('cib', uid)
+        if event in ('added', 'changed'):
+            self.added.add(uid)
+
+    def policy_changed(self, source, event, uid, policy=None):
+        if event == 'registered':
+            logging.debug("%s %s registered, clearing candidate cache" % (source, uid))
+            self.clear()
+        else:
+            self.invalidate(source, uid)
+
+    def __repr__(self):
+        return 'CandidateCache<%d>' % len(self.entries)
@@ -8,6 +8,12 @@ UTF = True if sys.stdout.encoding == 'UTF-8' else False
 
 # enable caching of HE CIB entries
 CIB_CACHE = True
+# limits of the in-memory tier storing cached HE CIB entries
+CIB_CACHE_MAX_ENTRIES = 10000
+CIB_CACHE_MAX_BYTES = 16 * 1024 * 1024
+CIB_CACHE_TTL = 10 * 60
+# maximum number of (interface, transport) results cached for each (remote_ip, port) destination
+CIB_CACHE_MAX_PER_DESTINATION = 8
 
 logging.addLevelName(logging.INFO, 'INF')
 logging.addLevelName(logging.ERROR, 'ERR')
@@ -21,10 +27,85 @@ CLIENT_UID = str(uuid.uuid3(uuid.NAMESPACE_OID, str(uuid.getnode())))
 # CIB expiration time in seconds
 CIB_DEFAULT_TIMEOUT = 10 * 60
 
+# limits for the paths through the CIB graph expanded for each root node
+CIB_MAX_PATH_DEPTH = 32
+CIB_MAX_PATHS = 10000
+
+# maximum number of compiled CIB lookup queries cached per CIB generation
+CIB_QUERY_CACHE_SIZE = 1024
+
+# number of worker processes the CIB is partitioned across (1 disables sharding)
+CIB_SHARDS = 1
+
+# number of worker processes handling PM requests outside the event loop (0 processes requests in the event loop)
+REQUEST_WORKERS = 0
+
+# number of forked worker processes accepting PM connections on the shared PM socket, while the main process handles
+# all CIB/PIB updates and pushes them to the workers (0 accepts PM connections in the main process)
+PREFORK_WORKERS = 0
+# interval in seconds at which the workers report their metrics to the main process
+PREFORK_REPORT_INTERVAL = 1.0
+
+# maximum number of PM requests waiting to be processed, further requests are answered with an empty candidate list
+ADMISSION_QUEUE_SIZE = 1000
+# PM requests which waited longer than this number of seconds are answered with an empty candidate list, as the NEAT
+# core stops waiting for the reply after 3 seconds (on_pm_timeout)
+ADMISSION_MAX_AGE = 2.5
+# maximum number of admitted PM requests processed concurrently by each request worker
+ADMISSION_IN_FLIGHT = 4
+
+# maximum number of PM replies cached by each process handling PM requests (0 disables the candidate cache)
+CANDIDATE_CACHE_SIZE = 1024
+
+# output of the request processing: 'terminal' renders requests and candidates, 'production' only logs a summary for
+# a fraction of the requests
+OUTPUT_MODE = 'terminal'
+OUTPUT_SAMPLE_RATE = 0.01
+
+# bind the PM socket before loading the CIB and PIB, which are then filled from the event loop while requests are
+# served, loading the given number of entries at a time
+FAST_START = False
+STARTUP_BATCH_SIZE = 50
+
+# upper bounds in seconds of the latency histogram buckets exported at /metrics
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# directory for profiles written on demand (SIGUSR1/SIGUSR2 or REST /profile)
+PROFILE_DIR = os.path.join(os.environ['HOME'], '.neat', 'profiles')
+# default number of profiled requests, and number of functions or allocation sites listed in the profiles
+PROFILE_REQUESTS = 100
+PROFILE_TOP = 30
+# number of frames stored for each memory allocation
+PROFILE_TRACEMALLOC_FRAMES = 1
+# default duration and interval in seconds of stack sampling
+PROFILE_SAMPLE_DURATION = 10
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# number of CIB/PIB change events kept for feed consumers
+FEED_MAX_EVENTS = 10000
+# maximum number of events (REST) or bytes (Unix socket) buffered for a slow feed consumer before it is disconnected
+FEED_QUEUE_SIZE = 1000
+FEED_MAX_BUFFER = 1024 * 1024
+# interval in seconds for keepalive messages on idle REST feed streams
+FEED_KEEPALIVE = 15
+
+# maximum length in bytes of a single framed request received on the PM socket
+PM_MAX_FRAME = 1024 * 1024
+
+# maximum length in bytes of a single line received on the CIB stream socket
+CIB_STREAM_MAX_LINE = 1024 * 1024
+# number of CIB nodes received on the CIB stream socket which are applied per event loop iteration. Reading from the
+# connection is paused while more nodes are pending.
+CIB_STREAM_BATCH = 500
+
 SOCK_DIR = os.path.join(os.environ['HOME'], '.neat', '')
 PIB_SOCK_NAME = 'neat_pib_socket'
 CIB_SOCK_NAME = 'neat_cib_socket'
+FEED_SOCK_NAME = 'neat_feed_socket'
+CIB_STREAM_SOCK_NAME = 'neat_cib_stream_socket'
 DOMAIN_SOCK_NAME = 'neat_pm_socket'
+# file created once the CIB and PIB are completely loaded
+READY_FILE_NAME = 'neat_pm_ready'
 
 
 def update_log_level(level):
@@ -43,10 +124,13 @@ def update_log_level(level):
 
 
 def update_sock_files():
-    global PIB_SOCK, CIB_SOCK, DOMAIN_SOCK
+    global PIB_SOCK, CIB_SOCK, DOMAIN_SOCK, FEED_SOCK, CIB_STREAM_SOCK, READY_FILE
     PIB_SOCK = os.path.join(SOCK_DIR, PIB_SOCK_NAME)
     CIB_SOCK = os.path.join(SOCK_DIR, CIB_SOCK_NAME)
+    FEED_SOCK = os.path.join(SOCK_DIR, FEED_SOCK_NAME)
+    CIB_STREAM_SOCK = os.path.join(SOCK_DIR, CIB_STREAM_SOCK_NAME)
     DOMAIN_SOCK = os.path.join(SOCK_DIR, DOMAIN_SOCK_NAME)
+    READY_FILE = os.path.join(SOCK_DIR, READY_FILE_NAME)
 
 
 update_sock_files()
@@ -54,6 +138,13 @@ update_sock_files()
 PIB_DIR = 'examples/pib/'
 CIB_DIR = 'examples/cib/'
 
+# storage backend for CIB nodes and PIB entries: 'dir' (one JSON file per entry) or 'log' (append-only log)
+STORE_BACKEND = 'dir'
+# number of buffered log records written at once
+STORE_BATCH_SIZE = 100
+# minimum number of superseded log records before the log is compacted
+STORE_COMPACT_MIN = 1000
+
 # default policy property attributes
 DEFAULT_SCORE = 0.0
 DEFAULT_PRECEDENCE = 1
@@ -0,0 +1,131 @@
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import time
+from collections import deque
+
+import pmdefaults as PM
+
+
+class ChangeFeed(object):
+    """
+    Monotonically versioned log of CIB and PIB changes.
+
+    Each event is a JSON compatible dictionary, e.g.,
+
+        {"version": 42, "time": 1500000000.0, "source": "cib", "event": "added", "uid": "eth0", "entry": {...}}
+
+    where event is one of added, changed, removed, expired (CIB nodes) or registered, unregistered (policies and
+    profiles). Added, changed and registered events include the new entry. Only the last PM.FEED_MAX_EVENTS events are
+    kept, consumers whose cursor is older than the oldest retained event have to resynchronize.
+    """
+
+    def __init__(self, max_events=None):
+        self.version = 0
+        self.events = deque(maxlen=max_events or PM.FEED_MAX_EVENTS)
+        self.subscribers = set()
+
+    def watch(self, repository, source):
+        """Publish all changes of a CIB or PIB repository"""
+        repository.observers.append(functools.partial(self._on_change, source))
+
+    def _on_change(self, source, event, uid, entry=None):
+        self.publish(source, event, uid, entry.dict() if entry is not None else None)
+
+    def publish(self, source, event, uid, entry=None):
+        self.version += 1
+        e = {'version': self.version, 'time': time.time(), 'source': source, 'event': event, 'uid': uid}
+        if entry is not None:
+            e['entry'] = entry
+        self.events.append(e)
+
+        for callback in list(self.subscribers):
+            callback(e)
+        return self.version
+
+    def since(self, version):
+        """
+        Return all events newer than the given version. Returns None if some of these events are no longer available.
+        """
+        if version >= self.version:
+            return []
+        oldest = self.events[0]['version'] if self.events else self.version + 1
+        if version + 1 < oldest:
+            return None
+        return list(itertools.islice(self.events, version + 1 - oldest, None))
+
+    def reset_event(self):
+        """Event sent to consumers which missed events. The consumer should fetch the CIB/PIB again."""
+        return {'version': self.version, 'time': time.time(), 'source': None, 'event': 'reset', 'uid': None}
+
+    def subscribe(self, callback):
+        self.subscribers.add(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.discard(callback)
+
+    def __repr__(self):
+        return 'ChangeFeed<v%d, %d events>' % (self.version, len(self.events))
+
+
+class FeedProtocol(asyncio.Protocol):
+    """
+    Stream the change feed over a Unix domain socket. The client sends the last version it has seen (0 for all
+    retained events) followed by a newline, and receives one JSON event per line.
+
+    test using
+        echo 0 | socat -t 3600 - UNIX-CONNECT:$HOME/.neat/neat_feed_socket
+    """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.transport = None
+        self.buffer = ''
+        self.streaming = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        if self.streaming:
+            return
+        self.buffer += data.decode()
+        if '\n' not in self.buffer:
+            if len(self.buffer) > 64:
+                self.transport.close()
+            return
+
+        try:
+            cursor = int(self.buffer.split('\n', 1)[0].strip() or 0)
+        except ValueError:
+            logging.warning("invalid feed cursor %s" % self.buffer.strip())
+            self.transport.close()
+            return
+
+        self.streaming = True
+        events = self.feed.since(cursor)
+        if events is None:
+            events = [self.feed.reset_event()]
+        for e in events:
+            self.send(e)
+        self.feed.subscribe(self.send)
+
+    def send(self, event):
+        if self.transport.is_closing():
+            self.feed.unsubscribe(self.send)
+            return
+        if self.transport.get_write_buffer_size() > PM.FEED_MAX_BUFFER:
+            logging.warning("closing slow change feed consumer")
+            self.feed.unsubscribe(self.send)
+            self.transport.close()
+            return
+        self.transport.write((json.dumps(event) + '\n').encode('utf-8'))
+
+    def eof_received(self):
+        # keep streaming to clients which closed their sending side
+        return True
+
+    def connection_lost(self, exc):
+        self.feed.unsubscribe(self.send)
@@ -1,4 +1,5 @@
 import logging
+import os
 import socket
 
 so_separator = '/'
@@ -29,3 +30,23 @@ def sock_prop(so_str):
         return -1
 
     return so_separator.join(('SO', str(sol_i), str(so_i)))
+
+
+def sd_notify(state):
+    """
+    Send a state notification (e.g., 'READY=1') to the service manager, if the PM was started by systemd with
+    Type=notify
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # abstract namespace socket
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.sendto(state.encode(), address)
+    except OSError as e:
+        logging.warning("unable to notify service manager: %s" % e)
+        return False
+    return True
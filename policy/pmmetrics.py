@@ -0,0 +1,146 @@
+import bisect
+import time
+
+import pmdefaults as PM
+
+
+class Timer(object):
+    """Context manager which records the elapsed time in a histogram"""
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class Metrics(object):
+    """
+    Registry of latency histograms with fixed buckets, counters and gauges, exported in the Prometheus text format.
+
+    Samples are identified by the metric name and a set of labels, e.g., observe('neat_pm_stage_seconds', 0.002,
+    stage='cib'). Metrics recorded in worker processes are transferred to the main process using drain() and merge().
+    Gauges describe the current state of a process and are not transferred.
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or PM.METRICS_BUCKETS)
+        # name -> (type, help text)
+        self.descriptions = {}
+        # (name, labels) -> [count of each bucket and of +Inf, sum]
+        self.histograms = {}
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> value
+        self.gauges = {}
+
+    def describe(self, name, metric_type, text):
+        self.descriptions[name] = (metric_type, text)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        h[bisect.bisect_left(self.buckets, value)] += 1
+        h[-1] += value
+
+    def time(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def drain(self):
+        """Return all samples recorded since the last call and reset the registry"""
+        samples = (self.histograms, self.counters)
+        self.histograms = {}
+        self.counters = {}
+        return samples
+
+    def merge(self, samples):
+        """Add samples returned by drain(), e.g., in another process"""
+        histograms, counters = samples
+        for key, h in histograms.items():
+            mine = self.histograms.get(key)
+            if mine is None:
+                self.histograms[key] = list(h)
+            else:
+                for i, v in enumerate(h):
+                    mine[i] += v
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        families = {}
+        for (name, labels), h in self.histograms.items():
+            families.setdefault(name, []).append((labels, h))
+        for (name, labels), value in self.counters.items():
+            families.setdefault(name, []).append((labels, value))
+        for (name, labels), value in self.gauges.items():
+            families.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(families):
+            metric_type, text = self.descriptions.get(name, ('untyped', ''))
+            if text:
+                lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+            for labels, value in sorted(families[name], key=lambda s: s[0]):
+                if not isinstance(value, list):
+                    lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+                    continue
+                count = 0
+                for bound, n in zip(self.buckets + (float('inf'),), value):
+                    count += n
+                    le = format_value(bound) if bound != float('inf') else '+Inf'
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', le),)), count))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(value[-1])))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def __repr__(self):
+        return 'Metrics<%d histograms, %d counters, %d gauges>' % (len(self.histograms), len(self.counters),
+                                                                   len(self.gauges))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, escape_label(v)) for k, v in labels) + '}'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# metrics of the current process
+metrics = Metrics()
+
+metrics.describe('neat_pm_stage_seconds', 'histogram', 'Time spent in each stage of the PM request processing.')
+metrics.describe('neat_pm_request_seconds', 'histogram', 'Time spent processing PM requests.')
+metrics.describe('neat_pm_requests_total', 'counter', 'Number of PM requests.')
+metrics.describe('neat_pm_candidates_total', 'counter', 'Number of candidates generated for PM requests.')
+metrics.describe('neat_pm_rejected_total', 'counter', 'Number of rejected PM requests by reason.')
+metrics.describe('neat_pm_queue_seconds', 'histogram', 'Time PM requests waited for admission.')
+metrics.describe('neat_pm_queue_depth', 'gauge', 'Number of PM requests waiting for admission.')
+metrics.describe('neat_rest_request_seconds', 'histogram', 'Time spent handling REST requests.')
+metrics.describe('neat_rest_requests_total', 'counter', 'Number of REST requests by handler and status.')
+metrics.describe('neat_import_seconds', 'histogram', 'Time spent importing CIB nodes and policies.')
@@ -0,0 +1,84 @@
+import logging
+import logging.handlers
+import queue
+import time
+
+import pmdefaults as PM
+from policy import term_separator
+
+
+class Output(object):
+    """
+    Output of the PM request processing.
+
+    In terminal mode (the default) requests, intermediate results and candidates are rendered for interactive use.
+    In production mode nothing is rendered. Log records are emitted by a background thread, so that writing to a slow
+    log consumer (e.g., journald) does not block the event loop, and a one-line summary is logged for a sample of the
+    processed requests (PM.OUTPUT_SAMPLE_RATE).
+    """
+
+    def __init__(self, mode=None, sample_rate=None):
+        self.mode = mode or PM.OUTPUT_MODE
+        self.terminal = self.mode == 'terminal'
+
+        sample_rate = PM.OUTPUT_SAMPLE_RATE if sample_rate is None else sample_rate
+        # log the summary of every n-th request
+        self.sample_interval = round(1 / sample_rate) if sample_rate > 0 else 0
+        self.requests = 0
+
+        self.listener = None
+        self.handlers = []
+
+    def start(self):
+        """Emit log records from a background thread (production mode only)"""
+        if self.terminal or self.listener is not None:
+            return
+
+        root = logging.getLogger()
+        self.handlers = root.handlers[:]
+        log_queue = queue.SimpleQueue()
+        for handler in self.handlers:
+            root.removeHandler(handler)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        self.listener = logging.handlers.QueueListener(log_queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Flush all pending log records and restore the original log handlers"""
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener = None
+
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        for handler in self.handlers:
+            root.addHandler(handler)
+
+    def console(self, msg, *args):
+        """Print a message in terminal mode. Arguments are only formatted if the message is printed."""
+        if self.terminal:
+            print(msg % args if args else msg)
+
+    def separator(self, text='', line_char=PM.CHARS.LINE_SEPARATOR, offset=0):
+        if self.terminal:
+            print(term_separator(text, line_char=line_char, offset=offset))
+
+    def summary(self, requests, candidates, start, cached=False):
+        """Log a summary of a processed request in production mode. start is the time.perf_counter() timestamp at
+        which the request processing started. Replies served from the candidate cache are summarized as cached."""
+        self.requests += 1
+        if self.terminal or not self.sample_interval or self.requests % self.sample_interval:
+            return
+
+        if cached:
+            result = 'cached candidates'
+        else:
+            best = '%d|%d' % candidates[0].score if candidates else '-'
+            result = '%d candidates, best score %s' % (len(candidates), best)
+        logging.info("request %d: %d requests, %s, %.1f ms", self.requests, requests, result,
+                     (time.perf_counter() - start) * 1000)
+
+    def __repr__(self):
+        return 'Output<%s>' % self.mode
@@ -0,0 +1,472 @@
+import asyncio
+import collections
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+import time
+from multiprocessing.reduction import ForkingPickler
+
+import pmdefaults as PM
+from pmmetrics import metrics
+
+
+class PoolError(Exception):
+    pass
+
+
+class TouchLog(object):
+    """Stand-in for the CIBCache of a replica, records the cached CIB nodes used by lookups"""
+
+    def __init__(self):
+        self.uids = []
+
+    def touch(self, uids):
+        self.uids.extend(uids)
+
+    def discard(self, uids, expired=False):
+        pass
+
+    def drain(self):
+        """Return and reset the recorded CIB node uids"""
+        uids, self.uids = self.uids, []
+        return uids
+
+
+def apply_change(repository, event, uid, entry):
+    """Apply a change of the CIB or PIB observed in the main process to a replica"""
+    if event in ('added', 'changed'):
+        repository.add_node(entry)
+    elif event in ('removed', 'expired'):
+        repository.evict([uid], expired=event == 'expired')
+    elif event == 'registered':
+        repository.register(entry)
+    elif event == 'unregistered' and uid in repository.index:
+        repository.unregister(uid)
+
+
+def replay_change(repositories, source, event, uid, entry):
+    """Apply a change forwarded by the main process to the replica of a worker"""
+    try:
+        apply_change(repositories[source], event, uid, entry)
+    except Exception as e:
+        logging.exception("PM worker failed to apply %s %s %s: %s" % (source, event, uid, e))
+
+
+def init_worker(repositories, initializer=None):
+    """
+    Prepare the replicas of the CIB and PIB repositories in a forked worker process. initializer is called once the
+    replicas are set up. Returns the TouchLog which records the cached CIB nodes used by the lookups of the worker.
+    """
+    # signals from the terminal are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGQUIT, signal.SIG_IGN)
+    signal.set_wakeup_fd(-1)
+
+    for repository in repositories.values():
+        # changes applied to the replicas must not be published again
+        repository.observers.clear()
+    touches = TouchLog()
+    cib = repositories.get('cib')
+    if cib is not None:
+        cib.loop = None
+        cib.cache = touches
+    if initializer is not None:
+        initializer()
+    # metrics recorded by the worker are merged into the metrics of the main process
+    metrics.drain()
+    return touches
+
+
+def _worker(conn, reply_conn, handler, repositories, initializer=None):
+    """
+    Main loop of a request worker. The worker holds replicas of the CIB and PIB repositories, which were forked from
+    the main process and are kept up to date by replaying all subsequent changes in the order they were observed.
+    """
+    touches = init_worker(repositories, initializer)
+
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        op, args = msg[0], msg[1:]
+        if op == 'request':
+            rid, request, stream = args
+            try:
+                if stream:
+                    # partial replies are forwarded to the main process as soon as they are available
+                    data = handler(request, lambda partial: reply_conn.send(('partial', rid, partial)))
+                else:
+                    data = handler(request)
+                reply_conn.send(('reply', rid, data, touches.drain(), metrics.drain()))
+            except Exception as e:
+                logging.exception("request worker failed to process request: %s" % e)
+                touches.drain()
+                reply_conn.send(('reply', rid, None, None, metrics.drain()))
+        elif op == 'change':
+            replay_change(repositories, *args)
+        elif op == 'close':
+            break
+    conn.close()
+    reply_conn.close()
+
+
+class WorkerPipe(object):
+    """
+    Pipes between the main process and a forked worker process. Messages to the worker are written without blocking
+    the event loop, i.e., they are buffered while the pipe is full and written once the pipe becomes writable. The
+    worker reads them using the conn returned by child(), and sends its messages using reply_conn, which are passed to
+    on_message(msg) in the main process. on_close(error) is called once the worker is unavailable.
+    """
+
+    def __init__(self, ctx, loop, on_message, on_close):
+        self.loop = loop
+        self.on_message = on_message
+        self.on_close = on_close
+        # one pipe for each direction, so that only the sending side of the main process is non-blocking
+        self.conn, self.child_reply_conn = ctx.Pipe(duplex=False)
+        self.child_conn, self.writer = ctx.Pipe(duplex=False)
+        self.buffer = bytearray()
+        self.writing = False
+        self.closed = False
+
+    def child(self):
+        """Return the (conn, reply_conn) pair used by the worker"""
+        return self.child_conn, self.child_reply_conn
+
+    def started(self):
+        """Close the ends of the worker once it has been forked, and start reading its messages"""
+        self.child_conn.close()
+        self.child_reply_conn.close()
+        os.set_blocking(self.writer.fileno(), False)
+        self.loop.add_reader(self.conn.fileno(), self._on_readable)
+
+    def send(self, *msg):
+        """Queue a message for the worker. Returns False if the worker is unavailable."""
+        if self.closed:
+            return False
+        data = ForkingPickler.dumps(msg)
+        # framing of multiprocessing.Connection.send_bytes, the worker reads the message using recv()
+        if len(data) > 0x7fffffff:
+            self.buffer += struct.pack('!iQ', -1, len(data))
+        else:
+            self.buffer += struct.pack('!i', len(data))
+        self.buffer += data
+        if not self.writing:
+            self._write()
+        return not self.closed
+
+    def _write(self):
+        try:
+            written = os.write(self.writer.fileno(), self.buffer)
+        except BlockingIOError:
+            written = 0
+        except OSError as e:
+            self.on_close(e)
+            return
+        del self.buffer[:written]
+
+        if self.buffer and not self.writing:
+            self.loop.add_writer(self.writer.fileno(), self._write)
+            self.writing = True
+        elif not self.buffer and self.writing:
+            self.loop.remove_writer(self.writer.fileno())
+            self.writing = False
+
+    def _on_readable(self):
+        try:
+            while not self.closed and self.conn.poll():
+                self.on_message(self.conn.recv())
+        except EOFError:
+            self.on_close('exited')
+        except OSError as e:
+            self.on_close(e)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.buffer and not self.writing:
+            self._write()
+        self.closed = True
+        self.loop.remove_reader(self.conn.fileno())
+        if self.writing:
+            self.loop.remove_writer(self.writer.fileno())
+        self.conn.close()
+        self.writer.close()
+
+
+class RequestCoalescer(object):
+    """
+    Share a single in-flight computation between concurrent identical requests. Requests are identified by a
+    hashable key, e.g., the request string. Results must not be modified by the callers.
+    """
+
+    def __init__(self):
+        self.inflight = {}
+        self.stats = {'requests': 0, 'coalesced': 0}
+
+    def submit(self, key, start):
+        """Return the future of the computation for key. start() is only called if no such computation is in flight."""
+        self.stats['requests'] += 1
+        future = self.inflight.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            return future
+
+        future = start()
+        self.inflight[key] = future
+        future.add_done_callback(lambda f: self.inflight.pop(key, None))
+        return future
+
+    @property
+    def rate(self):
+        """Fraction of requests which were served by another in-flight computation"""
+        return self.stats['coalesced'] / self.stats['requests'] if self.stats['requests'] else 0.0
+
+    def __repr__(self):
+        return 'RequestCoalescer<%d in flight, %.1f%% coalesced>' % (len(self.inflight), 100 * self.rate)
+
+
+class AdmissionQueue(object):
+    """
+    Bounded queue of PM requests waiting to be processed. Requests are started in arrival order, one per event loop
+    iteration, so that new connections are accepted and timestamped in between. Requests which arrive while the queue
+    is full, or which waited longer than max_age when they are dequeued, are shed: they are not processed, as the
+    client has most likely stopped waiting for the reply.
+    """
+
+    def __init__(self, max_size=None, max_age=None, in_flight=1):
+        self.max_size = max_size or PM.ADMISSION_QUEUE_SIZE
+        self.max_age = max_age or PM.ADMISSION_MAX_AGE
+        # maximum number of started requests which have not completed yet
+        self.in_flight = in_flight
+        self.active = 0
+        self.queue = collections.deque()
+        self.scheduled = False
+        self.stats = {'admitted': 0, 'shed_full': 0, 'shed_stale': 0, 'max_depth': 0}
+
+    def __len__(self):
+        return len(self.queue)
+
+    def submit(self, start, shed, arrived=None):
+        """
+        Queue a request. start(done) is called once the request is admitted and must call done() once the request has
+        been processed. shed(reason) is called instead if the request is shed. arrived is the time.monotonic()
+        timestamp at which the request was received.
+        """
+        if len(self.queue) >= self.max_size:
+            self._shed(shed, 'full')
+            return
+
+        self.queue.append((arrived or time.monotonic(), start, shed))
+        self.stats['max_depth'] = max(self.stats['max_depth'], len(self.queue))
+        metrics.set('neat_pm_queue_depth', len(self.queue))
+        self._schedule()
+
+    def _shed(self, shed, reason):
+        self.stats['shed_' + reason] += 1
+        metrics.inc('neat_pm_rejected_total', reason='shed_' + reason)
+        shed(reason)
+
+    def _schedule(self):
+        if self.queue and self.active < self.in_flight and not self.scheduled:
+            self.scheduled = True
+            asyncio.get_event_loop().call_soon(self._run)
+
+    def _run(self):
+        self.scheduled = False
+        now = time.monotonic()
+        while self.queue and self.active < self.in_flight:
+            arrived, start, shed = self.queue.popleft()
+            metrics.observe('neat_pm_queue_seconds', now - arrived)
+            if now - arrived > self.max_age:
+                logging.warning("shedding PM request which waited %.2fs" % (now - arrived))
+                self._shed(shed, 'stale')
+                continue
+            self.stats['admitted'] += 1
+            self._start(start)
+            break
+        metrics.set('neat_pm_queue_depth', len(self.queue))
+        self._schedule()
+
+    def _start(self, start):
+        finished = False
+
+        def done():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            self.active -= 1
+            self._schedule()
+
+        self.active += 1
+        try:
+            start(done)
+        except Exception as e:
+            # the slot of a request which failed to start is released, so that the queue does not stall
+            logging.exception("failed to start PM request: %s" % e)
+            done()
+
+    def __repr__(self):
+        return 'AdmissionQueue<%d queued, %d active>' % (len(self.queue), self.active)
+
+
+class ReplicaWorkers(object):
+    """
+    Worker processes forked from the main process, which hold replicas of the CIB and PIB repositories. Every change
+    of a repository is forwarded to all workers in the order it was observed. target(conn, reply_conn, *args) is the
+    main function of each worker, see WorkerPipe.
+    """
+
+    # used in log messages
+    kind = 'PM worker'
+
+    def __init__(self, target, args, repositories, size, loop, name):
+        self.repositories = repositories
+        self.loop = loop
+        self.size = size
+        self.conns = {}
+        self.workers = {}
+        self.stats = {'changes': 0}
+
+        ctx = multiprocessing.get_context('fork')
+        for i in range(size):
+            pipe = WorkerPipe(ctx, loop, functools.partial(self._on_message, i), functools.partial(self._failed, i))
+            worker = ctx.Process(target=target, args=pipe.child() + args, name='%s-%d' % (name, i), daemon=True)
+            worker.start()
+            pipe.started()
+            self.conns[i] = pipe
+            self.workers[i] = worker
+
+        for source, repository in repositories.items():
+            repository.observers.append(self._observer(source))
+
+    def _observer(self, source):
+        def on_change(event, uid, entry=None):
+            self.stats['changes'] += 1
+            for i in list(self.conns):
+                self._send(i, 'change', source, event, uid, entry)
+
+        return on_change
+
+    def _send(self, i, *msg):
+        return self.conns[i].send(*msg)
+
+    def _failed(self, i, error):
+        logging.error("%s %d unavailable: %s" % (self.kind, i, error))
+        self._remove(i)
+
+    def _remove(self, i):
+        """Stop using a worker. Returns False if the worker was already removed."""
+        pipe = self.conns.pop(i, None)
+        if pipe is None:
+            return False
+        pipe.close()
+        return True
+
+    def _on_message(self, i, msg):
+        raise NotImplementedError
+
+    def _touch(self, touched):
+        """Record the cached CIB nodes used by the lookups of a worker"""
+        if touched:
+            self.repositories['cib'].cache.touch(touched)
+
+    def __len__(self):
+        return len(self.conns)
+
+    def close(self):
+        for i in list(self.conns):
+            self._send(i, 'close')
+            self._remove(i)
+        for worker in self.workers.values():
+            worker.join(timeout=1)
+
+
+class RequestPool(ReplicaWorkers):
+    """
+    Pool of worker processes which run the CPU-heavy request processing outside the asyncio event loop.
+
+    The workers are forked from the main process, so they start with a copy of the loaded CIB and PIB repositories.
+    Every change of a repository is forwarded to all workers on the same pipe as the requests, hence a request always
+    sees all changes which were made before it was submitted. Requests are dispatched to the worker with the fewest
+    pending requests. Workers must be started before any client connection is accepted, so that they do not inherit
+    client sockets.
+    """
+
+    kind = 'request worker'
+
+    def __init__(self, handler, repositories, workers=None, loop=None, initializer=None):
+        """
+        handler is called with the request string in a worker process and returns the reply. repositories maps the
+        source name used by the change feed (cib, pib, profile) to the CIB or PIB object. initializer is called in
+        each worker once the replicas are set up, e.g., to register observers.
+        """
+        self.handler = handler
+        self.rids = itertools.count()
+        # futures of the pending requests of each worker
+        self.pending = collections.defaultdict(dict)
+        # callbacks for the partial replies of streamed requests
+        self.partials = {}
+
+        super().__init__(_worker, (handler, repositories, initializer), repositories, workers or PM.REQUEST_WORKERS,
+                         loop or asyncio.get_event_loop(), 'pm-worker')
+        self.stats.update({'requests': 0, 'failed': 0})
+        logging.info("started %d request workers" % self.size)
+
+    def _remove(self, i):
+        if not super()._remove(i):
+            return False
+        for rid, future in self.pending.pop(i, {}).items():
+            self.partials.pop(rid, None)
+            if not future.done():
+                future.set_exception(PoolError('request worker %d exited' % i))
+        return True
+
+    def _on_message(self, i, msg):
+        if msg[0] == 'partial':
+            on_partial = self.partials.get(msg[1])
+            if on_partial is not None:
+                on_partial(msg[2])
+            return
+        op, rid, data, touched, samples = msg
+        metrics.merge(samples)
+        future = self.pending[i].pop(rid)
+        self.partials.pop(rid, None)
+        self._touch(touched)
+        if future.done():
+            return
+        if data is None and touched is None:
+            self.stats['failed'] += 1
+            future.set_exception(PoolError('request worker %d failed to process request' % i))
+        else:
+            future.set_result(data)
+
+    def submit(self, request, on_partial=None):
+        """
+        Process a request in one of the workers. Returns a future for the reply of the handler. If on_partial is
+        given, the handler is called with an additional emit function, and every partial reply passed to it in the
+        worker is passed to on_partial in the main process before the future completes.
+        """
+        future = self.loop.create_future()
+        if not self.conns:
+            future.set_exception(PoolError('no request workers available'))
+            return future
+
+        i = min(self.conns, key=lambda i: len(self.pending[i]))
+        rid = next(self.rids)
+        self.pending[i][rid] = future
+        if on_partial is not None:
+            self.partials[rid] = on_partial
+        self.stats['requests'] += 1
+        self._send(i, 'request', rid, request, on_partial is not None)
+        return future
+
+    def __repr__(self):
+        return 'RequestPool<%d workers>' % len(self.conns)
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import socket
+
+import pmdefaults as PM
+from pmmetrics import metrics
+from pmpool import ReplicaWorkers, init_worker, replay_change
+
+
+def bind_unix_socket(path, backlog=100):
+    """Bind a listening Unix stream socket, which is inherited by the forked workers"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def _worker(conn, reply_conn, sock, protocol_factory, repositories, initializer=None):
+    """
+    Main loop of an accepting worker. The worker runs its own event loop, accepts connections on the shared listening
+    socket and processes the requests using its replicas of the CIB and PIB repositories. Changes made in the writer
+    process are applied between two requests.
+    """
+    touches = init_worker(repositories, initializer)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def on_message():
+        try:
+            while conn.poll():
+                msg = conn.recv()
+                if msg[0] == 'change':
+                    replay_change(repositories, *msg[1:])
+                elif msg[0] == 'close':
+                    loop.stop()
+                    return
+        except (EOFError, OSError):
+            # the writer process exited
+            loop.stop()
+
+    def report():
+        # metrics and the cached happy eyeballs results used by the requests are passed to the writer process
+        try:
+            reply_conn.send(('report', touches.drain(), metrics.drain()))
+        except OSError:
+            loop.stop()
+            return
+        loop.call_later(PM.PREFORK_REPORT_INTERVAL, report)
+
+    server = loop.run_until_complete(loop.create_unix_server(protocol_factory, sock=sock))
+    loop.add_reader(conn.fileno(), on_message)
+    loop.call_later(PM.PREFORK_REPORT_INTERVAL, report)
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.close()
+        conn.close()
+        reply_conn.close()
+
+
+class PreforkServer(ReplicaWorkers):
+    """
+    Serve a Unix socket from several forked worker processes, which accept connections in parallel.
+
+    The listening socket is bound once by the writer process, which keeps the CIB and PIB repositories. Updates of the
+    repositories are only made in the writer process (CIB/PIB sockets, REST API, expiry), and every change is pushed to
+    all workers, which start with a copy of the repositories at the time they were forked. Workers must be forked before
+    any client connection is accepted, so that they do not inherit client sockets. Hence workers which exit are not
+    restarted. Once all workers have exited, the writer process accepts connections itself.
+    """
+
+    def __init__(self, path, protocol_factory, repositories, workers=None, loop=None, initializer=None):
+        """
+        protocol_factory creates the protocol of each connection in the workers. repositories maps the source name
+        used by the change feed (cib, pib, profile) to the CIB or PIB object. initializer is called in each worker once
+        the replicas are set up, e.g., to register observers.
+        """
+        self.path = path
+        self.protocol_factory = protocol_factory
+        self.sock = bind_unix_socket(path)
+        # server of the writer process, started once all workers have exited
+        self.server = None
+        self.closing = False
+
+        super().__init__(_worker, (self.sock, protocol_factory, repositories, initializer), repositories,
+                         workers or PM.PREFORK_WORKERS, loop or asyncio.get_event_loop(), 'pm-acceptor')
+        self.stats.update({'workers': len(self.conns), 'exited': 0})
+        logging.info("started %d PM workers accepting on %s" % (self.size, path))
+
+    def _remove(self, i):
+        if not super()._remove(i):
+            return False
+        self.stats['workers'] = len(self.conns)
+        self.stats['exited'] += 1
+        if not self.conns and self.server is None and not self.closing:
+            logging.warning("all PM workers exited, accepting PM requests in the writer process")
+            asyncio.ensure_future(self._serve(), loop=self.loop)
+        return True
+
+    async def _serve(self):
+        self.server = await self.loop.create_unix_server(self.protocol_factory, sock=self.sock)
+
+    def _on_message(self, i, msg):
+        op, touched, samples = msg
+        metrics.merge(samples)
+        self._touch(touched)
+
+    def close(self):
+        self.closing = True
+        super().close()
+        if self.server is not None:
+            self.server.close()
+        self.sock.close()
+
+    def __repr__(self):
+        return 'PreforkServer<%d workers>' % len(self.conns)
@@ -0,0 +1,161 @@
+import cProfile
+import collections
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+import pmdefaults as PM
+
+
+class Profiler(object):
+    """
+    On-demand profiling of a running PM without blocking the event loop. Results are written to files in
+    PM.PROFILE_DIR:
+
+    requests-<time>.prof/.txt  cProfile statistics of the next N processed requests (profile_requests)
+    memory-<time>.txt          tracemalloc allocations, and differences to the previous snapshot (snapshot_memory)
+    stacks-<time>.txt          stacks of the main thread sampled by a background thread, in the collapsed format used
+                               by flame graph tools (sample_stacks)
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or PM.PROFILE_DIR
+        self.profile = None
+        # number of requests which are still to be profiled
+        self.remaining = 0
+        self.profiled = 0
+        self.snapshot = None
+        self.sampler = None
+        self.files = []
+
+    @property
+    def profiling(self):
+        return self.remaining > 0
+
+    def status(self):
+        return {'directory': self.directory,
+                'requests_remaining': self.remaining,
+                'tracing_memory': tracemalloc.is_tracing(),
+                'sampling_stacks': self.sampler is not None and self.sampler.is_alive(),
+                'files': self.files[-10:]}
+
+    def _path(self, kind, extension):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, '%s-%s%s' % (kind, time.strftime('%Y%m%d-%H%M%S'), extension))
+
+    def _written(self, path):
+        self.files.append(path)
+        logging.info("profile written to %s" % path)
+
+    def profile_requests(self, count=None):
+        """Profile the next count requests. Profiling in progress is restarted."""
+        self.profile = cProfile.Profile()
+        self.remaining = count or PM.PROFILE_REQUESTS
+        self.profiled = 0
+        logging.info("profiling the next %d requests" % self.remaining)
+
+    def call(self, func, *args):
+        """Call func, and profile the call if requests are being profiled"""
+        if not self.remaining:
+            return func(*args)
+
+        self.profile.enable()
+        try:
+            return func(*args)
+        finally:
+            self.profile.disable()
+            self.profiled += 1
+            self.remaining -= 1
+            if not self.remaining:
+                self.dump_profile()
+
+    def dump_profile(self):
+        profile, self.profile = self.profile, None
+        self.remaining = 0
+        if profile is None:
+            return
+
+        path = self._path('requests', '.prof')
+        profile.dump_stats(path)
+        text = io.StringIO()
+        text.write('%d requests\n' % self.profiled)
+        pstats.Stats(profile, stream=text).sort_stats('cumulative').print_stats(PM.PROFILE_TOP)
+        with open(path[:-len('.prof')] + '.txt', 'w') as f:
+            f.write(text.getvalue())
+        self._written(path)
+        return path
+
+    def snapshot_memory(self):
+        """
+        Start tracing memory allocations, or write the top allocations and the differences to the previous snapshot.
+        Returns the path of the written file, or None if tracing was just started.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(PM.PROFILE_TRACEMALLOC_FRAMES)
+            self.snapshot = self._take_snapshot()
+            logging.info("started tracing memory allocations")
+            return
+
+        snapshot = self._take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ['traced memory: %d bytes, peak %d bytes' % (current, peak), '', 'top allocations:']
+        lines.extend(str(s) for s in snapshot.statistics('lineno')[:PM.PROFILE_TOP])
+        if self.snapshot is not None:
+            lines.extend(['', 'differences to previous snapshot:'])
+            lines.extend(str(s) for s in snapshot.compare_to(self.snapshot, 'lineno')[:PM.PROFILE_TOP])
+        self.snapshot = snapshot
+
+        path = self._path('memory', '.txt')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self._written(path)
+        return path
+
+    def _take_snapshot(self):
+        # ignore the memory used by tracemalloc itself
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+    def stop_memory(self):
+        tracemalloc.stop()
+        self.snapshot = None
+
+    def sample_stacks(self, duration=None, interval=None):
+        """Sample the stack of the main thread in a background thread. Returns False if sampling is in progress."""
+        if self.sampler is not None and self.sampler.is_alive():
+            return False
+
+        duration = duration or PM.PROFILE_SAMPLE_DURATION
+        interval = interval or PM.PROFILE_SAMPLE_INTERVAL
+        path = self._path('stacks', '.txt')
+        self.sampler = threading.Thread(target=self._sample, args=(threading.main_thread().ident, duration, interval,
+                                                                   path), name='pm-stack-sampler', daemon=True)
+        self.sampler.start()
+        logging.info("sampling stacks for %.1fs" % duration)
+        return True
+
+    def _sample(self, ident, duration, interval, path):
+        stacks = collections.Counter()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+        self._written(path)
+
+    def __repr__(self):
+        return 'Profiler<%s>' % self.directory
@@ -2,9 +2,11 @@ import asyncio
 import json
 import logging
 import random
+import time
 from contextlib import suppress
 
 import pmdefaults as PM
+from pmmetrics import metrics
 
 try:
     import aiohttp
@@ -22,6 +24,9 @@ except ImportError as e:
 profiles = None
 cib = None
 pib = None
+feed = None
+pm_stats = None
+profiler = None
 
 server = None
 
@@ -145,6 +150,96 @@ async def handle_cib_rows(request):
     return web.Response(text=text)
 
 
+async def handle_cib_stats(request):
+    text = json.dumps(dict(cib.stats, nodes=len(cib.nodes), rows=len(cib.rows), cache=cib.cache.stats()), indent=4)
+    return web.Response(text=text)
+
+
+async def handle_pm_stats(request):
+    text = json.dumps(pm_stats(), indent=4)
+    return web.Response(text=text)
+
+
+async def handle_metrics(request):
+    """
+    Export latency histograms and counters in the Prometheus text format.
+
+    Test using: curl localhost:45888/metrics
+    """
+    return web.Response(text=metrics.render(), content_type='text/plain')
+
+
+async def handle_profile(request):
+    """
+    Return the profiler status. Profiling is controlled using POST requests:
+
+    /profile/requests?count=100   profile the next requests (count=0 stops profiling in progress)
+    /profile/memory               take a memory snapshot (the first request starts tracing)
+    /profile/stacks?duration=10   sample stacks of the event loop thread
+
+    Test using: curl -X POST localhost:45888/profile/stacks?duration=5
+    """
+    action = request.match_info.get('action')
+    try:
+        if action == 'requests':
+            count = int(request.rel_url.query.get('count', PM.PROFILE_REQUESTS))
+            if count > 0:
+                profiler.profile_requests(count)
+            else:
+                profiler.dump_profile()
+        elif action == 'memory':
+            profiler.snapshot_memory()
+        elif action == 'stacks':
+            duration = float(request.rel_url.query.get('duration', PM.PROFILE_SAMPLE_DURATION))
+            interval = float(request.rel_url.query.get('interval', PM.PROFILE_SAMPLE_INTERVAL))
+            if not profiler.sample_stacks(duration, interval):
+                return web.Response(status=409, text='stack sampling in progress')
+        elif action is not None:
+            return web.Response(status=404, text='unknown profiling action')
+    except ValueError:
+        return web.Response(status=400, text='invalid parameter')
+    except OSError as e:
+        return web.Response(status=500, text='unable to write profile: %s' % e)
+
+    text = json.dumps(profiler.status(), indent=4)
+    return web.Response(text=text)
+
+
+async def observe_request(request, handler):
+    """Record the latency and status of a REST request, labeled with the name of its handler"""
+    start = time.perf_counter()
+    name = getattr(request.match_info.handler, '__name__', 'unknown')
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.observe('neat_rest_request_seconds', time.perf_counter() - start, handler=name)
+        metrics.inc('neat_rest_requests_total', handler=name, status=status)
+
+
+def metrics_middleware():
+    if hasattr(web, 'middleware'):
+        @web.middleware
+        async def middleware(request, handler):
+            return await observe_request(request, handler)
+
+        return middleware
+
+    # aiohttp < 2.3 only supports middleware factories
+    async def factory(app, handler):
+        async def middleware(request):
+            return await observe_request(request, handler)
+
+        return middleware
+
+    return factory
+
+
 async def handle_cib(request):
     uid = request.match_info.get('uid')
     if uid is None:
@@ -194,6 +289,73 @@ async def handle_cib_delete(request):
     return web.Response(text="CIB node removed")
 
 
+def format_sse(event):
+    return ('id: %d\nevent: %s\ndata: %s\n\n' % (event['version'], event['event'], json.dumps(event))).encode('utf-8')
+
+
+async def write_stream(response, data):
+    result = response.write(data)
+    if result is not None:
+        # aiohttp >= 3.0
+        await result
+    else:
+        await response.drain()
+
+
+async def handle_feed(request):
+    """
+    Stream CIB/PIB changes as server-sent events, starting after the version given by the `since` parameter or the
+    Last-Event-ID header (default: only new events). With stream=0 the pending events are returned as JSON.
+
+    Test using: curl -N localhost:45888/feed?since=0
+    """
+    try:
+        cursor = int(request.rel_url.query.get('since', request.headers.get('Last-Event-ID', feed.version)))
+    except ValueError:
+        return web.Response(status=400, text='invalid feed version')
+
+    events = feed.since(cursor)
+    if events is None:
+        events = [feed.reset_event()]
+
+    if request.rel_url.query.get('stream') == '0':
+        text = json.dumps({'version': feed.version, 'events': events}, indent=4)
+        return web.Response(text=text, content_type='application/json')
+
+    queue = asyncio.Queue(maxsize=PM.FEED_QUEUE_SIZE)
+
+    def enqueue(event):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # the consumer is too slow, ask it to resynchronize
+            feed.unsubscribe(enqueue)
+            queue.get_nowait()
+            queue.put_nowait(None)
+
+    feed.subscribe(enqueue)
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    try:
+        await response.prepare(request)
+        for event in events:
+            await write_stream(response, format_sse(event))
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), PM.FEED_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await write_stream(response, b': keepalive\n\n')
+                continue
+            if event is None:
+                await write_stream(response, format_sse(feed.reset_event()))
+                break
+            await write_stream(response, format_sse(event))
+    except (ConnectionResetError, asyncio.CancelledError):
+        pass
+    finally:
+        feed.unsubscribe(enqueue)
+    return response
+
+
 async def handle_rest(request):
     name = str(request.match_info.get('name')).lower()
     if name not in ('pib', 'cib'):
@@ -205,7 +367,8 @@ async def handle_rest(request):
     return web.Response(text=text)
 
 
-def init_rest_server(asyncio_loop, profiles_ref, cib_ref, pib_ref, rest_port=None):
+def init_rest_server(asyncio_loop, profiles_ref, cib_ref, pib_ref, rest_port=None, feed_ref=None, stats_ref=None,
+                     profiler_ref=None):
     """ 
     Initialize and register REST server.
     """
@@ -213,18 +376,21 @@ def init_rest_server(asyncio_loop, profiles_ref, cib_ref, pib_ref, rest_port=Non
         logging.info("REST server not available because the aiohttp module is not installed.")
         return
 
-    global pib, cib, profiles, port, server, loop, app
+    global pib, cib, profiles, feed, pm_stats, profiler, port, server, loop, app
 
     loop = asyncio_loop
 
     cib = cib_ref
     pib = pib_ref
     profiles = profiles_ref
+    feed = feed_ref
+    pm_stats = stats_ref
+    profiler = profiler_ref
 
     if rest_port:
         PM.REST_PORT = rest_port
 
-    pmrest = web.Application()
+    pmrest = web.Application(middlewares=[metrics_middleware()])
     app = pmrest
 
     pmrest.router.add_get('/', handle_rest)
@@ -234,9 +400,19 @@ def init_rest_server(asyncio_loop, profiles_ref, cib_ref, pib_ref, rest_port=Non
     pmrest.router.add_get('/pib/{uid}', handle_pib)
 
     pmrest.router.add_get('/cib', handle_cib)
+    pmrest.router.add_get('/cib/stats', handle_cib_stats)
     pmrest.router.add_get('/cib/{uid}', handle_cib)
     pmrest.router.add_get('/cib/rows', handle_cib_rows)
 
+    if feed is not None:
+        pmrest.router.add_get('/feed', handle_feed)
+    if pm_stats is not None:
+        pmrest.router.add_get('/pm/stats', handle_pm_stats)
+    pmrest.router.add_get('/metrics', handle_metrics)
+    if profiler is not None:
+        pmrest.router.add_get('/profile', handle_profile)
+        pmrest.router.add_post('/profile/{action}', handle_profile)
+
     pmrest.router.add_put('/cib/{uid}', handle_cib_put)
     pmrest.router.add_put('/pib/{uid}', handle_pib_put)
 
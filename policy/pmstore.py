@@ -0,0 +1,262 @@
+import abc
+import json
+import logging
+import os
+
+import pmdefaults as PM
+
+
+class StoreError(Exception):
+    pass
+
+
+class Store(abc.ABC):
+    """
+    Persistent storage backend for CIB nodes and PIB policies.
+
+    Entries are JSON compatible dictionaries identified by a name, e.g., the filename of a CIB node. Backends report
+    new, modified and removed entries through changes(), which includes entries written using put().
+    """
+
+    @abc.abstractmethod
+    def changes(self):
+        """Return a dict {name: entry} of new or modified entries and a set of removed names since the last call.
+        Entries which could not be decoded are returned as None."""
+
+    @abc.abstractmethod
+    def put(self, uid, entry):
+        """Store an entry and return its name"""
+
+    @abc.abstractmethod
+    def delete(self, name):
+        """Remove the entry with the given name"""
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class DirectoryStore(Store):
+    """Store each entry as a separate JSON file, e.g., <uid>.cib. Changes are detected using file modification times."""
+
+    def __init__(self, path, extensions, suffix):
+        self.path = path
+        self.extensions = extensions
+        self.suffix = suffix
+        # track file modification times
+        self.files = dict()
+
+    def changes(self):
+        if not os.path.exists(self.path):
+            raise StoreError('directory %s does not exist' % self.path)
+
+        updated = {}
+        full_names = set()
+
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                if not filename.endswith(self.extensions) or filename.startswith(('.', '#')):
+                    continue
+                full_name = os.path.join(dirpath, filename)
+                stat = os.stat(full_name)
+                full_names.add(full_name)
+                if self.files.get(full_name) != stat.st_mtime_ns:
+                    self.files[full_name] = stat.st_mtime_ns
+                    updated[full_name] = self.load(full_name)
+
+        removed = self.files.keys() - full_names
+        for filename in removed:
+            del self.files[filename]
+
+        return updated, removed
+
+    def load(self, filename):
+        try:
+            with open(filename, 'r') as f:
+                return json.load(f)
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            logging.error("Could not read %s: %s" % (filename, e))
+            return None
+
+    def put(self, uid, entry):
+        filename = os.path.join(self.path, '%s%s' % (uid.lower(), self.suffix))
+        with open(filename, 'w') as f:
+            f.write(json.dumps(entry, indent=4, sort_keys=True))
+        return filename
+
+    def delete(self, name):
+        try:
+            os.unlink(name)
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        return 'DirectoryStore<%s>' % self.path
+
+
+class LogStore(Store):
+    """
+    Append-only log containing one JSON record per line, e.g., {"op": "put", "name": "foo", "entry": {...}}.
+
+    Writes are buffered and appended in batches. On startup the log is replayed sequentially. Once the number of
+    superseded records exceeds the number of live entries the log is compacted, i.e., rewritten with the live entries
+    only.
+
+    Compaction replaces the log file, which invalidates the offsets of other processes reading the same log. Readers
+    keep the log open, detect the new file by its inode and replay it from the start, reporting only the entries
+    which differ.
+    """
+
+    def __init__(self, path, batch_size=None, compact_min=None):
+        self.path = path
+        self.batch_size = batch_size or PM.STORE_BATCH_SIZE
+        self.compact_min = compact_min or PM.STORE_COMPACT_MIN
+
+        self.entries = {}
+        self.buffer = []
+        # number of superseded records in the log
+        self.dead = 0
+        self.offset = 0
+        # the log is kept open, so that a log replaced by compaction is detected by its inode
+        self.file = None
+
+        self.updated = {}
+        self.removed = set()
+
+        if not os.path.exists(os.path.dirname(os.path.abspath(path))):
+            raise StoreError('directory for %s does not exist' % path)
+
+        self.replay()
+
+    def replay(self):
+        """Read all records appended to the log since the last replay"""
+        if not os.path.exists(self.path):
+            return
+
+        previous = None
+        if self.file is not None and os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino:
+            # the log was compacted by another process, read the new file from the start
+            self.file.close()
+            self.file = None
+            previous, updated, removed = self.entries, self.updated, self.removed
+            self.entries, self.updated, self.removed = {}, {}, set()
+            self.dead = self.offset = 0
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+
+        self.file.seek(self.offset)
+        for line in self.file:
+            if not line.endswith(b'\n'):
+                # incomplete record
+                break
+            self.offset += len(line)
+            try:
+                record = json.loads(line.decode('utf-8'))
+                self._apply(record['op'], record['name'], record.get('entry'))
+            except (ValueError, KeyError) as e:
+                logging.warning("Skipping invalid record in %s: %s" % (self.path, e))
+
+        if previous is not None:
+            self.updated = {name: entry for name, entry in self.entries.items()
+                            if name in updated or previous.get(name) != entry}
+            self.removed = (removed | previous.keys()) - self.entries.keys()
+
+    def _apply(self, op, name, entry=None):
+        if name in self.entries:
+            self.dead += 1
+
+        if op == 'put':
+            self.entries[name] = entry
+            self.updated[name] = entry
+            self.removed.discard(name)
+        elif op == 'del':
+            self.dead += 1
+            self.entries.pop(name, None)
+            self.updated.pop(name, None)
+            self.removed.add(name)
+
+    def _append(self, op, name, entry=None):
+        record = {'op': op, 'name': name}
+        if entry is not None:
+            record['entry'] = entry
+        self.buffer.append(json.dumps(record, sort_keys=True))
+        self._apply(op, name, entry)
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def changes(self):
+        self.replay()
+        updated, removed = self.updated, self.removed
+        self.updated, self.removed = {}, set()
+        return updated, removed
+
+    def put(self, uid, entry):
+        name = uid.lower()
+        self._append('put', name, entry)
+        return name
+
+    def delete(self, name):
+        if name in self.entries:
+            self._append('del', name)
+
+    def flush(self):
+        if self.buffer:
+            data = ('\n'.join(self.buffer) + '\n').encode('utf-8')
+            with open(self.path, 'ab') as f:
+                f.write(data)
+            self.offset += len(data)
+            self.buffer = []
+
+        if self.dead > max(self.compact_min, len(self.entries)):
+            self.compact()
+
+    def compact(self):
+        """Rewrite the log keeping only the latest record of each live entry"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for name, entry in self.entries.items():
+                record = json.dumps({'op': 'put', 'name': name, 'entry': entry}, sort_keys=True)
+                f.write((record + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            offset = f.tell()
+        os.replace(tmp_path, self.path)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        logging.debug("Compacted %s (%d live entries, %d records dropped)" % (self.path, len(self.entries), self.dead))
+        self.offset = offset
+        self.dead = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __repr__(self):
+        return 'LogStore<%s: %d>' % (self.path, len(self.entries))
+
+
+def open_store(backend, path, extensions, suffix):
+    """Create the storage backend selected by PM.STORE_BACKEND for a CIB or PIB directory"""
+    if backend == 'dir':
+        return DirectoryStore(path, extensions, suffix)
+    elif backend == 'log':
+        log_path = os.path.join(path, '%s.log' % suffix.strip('.'))
+        seed = not os.path.exists(log_path)
+        store = LogStore(log_path)
+        if seed:
+            # import existing entries from the directory layout
+            updated, _ = DirectoryStore(path, extensions, suffix).changes()
+            for filename, entry in updated.items():
+                if entry is not None:
+                    store.put(os.path.splitext(os.path.basename(filename))[0], entry)
+            store.flush()
+        return store
+    else:
+        raise StoreError('unknown storage backend %s' % backend)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3.5
 
 import locale
+import os
 import socket
+import time
 import unittest
 
 from policy import *
@@ -69,6 +71,39 @@ class PropertyTests(unittest.TestCase):
         # np1 should match any property
         self.assertNotEqual(np1 & np2, False)
 
+    def test_prefixes(self):
+        np1 = NEATProperty(('remote_ip', '10.0.0.0/8'), precedence=NEATProperty.IMMUTABLE)
+        np2 = NEATProperty(('remote_ip', '10.54.1.23'), precedence=NEATProperty.IMMUTABLE)
+        np3 = NEATProperty(('remote_ip', '192.168.1.1'), precedence=NEATProperty.IMMUTABLE)
+
+        self.assertTrue(np1 == np2)
+        self.assertFalse(np1 == np3)
+        self.assertTrue(np1 == NEATProperty(('remote_ip', '10.1.0.0/16')))
+
+        # the more specific value is retained
+        np1.update(np2)
+        self.assertEqual(np1.value, '10.54.1.23')
+
+        with self.assertRaises(ImmutablePropertyError):
+            np3.update(NEATProperty(('remote_ip', '10.0.0.0/8'), precedence=NEATProperty.IMMUTABLE))
+
+    def test_prefix_trie(self):
+        from iptrie import PrefixTrie
+
+        trie = PrefixTrie()
+        trie.insert('10.0.0.0/8', 'a')
+        trie.insert('10.54.0.0/16', 'b')
+        trie.insert('192.168.0.0/16', 'c')
+        trie.insert('2001:db8::/32', 'd')
+
+        self.assertEqual(set(trie.covering('10.54.1.23')), {'a', 'b'})
+        self.assertEqual(set(trie.covering('10.1.1.1')), {'a'})
+        self.assertEqual(set(trie.covering('2001:db8::1')), {'d'})
+        self.assertEqual(set(trie.covering('8.8.8.8')), set())
+
+        trie.remove('10.0.0.0/8', 'a')
+        self.assertEqual(set(trie.covering('10.54.1.23')), {'b'})
+
     def test_property_array_creation(self):
         np1 = NEATProperty(("MTU", {"start": 50, "end": 1000}))
         np2 = NEATProperty(("MTU", 10000))
@@ -149,6 +184,949 @@ class PropertyTests(unittest.TestCase):
         print("\n")
 
 
+def gen_test_cib(cib=None):
+    from cib import CIB, CIBNode
+
+    nodes = [
+        {"uid": "eth0", "root": True, "expire": -1,
+         "properties": {"interface": {"value": "eth0", "precedence": 2},
+                        "local_ip": {"value": "10.10.2.1", "precedence": 2}}},
+        {"uid": "eth1", "root": True, "expire": -1,
+         "properties": {"interface": {"value": "eth1", "precedence": 2},
+                        "local_ip": {"value": "10.10.3.1", "precedence": 2}}},
+        {"uid": "eth0_remote_1", "link": True, "expire": -1, "match": [{"uid": {"value": "eth0"}}],
+         "properties": {"remote_ip": {"value": "8.8.8.8", "precedence": 2, "score": 2}}},
+        {"uid": "eth1_remote_1", "link": True, "expire": -1, "match": [{"uid": {"value": "eth1"}}],
+         "properties": {"remote_ip": {"value": "8.8.4.4", "precedence": 2, "score": 1}}},
+    ]
+
+    if cib is None:
+        cib = CIB()
+    for n in nodes:
+        cib.register(CIBNode(n))
+    cib.update_graph()
+    return cib
+
+
+class CIBTests(unittest.TestCase):
+
+    def test_row_index(self):
+        cib = gen_test_cib()
+        self.assertEqual(len(cib.rows), 2)
+
+        idx = cib.index
+        self.assertEqual(len(idx.postings('remote_ip', '8.8.8.8')), 1)
+        self.assertEqual(len(idx.postings('remote_ip', '1.2.3.4')), 0)
+
+    def test_extenders(self):
+        from cib import CIBNode
+
+        cib = gen_test_cib()
+        cib.register(CIBNode({"uid": "dns", "expire": -1, "match": [{"remote_ip": {"value": "8.8.8.8"}}],
+                              "properties": [[{"transport": {"value": "TCP"}}, {"transport": {"value": "UDP"}}]]}))
+        cib.register(CIBNode({"uid": "local", "expire": -1, "match": [{"local_ip": {"value": "10.10.0.0/16"}}],
+                              "properties": {"local": {"value": True}}}))
+        cib.register(CIBNode({"uid": "unmatched", "expire": -1, "match": [{"interface": {"value": "eth2"}}],
+                              "properties": {"foo": {"value": 1}}}))
+        cib.update_graph()
+
+        self.assertEqual(len(cib.extender_index), 5)
+        uids = sorted(r.meta['cib_uids'] for r in cib.rows)
+        self.assertEqual(uids, ['eth0<<eth0_remote_1', 'eth0<<eth0_remote_1<<dns', 'eth0<<eth0_remote_1<<dns',
+                                'eth0<<eth0_remote_1<<local', 'eth1<<eth1_remote_1', 'eth1<<eth1_remote_1<<local'])
+        self.assertEqual({r['transport'].value for r in cib.rows if 'transport' in r}, {'TCP', 'UDP'})
+
+    def test_resolve_paths(self):
+        import pmdefaults as PM
+        from cib import CIB
+
+        cib = CIB()
+        cib.graph = {'r': ['a', 'b'], 'a': ['c'], 'b': ['c', 'a'], 'c': ['d', 'e']}
+        self.assertEqual(sorted(cib.resolve_paths('r')),
+                         [('r', 'a', 'c', 'd'), ('r', 'a', 'c', 'e'), ('r', 'b', 'a', 'c', 'd'), ('r', 'b', 'a', 'c', 'e'),
+                          ('r', 'b', 'c', 'd'), ('r', 'b', 'c', 'e')])
+
+        max_paths = PM.CIB_MAX_PATHS
+        PM.CIB_MAX_PATHS = 3
+        try:
+            cib.invalidate()
+            self.assertEqual(len(cib.resolve_paths('r')), 3)
+        finally:
+            PM.CIB_MAX_PATHS = max_paths
+
+    def test_lookup_immutable(self):
+        cib = gen_test_cib()
+
+        request = PropertyArray(NEATProperty(('remote_ip', '8.8.8.8'), precedence=NEATProperty.IMMUTABLE))
+        candidates = cib.lookup(request)
+        self.assertEqual(len(candidates), 2)
+        self.assertEqual(candidates[0]['interface'].value, 'eth0')
+
+        request = PropertyArray(NEATProperty(('remote_ip', '1.2.3.4'), precedence=NEATProperty.IMMUTABLE))
+        self.assertEqual(len(cib.lookup(request)), 1)
+
+        # optional properties do not restrict the matched rows
+        request = PropertyArray(NEATProperty(('remote_ip', '1.2.3.4'), precedence=NEATProperty.OPTIONAL))
+        self.assertEqual(len(cib.lookup(request)), 3)
+
+    def test_lookup_top_k(self):
+        cib = gen_test_cib()
+
+        request = PropertyArray(NEATProperty(('remote_ip', '8.8.4.4')))
+        candidates = cib.lookup(request, candidate_num=3)
+        self.assertEqual([c.get('interface') and c['interface'].value for c in candidates], ['eth0', 'eth1', None])
+
+        # rows which cannot beat the best candidate are not merged
+        candidates = cib.lookup(request, candidate_num=1)
+        self.assertEqual(candidates[0]['interface'].value, 'eth0')
+        self.assertEqual(cib.stats['pruned'], 1)
+
+    def test_compiled_query(self):
+        cib = gen_test_cib()
+
+        request = PropertyArray(NEATProperty(('remote_ip', '8.8.8.8'), precedence=NEATProperty.IMMUTABLE),
+                                NEATProperty(('local_ip', '10.10.0.0/16'), precedence=NEATProperty.IMMUTABLE),
+                                NEATProperty(('transport', 'TCP')))
+        query = cib.compile_query(request)
+        self.assertEqual(query.keys, {'remote_ip', 'local_ip'})
+        self.assertEqual([r['interface'].value for r in cib.rows if query.matches(r)], ['eth0'])
+
+        # profile variants which only differ in their optional properties share the compiled query
+        variant = PropertyArray(NEATProperty(('remote_ip', '8.8.8.8'), precedence=NEATProperty.IMMUTABLE),
+                                NEATProperty(('local_ip', '10.10.0.0/16'), precedence=NEATProperty.IMMUTABLE),
+                                NEATProperty(('transport', 'SCTP')))
+        self.assertIs(cib.compile_query(variant), query)
+        self.assertEqual(len(cib.lookup(variant)), 2)
+
+    def test_sharded_lookup(self):
+        from cibshard import ShardedCIB
+
+        cib = gen_test_cib()
+        sharded = gen_test_cib(ShardedCIB(shards=3))
+        try:
+            self.assertEqual(len(set(sharded.owners.values())), 2)
+            for remote_ip in ['8.8.8.8', '8.8.4.4', '1.2.3.4']:
+                for precedence in [NEATProperty.OPTIONAL, NEATProperty.IMMUTABLE]:
+                    request = PropertyArray(NEATProperty(('remote_ip', remote_ip), precedence=precedence))
+                    self.assertEqual([str(c) for c in sharded.lookup(request)], [str(c) for c in cib.lookup(request)])
+
+            sharded.evict(['eth0_remote_1'])
+            request = PropertyArray(NEATProperty(('remote_ip', '8.8.8.8'), precedence=NEATProperty.IMMUTABLE))
+            self.assertEqual(len(sharded.lookup(request)), 1)
+
+            # a failed shard is not used anymore, the remaining shards are drained
+            sharded.workers[1].terminate()
+            sharded.workers[1].join()
+            self.assertEqual(len(sharded.lookup(request)), 1)
+            self.assertEqual(sharded.dead, {1})
+            self.assertFalse(any(sharded.conns[i].poll() for i in (0, 2)))
+            self.assertEqual(len(sharded.lookup(request)), 1)
+        finally:
+            sharded.close()
+
+    def test_sharded_lookup_failure(self):
+        from cib import CIB
+        from cibshard import ShardedCIB
+
+        pid = os.getpid()
+        top_candidates = CIB.top_candidates
+
+        def failing_top_candidates(self, input_properties, candidate_num=5):
+            if os.getpid() != pid and 'fail' in input_properties:
+                raise ValueError('shard lookup failed')
+            return top_candidates(self, input_properties, candidate_num)
+
+        cib = gen_test_cib()
+        # the shards are forked with the failing lookup
+        CIB.top_candidates = failing_top_candidates
+        try:
+            sharded = gen_test_cib(ShardedCIB(shards=2))
+        finally:
+            CIB.top_candidates = top_candidates
+        try:
+            request = PropertyArray(NEATProperty(('remote_ip', '8.8.8.8'), precedence=NEATProperty.IMMUTABLE),
+                                    NEATProperty(('fail', True)))
+            self.assertEqual([str(c) for c in sharded.lookup(request)], [str(c) for c in cib.lookup(request)])
+            # shards whose lookup failed are still used
+            self.assertEqual(sharded.dead, set())
+            request = PropertyArray(NEATProperty(('remote_ip', '8.8.8.8'), precedence=NEATProperty.IMMUTABLE))
+            self.assertEqual([str(c) for c in sharded.lookup(request)], [str(c) for c in cib.lookup(request)])
+        finally:
+            sharded.close()
+
+    def test_stream_ingestion(self):
+        import asyncio
+        import json
+        import pmdefaults as PM
+        import tempfile
+        from cib import CIB
+        from cibstream import CIBStreamProtocol
+
+        class Transport(object):
+            def __init__(self):
+                self.data = b''
+                self.paused = []
+                self.closed = False
+
+            def write(self, data):
+                self.data += data
+
+            def is_closing(self):
+                return self.closed
+
+            def close(self):
+                self.closed = True
+
+            def pause_reading(self):
+                self.paused.append(True)
+
+            def resume_reading(self):
+                self.paused.append(False)
+
+        with tempfile.TemporaryDirectory() as cib_dir:
+            cib = CIB(cib_dir)
+            transport = Transport()
+            protocol = CIBStreamProtocol(cib)
+            protocol.connection_made(transport)
+
+            nodes = [{"uid": "eth%d" % i, "root": True, "expire": -1,
+                      "properties": {"interface": {"value": "eth%d" % i}}} for i in range(3)]
+            data = ('\n'.join(json.dumps(n) for n in nodes[:2]) + '\n{invalid}\n' + json.dumps(nodes[2])).encode()
+            # split a line across two chunks
+            protocol.data_received(data[:30])
+            protocol.data_received(data[30:])
+            self.assertEqual(sorted(cib.nodes), ['eth0', 'eth1'])
+            self.assertTrue(protocol.eof_received())
+            self.assertEqual(sorted(cib.nodes), ['eth0', 'eth1', 'eth2'])
+            self.assertTrue(transport.closed)
+            self.assertEqual(transport.paused, [])
+            replies = [json.loads(l) for l in transport.data.decode().splitlines()]
+            self.assertEqual(replies[0]['line'], 3)
+            self.assertEqual(replies[1:], [{'ack': 3, 'stored': 2, 'errors': 1}, {'ack': 4, 'stored': 3, 'errors': 1}])
+
+            # reading is paused until all nodes of a chunk are applied
+            transport = Transport()
+            protocol = CIBStreamProtocol(cib)
+            protocol.connection_made(transport)
+            nodes = [{"uid": "eth%d" % i, "root": True, "expire": -1,
+                      "properties": {"interface": {"value": "eth%d" % i}}} for i in range(3, 8)]
+            batch = PM.CIB_STREAM_BATCH
+            PM.CIB_STREAM_BATCH = 2
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                protocol.data_received(('\n'.join(json.dumps(n) for n in nodes) + '\n').encode())
+                self.assertEqual(len(cib.nodes), 5)
+                self.assertEqual(transport.paused, [True])
+                loop.run_until_complete(asyncio.sleep(0.01))
+            finally:
+                PM.CIB_STREAM_BATCH = batch
+                loop.close()
+            self.assertEqual(len(cib.nodes), 8)
+            self.assertEqual(transport.paused, [True, False])
+            self.assertEqual(json.loads(transport.data), {'ack': 5, 'stored': 5, 'errors': 0})
+            self.assertEqual(sorted(cib.store.changes()[0])[-1], os.path.join(cib_dir, 'eth7.cib'))
+
+    def test_incremental_load(self):
+        import tempfile
+        from cib import CIB
+
+        with tempfile.TemporaryDirectory() as cib_dir:
+            cib = CIB(cib_dir)
+            for node in gen_test_cib().nodes.values():
+                cib.import_node(node.dict())
+            cib.store.flush()
+            cib.reload_files()
+
+            loaded = CIB(cib_dir, load=False)
+            self.assertEqual(len(loaded.nodes), 0)
+            self.assertEqual(sum(1 for _ in loaded.iter_load()), 4)
+            self.assertEqual(sorted(r.meta['cib_uids'] for r in loaded.rows),
+                             sorted(r.meta['cib_uids'] for r in cib.rows))
+
+    def test_lookup_prefix(self):
+        from cib import CIBNode
+
+        cib = gen_test_cib()
+        cib.register(CIBNode({"uid": "eth1_remote_2", "link": True, "expire": -1, "match": [{"uid": {"value": "eth1"}}],
+                              "properties": {"remote_ip": {"value": "10.0.0.0/8", "precedence": 2}}}))
+        cib.update_graph()
+
+        request = PropertyArray(NEATProperty(('remote_ip', '10.54.1.23'), precedence=NEATProperty.IMMUTABLE))
+        candidates = cib.lookup(request)
+        self.assertEqual(len(candidates), 2)
+        self.assertEqual(candidates[1]['interface'].value, 'eth1')
+        self.assertEqual(candidates[1]['remote_ip'].value, '10.54.1.23')
+
+    def test_expire_nodes(self):
+        import time
+        from cib import CIBNode
+
+        cib = gen_test_cib()
+        cib.register(CIBNode({"uid": "eth0_remote_2", "link": True, "expire": time.time() + 60,
+                              "match": [{"uid": {"value": "eth0"}}],
+                              "properties": {"remote_ip": {"value": "8.8.4.4", "precedence": 2}}}))
+        cib.update_graph()
+        self.assertEqual(len(cib.rows), 3)
+        eth1_rows = [r for r in cib.rows if r.cib_node == 'eth1']
+
+        self.assertEqual(cib.expire_nodes(), [])
+        self.assertEqual(cib.expire_nodes(now=time.time() + 120), ['eth0_remote_2'])
+        self.assertNotIn('eth0_remote_2', cib.nodes)
+        self.assertEqual(cib.stats['expired'], 1)
+        self.assertEqual(len(cib.rows), 2)
+
+        # rows of unaffected root nodes are not regenerated
+        self.assertIs([r for r in cib.rows if r.cib_node == 'eth1'][0], eth1_rows[0])
+
+    def test_expiry_timer(self):
+        import asyncio
+        import time
+        from cib import CIBNode
+
+        cib = gen_test_cib()
+        loop = asyncio.new_event_loop()
+        cib.start_expiry_timer(loop)
+        cib.register(CIBNode({"uid": "eth0_remote_2", "link": True, "expire": time.time() + 0.05,
+                              "match": [{"uid": {"value": "eth0"}}],
+                              "properties": {"remote_ip": {"value": "8.8.4.4", "precedence": 2}}}))
+        loop.run_until_complete(asyncio.sleep(0.2))
+        loop.close()
+        self.assertNotIn('eth0_remote_2', cib.nodes)
+
+    def test_cache(self):
+        import pmdefaults as PM
+        from cibcache import CIBCache
+
+        def he_result(remote_ip, transport, success=True):
+            return json.dumps([{"match": [{"interface": {"value": "eth0"}}], "link": True,
+                                "properties": {"transport": {"value": transport}, "remote_ip": {"value": remote_ip},
+                                               "port": {"value": 80}, "__cached": {"value": True},
+                                               "__he_candidate_success": {"value": success}}}])
+
+        PM.CIB_CACHE = True
+        cib = gen_test_cib()
+        cib.cache = CIBCache(cib, max_entries=2)
+        # cache nodes are not written to the CIB directory
+        cib.cib_dir = None
+
+        cib.import_json(he_result('1.1.1.1', 'TCP'))
+        cib.import_json(he_result('1.1.1.1', 'SCTP'))
+        self.assertEqual(len(cib.cache), 2)
+        self.assertEqual(len(cib.rows), 4)
+
+        # newer results for the same destination replace older ones
+        cib.import_json(he_result('1.1.1.1', 'TCP', success=False))
+        self.assertEqual(len(cib.cache), 2)
+        self.assertEqual(cib.cache.stats()['replaced'], 1)
+        self.assertEqual(len(cib.nodes), 6)
+
+        # least recently used entries are evicted
+        cib.import_json(he_result('2.2.2.2', 'TCP'))
+        self.assertEqual(len(cib.cache), 2)
+        self.assertEqual(cib.cache.stats()['evicted_lru'], 1)
+        self.assertEqual(len(cib.nodes), 6)
+        self.assertEqual(len(cib.rows), 4)
+
+        # expired cache entries are removed from the CIB
+        cib.expire_nodes(now=time.time() + PM.CIB_CACHE_TTL + 1)
+        self.assertEqual(len(cib.cache), 0)
+        self.assertEqual(cib.cache.stats()['evicted_ttl'], 2)
+        self.assertEqual(len(cib.rows), 2)
+
+
+class PIBTests(unittest.TestCase):
+
+    def test_lookup_prefix(self):
+        import tempfile
+        from pib import PIB, NEATPolicy
+
+        with tempfile.TemporaryDirectory() as policy_dir:
+            pib = PIB(policy_dir)
+            pib.register(NEATPolicy({"uid": "private", "priority": 1,
+                                     "match": {"remote_ip": {"value": "10.0.0.0/8"}},
+                                     "properties": {"private": {"value": True}}}))
+            pib.register(NEATPolicy({"uid": "private_16", "priority": 2,
+                                     "match": {"remote_ip": {"value": "10.54.0.0/16"}},
+                                     "properties": {"local": {"value": True}}}))
+
+            candidate = pib.lookup(PropertyArray(NEATProperty(('remote_ip', '10.54.1.23'))))[0]
+            self.assertIn('private', candidate)
+            self.assertIn('local', candidate)
+
+            candidate = pib.lookup(PropertyArray(NEATProperty(('remote_ip', '10.1.1.1'))))[0]
+            self.assertIn('private', candidate)
+            self.assertNotIn('local', candidate)
+
+            candidate = pib.lookup(PropertyArray(NEATProperty(('remote_ip', '8.8.8.8'))))[0]
+            self.assertNotIn('private', candidate)
+
+    def test_unregister(self):
+        import tempfile
+        from pib import PIB, NEATPolicy
+
+        with tempfile.TemporaryDirectory() as policy_dir:
+            pib = PIB(policy_dir)
+            for uid, priority in [('a', 2), ('b', 3), ('c', 1)]:
+                pib.register(NEATPolicy({"uid": uid, "priority": priority, "properties": {uid: {"value": True}}}))
+
+            pib.unregister('a')
+            self.assertEqual([p.uid for p in pib.policies], ['c', 'b'])
+            self.assertEqual(pib.index['b'].uid, 'b')
+
+
+class FeedTests(unittest.TestCase):
+
+    def test_cib_events(self):
+        from cib import CIBNode
+        from pmfeed import ChangeFeed
+
+        feed = ChangeFeed(max_events=5)
+        cib = gen_test_cib()
+        feed.watch(cib, 'cib')
+
+        node = {"uid": "eth0_remote_2", "link": True, "expire": -1, "match": [{"uid": {"value": "eth0"}}],
+                "properties": {"remote_ip": {"value": "1.1.1.1", "precedence": 2}}}
+        cib.add_node(CIBNode(node))
+        cib.add_node(CIBNode(node))
+        cib.evict(['eth0_remote_2'])
+        cib.add_node(CIBNode(dict(node, expire=time.time() + 10)))
+        cib.expire_nodes(now=time.time() + 20)
+
+        events = feed.since(0)
+        self.assertEqual([e['event'] for e in events], ['added', 'changed', 'removed', 'added', 'expired'])
+        self.assertEqual(events[0]['entry']['uid'], 'eth0_remote_2')
+        self.assertEqual([e['version'] for e in feed.since(3)], [4, 5])
+        self.assertEqual(feed.since(5), [])
+
+        cib.unregister('eth1_remote_1')
+        # the oldest event is no longer available
+        self.assertIsNone(feed.since(0))
+        self.assertEqual(feed.since(1)[-1]['event'], 'removed')
+
+    def test_feed_socket(self):
+        import asyncio
+        import json
+        import tempfile
+        from pmfeed import ChangeFeed, FeedProtocol
+
+        feed = ChangeFeed()
+        feed.publish('pib', 'registered', 'a', {'uid': 'a'})
+        loop = asyncio.new_event_loop()
+
+        async def consume(path):
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(b'0\n')
+            first = json.loads((await reader.readline()).decode())
+            feed.publish('pib', 'unregistered', 'a')
+            second = json.loads((await reader.readline()).decode())
+            writer.close()
+            return first, second
+
+        protocols = []
+
+        def factory():
+            protocols.append(FeedProtocol(feed))
+            return protocols[-1]
+
+        with tempfile.TemporaryDirectory() as sock_dir:
+            path = os.path.join(sock_dir, 'feed')
+            server = loop.run_until_complete(loop.create_unix_server(factory, path))
+            try:
+                first, second = loop.run_until_complete(asyncio.wait_for(consume(path), 5))
+            finally:
+                # the feed keeps streaming to clients which closed their sending side
+                for protocol in protocols:
+                    protocol.transport.close()
+                server.close()
+                loop.run_until_complete(server.wait_closed())
+                loop.close()
+
+        self.assertEqual((first['version'], first['event']), (1, 'registered'))
+        self.assertEqual((second['version'], second['event']), (2, 'unregistered'))
+
+
+class PoolTests(unittest.TestCase):
+
+    def test_request_pool(self):
+        import asyncio
+        from cib import CIBNode
+        from pmpool import RequestPool
+
+        cib = gen_test_cib()
+
+        def handler(request, emit=None):
+            # runs in a worker process on the replica of the CIB
+            request = PropertyArray(NEATProperty(('remote_ip', request), precedence=NEATProperty.IMMUTABLE))
+            interfaces = [c['interface'].value for c in cib.lookup(request) if 'interface' in c]
+            if emit is not None:
+                for i in interfaces:
+                    emit([i])
+            return interfaces
+
+        loop = asyncio.new_event_loop()
+        pool = RequestPool(handler, {'cib': cib}, workers=2, loop=loop)
+        try:
+            self.assertEqual(loop.run_until_complete(pool.submit('8.8.8.8')), ['eth0'])
+
+            # changes made after the workers were started are replayed to the replicas
+            cib.add_node(CIBNode({"uid": "eth1_remote_2", "link": True, "expire": -1,
+                                  "match": [{"uid": {"value": "eth1"}}],
+                                  "properties": {"remote_ip": {"value": "8.8.8.8", "precedence": 2, "score": 1}}}))
+            cib.evict(['eth0_remote_1'])
+            replies = loop.run_until_complete(asyncio.gather(*(pool.submit('8.8.8.8') for _ in range(4))))
+            self.assertEqual(replies, [['eth1']] * 4)
+            self.assertEqual(pool.stats['changes'], 2)
+
+            # partial replies are passed on before the request completes
+            partials = []
+            future = pool.submit('8.8.8.8', on_partial=partials.append)
+            future.add_done_callback(lambda f: partials.append(f.result()))
+            loop.run_until_complete(future)
+            self.assertEqual(partials, [['eth1'], ['eth1']])
+            self.assertFalse(pool.partials)
+
+            # requests exceeding the pipe capacity are written without blocking the event loop
+            future = pool.submit('1.2.3.4' * 100000)
+            self.assertTrue(any(pipe.buffer for pipe in pool.conns.values()))
+            self.assertEqual(loop.run_until_complete(future), [])
+        finally:
+            pool.close()
+            loop.close()
+
+    def test_prefork_server(self):
+        import asyncio
+        import json
+        import tempfile
+        from cib import CIBNode
+        from pmprefork import PreforkServer
+
+        cib = gen_test_cib()
+
+        class LookupProtocol(asyncio.Protocol):
+            # runs in a worker process on the replica of the CIB
+            def connection_made(self, transport):
+                self.transport = transport
+                self.data = b''
+
+            def data_received(self, data):
+                self.data += data
+
+            def eof_received(self):
+                request = PropertyArray(NEATProperty(('remote_ip', self.data.decode()),
+                                                     precedence=NEATProperty.IMMUTABLE))
+                interfaces = [c['interface'].value for c in cib.lookup(request) if 'interface' in c]
+                self.transport.write(json.dumps([os.getpid(), interfaces]).encode())
+                self.transport.close()
+
+        async def query(path):
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(b'8.8.8.8')
+            writer.write_eof()
+            reply = json.loads((await reader.read()).decode())
+            writer.close()
+            return reply
+
+        async def queries(path, n=8):
+            return await asyncio.gather(*(query(path) for _ in range(n)))
+
+        with tempfile.TemporaryDirectory() as sock_dir:
+            path = os.path.join(sock_dir, 'pm_socket')
+            loop = asyncio.new_event_loop()
+            server = PreforkServer(path, LookupProtocol, {'cib': cib}, workers=2, loop=loop)
+            try:
+                replies = loop.run_until_complete(queries(path))
+                self.assertEqual({tuple(r[1]) for r in replies}, {('eth0',)})
+                self.assertNotIn(os.getpid(), [r[0] for r in replies])
+
+                # changes made in the writer process are pushed to all workers
+                cib.add_node(CIBNode({"uid": "eth1_remote_2", "link": True, "expire": -1,
+                                      "match": [{"uid": {"value": "eth1"}}],
+                                      "properties": {"remote_ip": {"value": "8.8.8.8", "precedence": 2, "score": 1}}}))
+                cib.evict(['eth0_remote_1'])
+                self.assertEqual(server.stats['changes'], 2)
+                deadline = time.time() + 5
+                while time.time() < deadline:
+                    replies = loop.run_until_complete(queries(path))
+                    if {tuple(r[1]) for r in replies} == {('eth1',)}:
+                        break
+                self.assertEqual({tuple(r[1]) for r in replies}, {('eth1',)})
+            finally:
+                server.close()
+                loop.close()
+
+
+    def test_coalescer(self):
+        import asyncio
+        from pmpool import RequestCoalescer
+
+        loop = asyncio.new_event_loop()
+        coalescer = RequestCoalescer()
+        started = []
+
+        def start():
+            started.append(loop.create_future())
+            return started[-1]
+
+        try:
+            first = coalescer.submit('a', start)
+            self.assertIs(coalescer.submit('a', start), first)
+            self.assertIsNot(coalescer.submit('b', start), first)
+            self.assertEqual(len(started), 2)
+
+            first.set_result(b'[]')
+            loop.run_until_complete(first)
+            # completed computations are not shared with later requests
+            coalescer.submit('a', start)
+            self.assertEqual(len(started), 3)
+            self.assertEqual(coalescer.stats, {'requests': 4, 'coalesced': 1})
+        finally:
+            loop.close()
+
+
+    def test_admission_queue(self):
+        import asyncio
+        from pmpool import AdmissionQueue
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        admission = AdmissionQueue(max_size=3, max_age=1.0, in_flight=1)
+        started = []
+        shed = []
+        pending = []
+
+        def request(name, arrived=None):
+            admission.submit(lambda done: (started.append(name), pending.append(done)),
+                             lambda reason: shed.append((name, reason)), arrived)
+
+        try:
+            request('a')
+            # waited longer than max_age before it could be started
+            request('stale', time.monotonic() - 2)
+            request('b')
+            request('full')
+            self.assertEqual(shed, [('full', 'full')])
+
+            loop.run_until_complete(asyncio.sleep(0.01))
+            # only a single request is processed at a time
+            self.assertEqual(started, ['a'])
+            pending.pop()()
+            loop.run_until_complete(asyncio.sleep(0.01))
+            self.assertEqual(started, ['a', 'b'])
+            self.assertEqual(shed, [('full', 'full'), ('stale', 'stale')])
+            self.assertEqual(admission.stats, {'admitted': 2, 'shed_full': 1, 'shed_stale': 1, 'max_depth': 3})
+            self.assertEqual(len(admission), 0)
+
+            # the slot of a request which failed to start is released
+            def fail(done):
+                raise ValueError('invalid request')
+
+            pending.pop()()
+            admission.submit(fail, shed.append)
+            request('c')
+            with self.assertLogs(level='ERROR'):
+                loop.run_until_complete(asyncio.sleep(0.01))
+            self.assertEqual(started, ['a', 'b', 'c'])
+            self.assertEqual(admission.active, 1)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+class CandidateCacheTests(unittest.TestCase):
+
+    def test_invalidation(self):
+        import tempfile
+        from cib import CIBNode
+        from pib import PIB, NEATPolicy
+        from pmcache import CandidateCache
+
+        cib = gen_test_cib()
+        with tempfile.TemporaryDirectory() as policy_dir:
+            pib = PIB(policy_dir)
+            profiles = PIB(policy_dir, file_extension='.profile')
+            pib.register(NEATPolicy({"uid": "p", "properties": {"p": {"value": True}}}))
+            cache = CandidateCache(cib, pib, profiles)
+
+            def put(remote_ip):
+                request = PropertyArray(NEATProperty(('remote_ip', remote_ip), precedence=NEATProperty.IMMUTABLE))
+                uids = {c.meta['cib_uids'] for c in cib.lookup(request) if 'cib_uids' in c.meta}
+                dependencies = {('cib', uid) for u in uids for uid in u.split('<<')} | {('pib', 'p')}
+                cache.put(remote_ip, remote_ip.encode(), dependencies, [cib.compile_query(request)])
+
+            def remote_node(uid, root, remote_ip):
+                return CIBNode({"uid": uid, "link": True, "expire": -1, "match": [{"uid": {"value": root}}],
+                                "properties": {"remote_ip": {"value": remote_ip, "precedence": 2}}})
+
+            put('8.8.8.8')
+            put('8.8.4.4')
+            self.assertEqual(cache.get('8.8.8.8'), b'8.8.8.8')
+
+            # changes of CIB nodes only invalidate the entries which used them
+            cib.evict(['eth1_remote_1'])
+            self.assertIsNone(cache.get('8.8.4.4'))
+            self.assertEqual(cache.get('8.8.8.8'), b'8.8.8.8')
+
+            # new CIB nodes invalidate the entries for which they generate new candidates
+            cib.add_node(remote_node('eth1_remote_2', 'eth1', '1.1.1.1'))
+            self.assertEqual(cache.get('8.8.8.8'), b'8.8.8.8')
+            cib.add_node(remote_node('eth1_remote_3', 'eth1', '8.8.8.8'))
+            self.assertIsNone(cache.get('8.8.8.8'))
+
+            put('8.8.8.8')
+            pib.unregister('p')
+            self.assertIsNone(cache.get('8.8.8.8'))
+
+            put('8.8.8.8')
+            profiles.register(NEATPolicy({"uid": "profile", "properties": {"q": {"value": True}}}))
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(cache.stats['cleared'], 1)
+
+
+class OutputTests(unittest.TestCase):
+
+    def test_production_mode(self):
+        import contextlib
+        import io
+        from pmoutput import Output
+
+        output = Output('production', sample_rate=0.5)
+        candidates = [PropertyArray(NEATProperty(('transport', 'TCP'), score=2))]
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), self.assertLogs(level='INFO') as logs:
+            output.console('%s', candidates[0])
+            output.separator('Top 1')
+            for _ in range(4):
+                output.summary(1, candidates, time.perf_counter())
+            # cached replies are counted as well
+            for _ in range(2):
+                output.summary(1, None, time.perf_counter(), cached=True)
+        self.assertEqual(stdout.getvalue(), '')
+        # every second request is summarized
+        self.assertEqual(len(logs.output), 3)
+        self.assertIn('best score 0|2', logs.output[0])
+        self.assertIn('request 6: 1 requests, cached candidates', logs.output[2])
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_prometheus_text(self):
+        from pmmetrics import Metrics
+
+        metrics = Metrics(buckets=(0.001, 0.01))
+        metrics.describe('neat_pm_stage_seconds', 'histogram', 'Stage latency.')
+        metrics.describe('neat_pm_requests_total', 'counter', 'Requests.')
+        metrics.observe('neat_pm_stage_seconds', 0.0005, stage='cib_lookup')
+        with metrics.time('neat_pm_stage_seconds', stage='pib_lookup'):
+            pass
+        metrics.inc('neat_pm_requests_total')
+        metrics.set('neat_pm_queue_depth', 4)
+
+        # samples of a worker process are added to the main process
+        worker = Metrics(buckets=(0.001, 0.01))
+        worker.observe('neat_pm_stage_seconds', 0.005, stage='cib_lookup')
+        worker.inc('neat_pm_requests_total', 2)
+        metrics.merge(worker.drain())
+        self.assertFalse(worker.counters)
+
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE neat_pm_stage_seconds histogram', lines)
+        self.assertIn('neat_pm_stage_seconds_bucket{stage="cib_lookup",le="0.001"} 1', lines)
+        self.assertIn('neat_pm_stage_seconds_bucket{stage="cib_lookup",le="0.01"} 2', lines)
+        self.assertIn('neat_pm_stage_seconds_bucket{stage="cib_lookup",le="+Inf"} 2', lines)
+        self.assertIn('neat_pm_stage_seconds_count{stage="pib_lookup"} 1', lines)
+        self.assertIn('neat_pm_requests_total 3', lines)
+        self.assertIn('neat_pm_queue_depth 4', lines)
+
+
+class ProfilerTests(unittest.TestCase):
+
+    def test_profiles(self):
+        import tempfile
+        from pmprofile import Profiler
+
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = Profiler(tmp)
+            profiler.profile_requests(2)
+            for i in range(3):
+                self.assertEqual(profiler.call(sorted, [i, 1]), sorted([i, 1]))
+            self.assertFalse(profiler.profiling)
+            self.assertEqual(profiler.profiled, 2)
+
+            # the first snapshot starts tracing memory allocations
+            self.assertIsNone(profiler.snapshot_memory())
+            try:
+                self.assertTrue(profiler.snapshot_memory())
+            finally:
+                profiler.stop_memory()
+
+            self.assertTrue(profiler.sample_stacks(duration=0.05, interval=0.01))
+            profiler.sampler.join()
+
+            files = sorted(os.listdir(tmp))
+            self.assertEqual([f.split('-')[0] for f in files], ['memory', 'requests', 'requests', 'stacks'])
+            self.assertEqual(len(profiler.files), 3)
+
+
+class StoreTests(unittest.TestCase):
+
+    def test_log_store(self):
+        import tempfile
+        from pmstore import LogStore, Store
+
+        self.assertRaises(TypeError, Store)
+        with tempfile.TemporaryDirectory() as cib_dir:
+            path = os.path.join(cib_dir, 'cib.log')
+            store = LogStore(path, batch_size=2, compact_min=2)
+            store.put('A', {'uid': 'a', 'expire': 1})
+            self.assertFalse(os.path.exists(path))
+            store.put('b', {'uid': 'b'})
+            store.put('a', {'uid': 'a', 'expire': 2})
+            store.delete('b')
+            store.flush()
+            updated, removed = store.changes()
+            self.assertEqual(updated, {'a': {'uid': 'a', 'expire': 2}})
+            self.assertEqual(removed, {'b'})
+
+            # replay from disk
+            replica = LogStore(path)
+            self.assertEqual(replica.changes(), ({'a': {'uid': 'a', 'expire': 2}}, set()))
+            store.put('c', {'uid': 'c'})
+            store.flush()
+            updated, removed = replica.changes()
+            self.assertEqual(set(updated), {'c'})
+
+            # superseded records are dropped during compaction
+            for i in range(5):
+                store.put('a', {'uid': 'a', 'expire': i})
+            store.flush()
+            with open(path) as f:
+                self.assertLessEqual(len(f.readlines()), 4)
+            self.assertEqual(LogStore(path).entries['a'], {'uid': 'a', 'expire': 4})
+
+            # other readers reopen the compacted log
+            store.delete('c')
+            store.flush()
+            self.assertEqual(replica.changes(), ({'a': {'uid': 'a', 'expire': 4}}, {'c'}))
+            self.assertEqual(replica.entries, store.entries)
+
+
+class PMSocketTests(unittest.TestCase):
+    """Requests sent to a neatpmd process started with the test CIB"""
+
+    @classmethod
+    def setUpClass(cls):
+        import json
+        import pmdefaults as PM
+        import shutil
+        import subprocess
+        import sys
+        import tempfile
+
+        policy_dir = os.path.dirname(os.path.abspath(__file__))
+        cls.tmp = tempfile.TemporaryDirectory()
+        cib_dir, pib_dir, sock_dir = [os.path.join(cls.tmp.name, d) for d in ('cib', 'pib', 'sock')]
+        shutil.copytree(os.path.join(policy_dir, PM.PIB_DIR), pib_dir)
+        for path in (cib_dir, sock_dir):
+            os.mkdir(path)
+        for node in gen_test_cib().nodes.values():
+            with open(os.path.join(cib_dir, node.uid + '.cib'), 'w') as f:
+                json.dump(node.dict(), f)
+
+        cls.sock = os.path.join(sock_dir, 'neat_pm_socket')
+        cls.pm = subprocess.Popen([sys.executable, 'neatpmd', '--sock', sock_dir, '--cib', cib_dir, '--pib', pib_dir],
+                                  cwd=policy_dir, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL, env=dict(os.environ, HOME=cls.tmp.name))
+        deadline = time.time() + 10
+        while not os.path.exists(os.path.join(sock_dir, 'neat_pm_ready')):
+            if cls.pm.poll() is not None or time.time() > deadline:
+                cls.tearDownClass()
+                raise unittest.SkipTest('neatpmd did not start')
+            time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pm.terminate()
+        cls.pm.wait()
+        cls.tmp.cleanup()
+
+    def send(self, data):
+        """Send data to the PM socket and return the reply once the PM closed the connection"""
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(2)
+        s.connect(self.sock)
+        s.sendall(data)
+        s.shutdown(socket.SHUT_WR)
+        reply = b''
+        try:
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                reply += chunk
+        finally:
+            s.close()
+        return reply.decode('utf-8')
+
+    def test_framed_requests(self):
+        import json
+
+        request = [{"remote_ip": {"value": "8.8.8.8", "precedence": 2}}]
+        frames = [{"id": 1, "request": request}, {"id": 2, "request": request, "stream": False}]
+        data = '\n'.join(json.dumps(f) for f in frames[:1]) + '\n{"id": 3, "request"\n' + json.dumps(frames[1]) + '\n'
+        replies = [json.loads(l) for l in self.send(data.encode()).splitlines()]
+
+        self.assertEqual(sorted(str(r.get('id')) for r in replies), ['1', '2', 'None'])
+        self.assertIn({'id': None, 'error': 'invalid request'}, replies)
+        candidates = [r['candidates'] for r in replies if 'candidates' in r]
+        self.assertTrue(candidates[0])
+        self.assertEqual(candidates[0], candidates[1])
+
+    def test_invalid_request(self):
+        self.assertEqual(self.send(b'[{"remote_ip": 1}'), '[]\n')
+
+    def test_failed_request(self):
+        import json
+
+        # processing fails as local_endpoint must have the form ip@interface
+        failing = b'[{"local_endpoint": {"value": "10.0.0.1"}, "remote_ip": {"value": "8.8.8.8"}}]'
+        for _ in range(4):
+            self.assertEqual(self.send(failing), '[]\n')
+        frame = json.dumps({"id": 1, "request": json.loads(failing.decode())}) + '\n'
+        self.assertEqual(json.loads(self.send(frame.encode())), {'id': 1, 'candidates': []})
+        # the admission slots of the failed requests were released
+        self.assertTrue(json.loads(self.send(b'[{"remote_ip": {"value": "8.8.8.8", "precedence": 2}}]')))
+
+    def test_streamed_replies(self):
+        import json
+
+        def request(remote_ip):
+            return [{"remote_ip": {"value": remote_ip, "precedence": 2}, "transport": {"value": "TCP"}}]
+
+        # replies served from the candidate cache are not streamed, hence each request asks for a different address
+        frame = json.dumps({"id": 5, "request": request('8.8.8.8'), "stream": True}) + '\n'
+        replies = [json.loads(l) for l in self.send(frame.encode()).splitlines()]
+        self.assertGreater(len(replies), 1)
+        self.assertTrue(all(r['id'] == 5 and r['candidates'] for r in replies))
+        self.assertTrue(all(r.get('partial') for r in replies[:-1]))
+        candidates = json.loads(self.send(json.dumps(request('8.8.8.8')).encode()))
+        self.assertEqual(replies[-1], {'id': 5, 'candidates': candidates, 'done': True})
+
+        streamed = request('8.8.4.4')
+        streamed[0]['__stream_reply'] = {"value": True}
+        replies = [json.loads(l) for l in self.send(json.dumps(streamed).encode()).splitlines()]
+        self.assertGreater(len(replies), 1)
+        self.assertTrue(all(r.get('partial') for r in replies[:-1]))
+        candidates = json.loads(self.send(json.dumps(request('8.8.4.4')).encode()))
+        self.assertEqual(replies[-1], {'candidates': candidates, 'done': True})
+
+        # only the property selects a streamed reply
+        plain = request('1.2.3.4')
+        plain[0]['__stream_reply'] = {"value": False}
+        plain[0]['description'] = {"value": '"__stream_reply"'}
+        self.assertIsInstance(json.loads(self.send(json.dumps(plain).encode())), list)
+
 if __name__ == "__main__":
     print(sys.stdout.encoding)
     print(locale.getpreferredencoding())
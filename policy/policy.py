@@ -5,6 +5,7 @@ import math
 import numbers
 import shutil
 
+from iptrie import is_prefix, to_network
 from pmdefaults import *
 from pmdefaults import STYLES, CHARS
 
@@ -104,6 +105,7 @@ class PropertyValue(object):
     1. a single value such as 2, True, or "TCP".
     2. a set of values [100, 200, 300, "foo"]. uses a set() internally
     3. a numeric range {"start":1, "end":10}. uses a tuple internally
+    4. an IP prefix in CIDR notation "10.0.0.0/8". stored as a single string value
     """
     ANY = None
 
@@ -114,6 +116,7 @@ class PropertyValue(object):
         self.is_numeric = False
         self.is_set = False
         self.is_range = False
+        self.is_prefix = False
 
         self.value = value
 
@@ -137,11 +140,13 @@ class PropertyValue(object):
         self.is_set = False
         self.is_range = False
         self.is_numeric = False
+        self.is_prefix = False
 
         if isinstance(value, (int, float, bool, str)):
             self._value = value
             self.is_single = True
             self.is_numeric = True if isinstance(value, numbers.Number) else False
+            self.is_prefix = is_prefix(value)
         # min-max numeric range
         elif isinstance(value, (dict,)):
             try:
@@ -178,6 +183,7 @@ class PropertyValue(object):
             self.is_numeric = value.is_numeric
             self.is_set = value.is_set
             self.is_range = value.is_range
+            self.is_prefix = value.is_prefix
         elif isinstance(value, type(None)):
             self._value = None
         else:
@@ -204,6 +210,9 @@ class PropertyValue(object):
         if other.value == PropertyValue.ANY:
             return self
 
+        if self.is_prefix or other.is_prefix:
+            return self._overlapping_prefix(other)
+
         if (self.is_range or self.is_numeric) and (other.is_range or other.is_numeric):
             return self._overlapping_range(other)
 
@@ -246,6 +255,36 @@ class PropertyValue(object):
         else:
             return PropertyValue(new_set)
 
+    def _overlapping_prefix(self, other):
+        """
+        check if an IP prefix covers an address or overlaps with another prefix. Returns the more specific value.
+
+        """
+        assert isinstance(other, PropertyValue)
+
+        def covers(a, b):
+            return a is not None and b is not None and a.version == b.version and b.subnet_of(a)
+
+        prefix, value = (self, other) if self.is_prefix else (other, self)
+        network = to_network(prefix.value)
+
+        if value.is_set:
+            new_set = [i for i in value.value if covers(network, to_network(i))]
+            if not new_set:
+                return False
+            return PropertyValue(new_set)
+
+        if not value.is_single:
+            return False
+
+        value_network = to_network(value.value)
+        if covers(network, value_network):
+            return value
+        elif covers(value_network, network):
+            return prefix
+        else:
+            return False
+
     def _overlapping_range(self, other):
         """
         check for overlapping numeric ranges
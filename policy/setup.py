@@ -13,5 +13,7 @@ setup(name='neatpmd',
       author_email='zdravko@bozakov.de',
       url='https://github.com/NEAT-project/neat/tree/master/policy/',
       scripts=['neatpmd'],
-      py_modules=['policy', 'cib', 'pib', 'pmdefaults', 'pmhelper', 'resthelper', 'pmrest'],
+      py_modules=['policy', 'cib', 'pib', 'pmdefaults', 'pmhelper', 'resthelper', 'pmrest', 'iptrie', 'cibcache', 'pmstore',
+                  'cibshard', 'pmfeed', 'cibstream', 'pmpool', 'pmcache', 'pmoutput', 'pmmetrics', 'pmprofile',
+                  'pmprefork'],
       )